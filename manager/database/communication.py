@@ -1,73 +1,131 @@
-from neo4j import GraphDatabase
 import csv
-from multiprocessing import Pool
 import os
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+from utils.batching import BatchSizeController
+from utils.parallelization import RESOURCE_MANAGER
+from utils.job_context import report_progress
 
 URI = "bolt://memgraph:7687"
 AUTH = ("testuser123", "t123")
 
+DRIVERS = {}
+DRIVERS_LOCK = threading.Lock()
+# Function called with every query run by a thread before it is run, set while its queries are profiled
+QUERY_HOOKS = threading.local()
+
+
+def get_driver():
+    """
+    Driver of this process, shared by all its threads. The driver keeps a pool of connections,
+    so queries do not open a new connection each time. Forked worker processes create their own driver,
+    as connections can not be shared between processes.
+    """
+    with DRIVERS_LOCK:
+        driver = DRIVERS.get(os.getpid())
+        if driver is None:
+            # Imported with the first connection, as it takes a large part of the startup time
+            from neo4j import GraphDatabase
+
+            driver = DRIVERS[os.getpid()] = GraphDatabase.driver(URI, auth=AUTH)
+    return driver
+
+
+def set_query_hook(hook):
+    QUERY_HOOKS.hook = hook
+
+
+def notify_query(query, parameters=None):
+    hook = getattr(QUERY_HOOKS, "hook", None)
+    if hook is not None:
+        hook(query, parameters)
+
 
 def run_with_database_client(func):
-    with GraphDatabase.driver(URI, auth=AUTH) as client:
-        client.verify_connectivity()
-        result = func(client)
-    return result
-
-def get_query_results_list(query, record_transform_function):
-    with GraphDatabase.driver(URI, auth=AUTH) as client:
-        with client.session() as session:
-            result = session.run(query)
-            results = [record_transform_function(record) for record in result]
+    client = get_driver()
+    client.verify_connectivity()
+    return func(client)
+
+def get_query_results_list(query, record_transform_function, parameters=None):
+    notify_query(query, parameters)
+    with get_driver().session() as session:
+        result = session.run(query, parameters)
+        results = [record_transform_function(record) for record in result]
     return results
 
-def execute_query(query, return_full=False, free_memory=True):
+def execute_query(query, return_full=False, free_memory=True, parameters=None):
+    notify_query(query, parameters)
     try:
-        with GraphDatabase.driver(URI, auth=AUTH) as client:
-            with client.session() as session:
-                print("Running query:", query)
-                result = session.run(query)
-                if return_full:
-                    print(result.values())
-                else:
-                    print(result.single())
-                if free_memory:
-                    session.run("FREE MEMORY")
+        with get_driver().session() as session:
+            print("Running query:", query)
+            result = session.run(query, parameters)
+            if return_full:
+                print(result.values())
+            else:
+                print(result.single())
+            if free_memory:
+                session.run("FREE MEMORY")
 
     except BaseException as e:
         print("Failed to execute transaction")
         raise e
 
 
-def execute_query_to_csv(query, headers, output_file, modifier_function=None, expand_output_list=False):
+def execute_query_with_rows(query, rows, batch_size=10_000):
+    """Runs a query using UNWIND $rows for consecutive batches of rows."""
+    with get_driver().session() as session:
+        for start in range(0, len(rows), batch_size):
+            session.run(query, rows=rows[start : start + batch_size]).consume()
+
+
+def save_edges(headers, rows, edge_query=None, output_directory=None):
+    """
+    Appends computed edges to the csv files of the worker process in output_directory, if it is given,
+    and sends them to the database with edge_query, if it is given.
+    """
+    if output_directory is not None:
+        from utils.file_management import write_rows_to_worker_csv
+
+        write_rows_to_worker_csv(output_directory, headers, rows)
+    if edge_query is not None and len(rows) > 0:
+        execute_query_with_rows(edge_query, [dict(zip(headers, row)) for row in rows])
+
+
+def execute_query_to_csv(query, headers, output_file, modifier_function=None, expand_output_list=False, edge_query=None):
     """Runs the query and saves the query results to csv."""
+    notify_query(query)
 
     def process_records(tx):
         result = tx.run(query)
 
-        with open(output_file, "w", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-
-            writer.writerow(headers)
-            if modifier_function is None:
-                for record in result:
-                    writer.writerow(record.values())
+        processed = []
+        if modifier_function is None:
+            for record in result:
+                processed.append(record.values())
 
-            else:
-                for record in result:
-                    modified_record = modifier_function(record.values())
-                    if modified_record is not None:
-                        if expand_output_list:
-                            writer.writerows(modified_record)
-                        else:
-                            writer.writerow(modified_record)
-                            
+        else:
+            for record in result:
+                modified_record = modifier_function(record.values())
+                if modified_record is not None:
+                    if expand_output_list:
+                        processed.extend(modified_record)
+                    else:
+                        processed.append(modified_record)
+
+        if output_file is not None:
+            with open(output_file, "w", newline="") as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(headers)
+                writer.writerows(processed)
+        save_edges(headers, processed, edge_query)
         return "finished"
 
-    with GraphDatabase.driver(URI, auth=AUTH) as client:
-        client.verify_connectivity()
-        with client.session() as session:
-            value = session.execute_read(process_records)
-            print(value)
+    with get_driver().session() as session:
+        value = session.execute_read(process_records)
+        print(value)
 
 
 def execute_query_to_csv_parallelized(
@@ -78,59 +136,92 @@ def execute_query_to_csv_parallelized(
     expand_output_list=False,
     num_processes=10,
     chunk_size=100,
+    edge_query=None,
+    tuning_key=None,
 ):
+    """
+    Runs the query and processes its results with modifier_function in parallel chunks
+    on at most num_processes workers of the shared worker pool.
+    Every worker appends its results to its own csv files in output_directory, unless it is None.
+    Results are sent to the database with edge_query by the workers, if it is given.
+
+    chunk_size is only the initial number of records in a chunk, later chunk sizes are chosen
+    from the measured processing cost of a record and stored under tuning_key for the next run.
+    """
     if modifier_function is None:
         return execute_query_to_csv(
             query,
             headers,
-            os.path.join(output_directory, "chunk_001.csv"),
+            os.path.join(output_directory, "chunk_00001.csv") if output_directory is not None else None,
             modifier_function=modifier_function,
-            expand_output_list=expand_output_list
+            expand_output_list=expand_output_list,
+            edge_query=edge_query,
         )
 
-    os.makedirs(output_directory, exist_ok=True)
+    notify_query(query)
+    if output_directory is not None:
+        os.makedirs(output_directory, exist_ok=True)
     assert num_processes <= 20
 
     def process_records(tx):
-        result_iterator = tx.run(query)
+        result_iterator = (record.values() for record in tx.run(query))
+        controller = BatchSizeController(tuning_key, initial_size=chunk_size)
 
         done = 0
-        last_i = 1
-        with Pool(processes=num_processes) as pool:
-            for chunk_of_chunks in chunked_iterator(
-                chunked_iterator(result_iterator, chunk_size, unpack_record=True),
-                num_processes,
-            ):
-                args = []
-                for chunk in chunk_of_chunks:
-                    args.append(
-                        (
+        with RESOURCE_MANAGER.stage(num_processes) as stage:
+            pending = deque()
+            window_start = time.perf_counter()
+            window_busy = 0.0
+            window_chunks = 0
+            exhausted = False
+            while True:
+                while not exhausted and (not pending or stage.has_capacity()):
+                    chunk = list(islice(result_iterator, controller.next_size()))
+                    if not chunk:
+                        exhausted = True
+                        break
+                    controller.measure_payload(chunk)
+                    pending.append(
+                        stage.submit(
+                            process_record_chunk,
                             chunk,
-                            os.path.join(output_directory, f"chunk_{last_i:03d}.csv"),
                             headers,
                             modifier_function,
-                            expand_output_list
+                            expand_output_list,
+                            edge_query,
+                            output_directory,
                         )
                     )
-                    last_i += 1
-
-                processed_chunks = pool.starmap(process_record_chunk, args)
-
-                for processed_records in processed_chunks:
-                    done += processed_records
-                    print(done)
-            pool.close()
-            pool.join()
+                if not pending:
+                    break
+
+                records, processed_records, elapsed = pending.popleft().result()
+                controller.record_batch(records, elapsed)
+                done += processed_records
+                report_progress(records)
+                print(done)
+
+                window_busy += elapsed
+                window_chunks += 1
+                workers = stage.manager.get_share(stage)
+                if window_chunks >= workers:
+                    now = time.perf_counter()
+                    controller.record_utilization(window_busy, now - window_start, workers)
+                    window_start, window_busy, window_chunks = now, 0.0, 0
+        controller.save()
+        if output_directory is not None:
+            from utils.file_management import finish_csv_files
+
+            finish_csv_files(output_directory)
         return "finished"
 
-    with GraphDatabase.driver(URI, auth=AUTH) as client:
-        client.verify_connectivity()
-        with client.session() as session:
-            value = session.execute_read(process_records)
-            print(value)
+    with get_driver().session() as session:
+        value = session.execute_read(process_records)
+        print(value)
 
 
-def process_record_chunk(chunk, output_file, headers, modifier_function, expand_output_list):
+def process_record_chunk(chunk, headers, modifier_function, expand_output_list, edge_query=None, output_directory=None):
+    start_time = time.perf_counter()
     processed = []
     for record in chunk:
         modified_record = modifier_function(record)
@@ -139,22 +230,5 @@ def process_record_chunk(chunk, output_file, headers, modifier_function, expand_
                 processed.extend(modified_record)
             else:
                 processed.append(modified_record)
-    with open(output_file, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(headers)
-        writer.writerows(processed)
-    return len(processed)
-
-
-def chunked_iterator(iterator, chunk_size, unpack_record=False):
-    chunk = []
-    for item in iterator:
-        if unpack_record:
-            chunk.append(item.values())
-        else:
-            chunk.append(item)
-        if len(chunk) == chunk_size:
-            yield chunk
-            chunk = []
-    if chunk:
-        yield chunk
+    save_edges(headers, processed, edge_query, output_directory)
+    return len(chunk), len(processed), time.perf_counter() - start_time
@@ -0,0 +1,72 @@
+import math
+
+from database.communication import execute_query, get_query_results_list
+
+
+def set_edge_layout(relationship_type, label, layout):
+    """
+    Records how symmetric relationships of a type between nodes with a label are stored:
+    'directed' with two edges per pair of nodes, or 'undirected' with one edge per pair.
+    """
+    execute_query(
+        f"""
+        MERGE (m:EdgeLayout {{relationship: "{relationship_type}", label: "{label}"}})
+        SET m.layout = "{layout}"
+        """
+    )
+
+
+def get_edge_layout(relationship_type, label):
+    query = f"""
+    MATCH (m:EdgeLayout {{relationship: "{relationship_type}", label: "{label}"}})
+    RETURN m.layout
+    """
+    layouts = get_query_results_list(query, lambda record: record.value())
+    return layouts[0] if layouts else "directed"
+
+
+def get_neighbour_pattern(relationship_type, label, variable=""):
+    """
+    Relationship pattern matching every neighbour of a node exactly once in the stored layout.
+    """
+    if get_edge_layout(relationship_type, label) == "undirected":
+        return f"-[{variable}:{relationship_type}]-"
+    return f"-[{variable}:{relationship_type}]->"
+
+
+# Road.tree_counts[i] is the number of trees CLOSE_TO the road at a distance in (i, i + 1] meters,
+# the first bucket also counts distance 0 and the last one all longer distances
+TREE_COUNT_BUCKETS = 20
+
+
+def build_road_tree_histograms():
+    """Materializes counts of trees close to every road in one meter distance buckets."""
+    execute_query("MATCH (road:Road) WHERE road.tree_counts IS NOT NULL REMOVE road.tree_counts")
+    execute_query(
+        f"""
+        MATCH (:Tree)-[e:CLOSE_TO]->(road:Road)
+        WITH road, COLLECT(e.distance) AS distances
+        SET road.tree_counts = [
+            b IN range(0, {TREE_COUNT_BUCKETS - 1}) |
+            size([d IN distances WHERE (b = 0 OR d > b) AND (b = {TREE_COUNT_BUCKETS - 1} OR d <= b + 1)])
+        ]
+        """
+    )
+    execute_query(
+        f"""
+        MERGE (m:Aggregate {{name: "road_tree_counts"}})
+        SET m.buckets = {TREE_COUNT_BUCKETS}
+        """
+    )
+
+
+def ensure_road_tree_histograms():
+    """Builds the road tree counts if they were not built after the trees were joined with roads."""
+    query = 'MATCH (m:Aggregate {name: "road_tree_counts"}) RETURN m.buckets'
+    if get_query_results_list(query, lambda record: record.value()) != [TREE_COUNT_BUCKETS]:
+        build_road_tree_histograms()
+
+
+def get_tree_count_buckets(max_distance):
+    """Number of leading buckets of Road.tree_counts which include all trees up to max_distance."""
+    return min(max(math.ceil(max_distance), 1), TREE_COUNT_BUCKETS)
@@ -0,0 +1,196 @@
+"""
+Query plans of query runners and relationship creators.
+
+While a runner is profiled, every query it sends to the database is first run under PROFILE,
+or only EXPLAIN for queries which write to the graph, so plans are taken with the real parameters
+and with the indexes the runner creates around its queries. Plans are saved next to the results,
+e.g. /data/query6.profile.json, and compared with the plans saved by the previous profile.
+"""
+import difflib
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from database.communication import get_driver, set_query_hook
+
+SKIPPED_QUERY = re.compile(
+    r"^\s*((CREATE|DROP)\s+(POINT\s+|EDGE\s+|TEXT\s+)?INDEX|FREE\s+MEMORY|SHOW\b|DROP\s+GRAPH|PROFILE\b|EXPLAIN\b|STORAGE\b|ANALYZE\b)",
+    re.IGNORECASE,
+)
+# Queries which change the graph are only explained, so profiling does not apply their changes twice
+WRITING_QUERY = re.compile(r"\b(CREATE|MERGE|SET|DELETE|REMOVE|DETACH|LOAD\s+CSV|CALL)\b", re.IGNORECASE)
+NUMBER = re.compile(r"[-+]?\d+(\.\d+)?")
+
+
+def get_profile_path(kind, no):
+    name = "query" if kind == "query" else "relationship"
+    return f"/data/{name}{no}.profile.json"
+
+
+def normalize_query(query):
+    return " ".join(query.split())
+
+
+def parse_number(value):
+    match = NUMBER.search(str(value))
+    return float(match.group()) if match else None
+
+
+def parse_operator(text):
+    """Depth and name of an operator from a plan line like '| * ScanAllByLabel (n :Road)', None for branch lines."""
+    prefix, star, operator = text.partition("*")
+    if not star:
+        return None
+    return prefix.count("|"), operator.strip()
+
+
+def get_indexes(session):
+    try:
+        rows = session.run("SHOW INDEX INFO").values()
+    except Exception:
+        return []
+    return sorted(f"{row[1]}({row[2] or ''}) {row[0]}" for row in rows)
+
+
+def capture_plan(query, explain_only, parameters=None):
+    """Operator tree of a query, with hits and times of every operator when it is profiled."""
+    profile = not explain_only and not WRITING_QUERY.search(query)
+    with get_driver().session() as session:
+        indexes = get_indexes(session)
+        start_time = time.perf_counter()
+        records = session.run(f"{'PROFILE' if profile else 'EXPLAIN'} {query}", parameters).data()
+        elapsed = time.perf_counter() - start_time
+
+    operators = []
+    for record in records:
+        values = list(record.values())
+        parsed = parse_operator(values[0])
+        if parsed is None:
+            continue
+        depth, name = parsed
+        operator = {"depth": depth, "operator": name}
+        if profile:
+            operator["hits"] = parse_number(record.get("ACTUAL HITS"))
+            operator["relative_time"] = parse_number(record.get("RELATIVE TIME"))
+            operator["absolute_time_ms"] = parse_number(record.get("ABSOLUTE TIME"))
+        operators.append(operator)
+    return {
+        "query": normalize_query(query),
+        "mode": "profile" if profile else "explain",
+        "seconds": elapsed if profile else None,
+        "indexes": indexes,
+        "operators": operators,
+    }
+
+
+@contextmanager
+def profile_queries(explain_only=False):
+    """Captures plans of the queries run by this thread in the block, into the yielded list."""
+    plans = []
+
+    def hook(query, parameters):
+        if SKIPPED_QUERY.match(query):
+            return
+        try:
+            plans.append(capture_plan(query, explain_only, parameters))
+        except Exception as e:
+            print(f"Failed to capture plan of query: {normalize_query(query)[:200]} ({e!r})")
+
+    set_query_hook(hook)
+    try:
+        yield plans
+    finally:
+        set_query_hook(None)
+
+
+def format_operators(plan):
+    return ["  " * operator["depth"] + operator["operator"] for operator in plan["operators"]]
+
+
+def diff_plans(previous, current):
+    """Lines describing differences of plans of the same runner, compared in the order the queries were run."""
+    lines = []
+    if len(previous) != len(current):
+        lines.append(f"Number of queries changed from {len(previous)} to {len(current)}")
+    for i, (old, new) in enumerate(zip(previous, current), start=1):
+        header = f"Query {i}: {new['query'][:120]}"
+        changes = []
+        if old["query"] != new["query"]:
+            changes.append("  query text changed")
+        added = sorted(set(new["indexes"]) - set(old["indexes"]))
+        removed = sorted(set(old["indexes"]) - set(new["indexes"]))
+        if added:
+            changes.append(f"  indexes added: {', '.join(added)}")
+        if removed:
+            changes.append(f"  indexes removed: {', '.join(removed)}")
+        operator_diff = list(
+            difflib.unified_diff(format_operators(old), format_operators(new), "previous", "current", lineterm="", n=1)
+        )
+        changes.extend(f"  {line}" for line in operator_diff)
+        if old.get("seconds") is not None and new.get("seconds") is not None:
+            ratio = new["seconds"] / old["seconds"] if old["seconds"] > 0 else float("inf")
+            if operator_diff or ratio > 1.5 or ratio < 1 / 1.5:
+                changes.append(f"  time {old['seconds']:.3f} s -> {new['seconds']:.3f} s")
+        if changes:
+            lines.append(header)
+            lines.extend(changes)
+    return lines
+
+
+def print_plans(plans):
+    for i, plan in enumerate(plans, start=1):
+        time_text = f", {plan['seconds']:.3f} s" if plan["seconds"] is not None else ""
+        print(f"Query {i} ({plan['mode']}{time_text}): {plan['query'][:200]}")
+        for operator in plan["operators"]:
+            details = ""
+            if operator.get("hits") is not None:
+                details = f"  hits={operator['hits']:.0f}"
+            if operator.get("absolute_time_ms") is not None:
+                details += f" time={operator['absolute_time_ms']:.3f} ms"
+            print("    " + "  " * operator["depth"] + operator["operator"] + details)
+
+
+def profile_runner(kind, no, runner, *args, explain_only=False, **kwargs):
+    """
+    Runs a query runner or relationship creator while capturing plans of its queries,
+    saves them and prints how they differ from the previously saved plans.
+    """
+    output_path = get_profile_path(kind, no)
+    previous = None
+    if os.path.exists(output_path):
+        with open(output_path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+
+    start_time = time.perf_counter()
+    with profile_queries(explain_only) as plans:
+        runner(*args, **kwargs)
+    elapsed = time.perf_counter() - start_time
+
+    profile = {
+        "kind": kind,
+        "no": no,
+        "arguments": [*map(str, args), *(f"{name}={value}" for name, value in kwargs.items())],
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "seconds": elapsed,
+        "plans": plans,
+    }
+    with open(output_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(output_path + ".tmp", output_path)
+
+    print_plans(plans)
+    print(f"Plans of {len(plans)} queries saved to {output_path}")
+    if previous is None:
+        print("No previous plans to compare with")
+        return profile
+    differences = diff_plans(previous["plans"], plans)
+    if differences:
+        print(f"Plans changed since {previous['created']}:")
+        for line in differences:
+            print(line)
+    else:
+        print(f"Plans are the same as on {previous['created']}")
+    return profile
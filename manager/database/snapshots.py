@@ -0,0 +1,264 @@
+"""
+Named snapshots of fully built graphs.
+
+A snapshot is created by the database in its data directory, shared with the manager through /data,
+and moved to /data/snapshots/<name> with a manifest of the source files, the preprocessed files
+the graph was built from and the relationships it contains.
+
+A snapshot is restored by making it the only snapshot in the data directory and restarting
+the database, which recovers it on startup. The restart is requested through a file watched
+by the entrypoint of the database container, which enables recovery only for that restart.
+The snapshot is removed from the data directory once it is recovered.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+
+from settings import DATABASE_DATA_DIRECTORY
+from plugins import DATA_LOADERS
+from database.communication import get_driver, get_query_results_list
+from relationships.scheduling import RELATIONSHIP_DEPENDENCIES
+
+SNAPSHOT_DIRECTORY = "/data/snapshots"
+DATABASE_SNAPSHOT_DIRECTORY = os.path.join(DATABASE_DATA_DIRECTORY, "snapshots")
+DATABASE_WAL_DIRECTORY = os.path.join(DATABASE_DATA_DIRECTORY, "wal")
+# Watched by memgraph/entrypoint.sh, which restarts the database when it appears
+RESTART_REQUEST_FILE = os.path.join(DATABASE_DATA_DIRECTORY, "restart_request")
+# Preprocessed files of the data loaders, besides the directories named after the data types
+PREPROCESSED_DIRECTORIES = ["roadnodes", "roadnodes_roads", "roadnodes_roadnodes", "roads_roads", "geometry_store"]
+RESTART_TIMEOUT_SECONDS = 60
+RECOVERY_TIMEOUT_SECONDS = 3600
+
+
+def get_snapshot_path(name):
+    return os.path.join(SNAPSHOT_DIRECTORY, name)
+
+
+def get_source_manifest():
+    """Name, size and modification time of the source csv file of every data type."""
+    files = [name for name in os.listdir("/data") if name.lower().endswith(".csv")]
+    manifest = {}
+    for data_type in DATA_LOADERS:
+        filename = next((name for name in files if data_type in name), None)
+        if filename is not None:
+            stat = os.stat(os.path.join("/data", filename))
+            manifest[data_type] = {"file": filename, "bytes": stat.st_size, "modified": stat.st_mtime}
+    return manifest
+
+
+def get_directory_fingerprint(directory):
+    """Number, size and hash of names and sizes of files in a directory, which change when it is preprocessed differently."""
+    entries = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            entries.append((os.path.relpath(path, directory), os.path.getsize(path)))
+    entries.sort()
+    digest = hashlib.sha256(json.dumps(entries).encode("utf-8")).hexdigest()
+    return {"files": len(entries), "bytes": sum(size for _, size in entries), "fingerprint": digest}
+
+
+def get_preprocessed_manifest():
+    manifest = {}
+    for name in [*DATA_LOADERS, *PREPROCESSED_DIRECTORIES]:
+        directory = os.path.join("/data", name)
+        if os.path.isdir(directory):
+            manifest[name] = get_directory_fingerprint(directory)
+    return manifest
+
+
+def get_node_counts():
+    nodes = get_query_results_list(
+        "MATCH (n) RETURN labels(n)[0] AS label, count(*) AS count", lambda record: record.values()
+    )
+    return {label: count for label, count in nodes}
+
+
+def get_graph_contents():
+    """Node counts by label, relationship counts by pattern and relationships created, judged by their exact patterns."""
+    patterns = get_query_results_list(
+        """
+        MATCH (a)-[r]->(b)
+        RETURN labels(a)[0] AS start, type(r) AS type, labels(b)[0] AS end, count(*) AS count
+        """,
+        lambda record: record.values(),
+    )
+    created_patterns = {(start, type, end) for start, type, end, _ in patterns}
+    relationships = [
+        relationship_no
+        for relationship_no, dependencies in RELATIONSHIP_DEPENDENCIES.items()
+        if dependencies["pattern"] in created_patterns
+    ]
+    return {
+        "nodes": get_node_counts(),
+        "relationship_patterns": [
+            {"start": start, "type": type, "end": end, "count": count} for start, type, end, count in patterns
+        ],
+        "relationships": relationships,
+    }
+
+
+def list_database_snapshots():
+    if not os.path.isdir(DATABASE_SNAPSHOT_DIRECTORY):
+        return []
+    return [entry for entry in os.scandir(DATABASE_SNAPSHOT_DIRECTORY) if entry.is_file()]
+
+
+def create_snapshot(name):
+    """Creates a snapshot of the current graph and stores it with its manifest under a name."""
+    path = get_snapshot_path(name)
+    if os.path.exists(path):
+        raise ValueError(f"Snapshot {name} already exists")
+    contents = get_graph_contents()
+    existing = {entry.path for entry in list_database_snapshots()}
+    start_time = time.time()
+    with get_driver().session() as session:
+        session.run("CREATE SNAPSHOT").consume()
+    created = [entry for entry in list_database_snapshots() if entry.path not in existing]
+    if not created:
+        raise RuntimeError(
+            f"No new snapshot found in {DATABASE_SNAPSHOT_DIRECTORY}, "
+            "the database has to be started with --data-directory pointing to it"
+        )
+    snapshot_file = max(created, key=lambda entry: entry.stat().st_mtime)
+
+    os.makedirs(path + ".tmp", exist_ok=True)
+    # Both directories are on the /data volume, so the snapshot is moved without copying
+    shutil.move(snapshot_file.path, os.path.join(path + ".tmp", "snapshot"))
+    manifest = {
+        "name": name,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "seconds": time.time() - start_time,
+        "bytes": os.path.getsize(os.path.join(path + ".tmp", "snapshot")),
+        "sources": get_source_manifest(),
+        "preprocessed": get_preprocessed_manifest(),
+        **contents,
+    }
+    with open(os.path.join(path + ".tmp", "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+    print(
+        f"Snapshot {name} of {sum(contents['nodes'].values())} nodes and relationships "
+        f"{', '.join(contents['relationships']) or 'none'} saved to {path} ({manifest['bytes'] / 2**30:.2f} GiB)"
+    )
+    return manifest
+
+
+def load_manifest(name):
+    path = os.path.join(get_snapshot_path(name), "manifest.json")
+    if not os.path.exists(path):
+        raise ValueError(f"Unknown snapshot {name}, available: {', '.join(get_snapshot_names()) or 'none'}")
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def get_snapshot_names():
+    if not os.path.isdir(SNAPSHOT_DIRECTORY):
+        return []
+    return sorted(
+        name
+        for name in os.listdir(SNAPSHOT_DIRECTORY)
+        if os.path.exists(os.path.join(SNAPSHOT_DIRECTORY, name, "manifest.json"))
+    )
+
+
+def list_snapshots():
+    names = get_snapshot_names()
+    if not names:
+        print(f"No snapshots in {SNAPSHOT_DIRECTORY}")
+    for name in names:
+        manifest = load_manifest(name)
+        print(
+            f"{name}: created {manifest['created']}, {manifest['bytes'] / 2**30:.2f} GiB, "
+            f"{sum(manifest['nodes'].values())} nodes, relationships {', '.join(manifest['relationships']) or 'none'}"
+        )
+
+
+def compare_with_preprocessed(manifest):
+    """Differences between preprocessed files recorded in a snapshot manifest and the current ones."""
+    current = get_preprocessed_manifest()
+    differences = []
+    for name in sorted(set(manifest["preprocessed"]) | set(current)):
+        recorded = manifest["preprocessed"].get(name)
+        present = current.get(name)
+        if recorded is None:
+            differences.append(f"{name} was preprocessed after the snapshot")
+        elif present is None:
+            differences.append(f"{name} is missing, it was preprocessed for the snapshot")
+        elif recorded["fingerprint"] != present["fingerprint"]:
+            differences.append(
+                f"{name} differs: {recorded['files']} files, {recorded['bytes']} bytes in the snapshot, "
+                f"{present['files']} files, {present['bytes']} bytes now"
+            )
+    return differences
+
+
+def wait_for_database(available, timeout):
+    """Waits until the database accepts connections, or stops accepting them, returns False on timeout."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            get_driver().verify_connectivity()
+            is_available = True
+        except Exception:
+            is_available = False
+        if is_available == available:
+            return True
+        time.sleep(1)
+    return False
+
+
+def restore_snapshot(name, force=False):
+    """
+    Restarts the database from a snapshot. The snapshot has to match the current preprocessed files,
+    which later imports and relationships build on, unless force is given.
+    """
+    manifest = load_manifest(name)
+    differences = compare_with_preprocessed(manifest)
+    if differences and not force:
+        raise ValueError(
+            f"Snapshot {name} does not match the current preprocessed data, restore it with 'force' to ignore:\n  "
+            + "\n  ".join(differences)
+        )
+
+    # The database recovers the newest snapshot, so snapshots and write-ahead logs made since are set aside
+    replaced = os.path.join(SNAPSHOT_DIRECTORY, ".replaced", datetime.now().strftime("%Y%m%d_%H%M%S"))
+    for directory in [DATABASE_SNAPSHOT_DIRECTORY, DATABASE_WAL_DIRECTORY]:
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                os.makedirs(os.path.join(replaced, os.path.basename(directory)), exist_ok=True)
+                shutil.move(entry.path, os.path.join(replaced, os.path.basename(directory), entry.name))
+    os.makedirs(DATABASE_SNAPSHOT_DIRECTORY, exist_ok=True)
+    snapshot_file = os.path.join(get_snapshot_path(name), "snapshot")
+    target = os.path.join(DATABASE_SNAPSHOT_DIRECTORY, f"{name}_snapshot")
+    try:
+        # A hard link keeps the named snapshot when the database removes old snapshots
+        os.link(snapshot_file, target)
+    except OSError:
+        shutil.copyfile(snapshot_file, target)
+
+    start_time = time.time()
+    with open(RESTART_REQUEST_FILE, "w", encoding="utf-8") as f:
+        f.write(name)
+    print(f"Restarting the database from snapshot {name}")
+    try:
+        if not wait_for_database(False, RESTART_TIMEOUT_SECONDS):
+            if os.path.exists(RESTART_REQUEST_FILE):
+                os.remove(RESTART_REQUEST_FILE)
+            raise RuntimeError("The database did not restart, its container has to run memgraph/entrypoint.sh")
+        if not wait_for_database(True, RECOVERY_TIMEOUT_SECONDS):
+            raise RuntimeError(f"The database did not start within {RECOVERY_TIMEOUT_SECONDS} seconds")
+    finally:
+        # The named snapshot stays in the snapshot directory, the data directory keeps no snapshot to recover later
+        if os.path.exists(target):
+            os.remove(target)
+
+    nodes = get_node_counts()
+    if nodes != manifest["nodes"]:
+        raise RuntimeError(f"Restored graph has nodes {nodes}, snapshot {name} has {manifest['nodes']}")
+    print(f"Snapshot {name} restored in {time.time() - start_time:.2f} seconds")
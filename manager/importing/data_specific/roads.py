@@ -92,6 +92,43 @@ def create_road_node_road_connection_query(path):
         """
 
 
+def preprocess_road_road_connections(road_node_df, df):
+    memberships = road_node_df[["id", "road_id"]].drop_duplicates()
+    memberships = memberships[memberships.groupby("id")["road_id"].transform("size") > 1]
+    memberships = memberships.merge(
+        df[["id", "start_node_id", "end_node_id"]].rename(columns={"id": "road_id"}),
+        on="road_id",
+    )
+    memberships["part"] = np.select(
+        [
+            memberships["id"] == memberships["start_node_id"],
+            memberships["id"] == memberships["end_node_id"],
+        ],
+        ["start", "end"],
+        default="mid",
+    )
+
+    road_road_connections_df = memberships[["id", "road_id", "part"]].merge(
+        memberships[["id", "road_id"]], on="id", suffixes=("_start", "_end")
+    )
+    road_road_connections_df = road_road_connections_df[
+        road_road_connections_df["road_id_start"] != road_road_connections_df["road_id_end"]
+    ]
+    road_road_connections_df = road_road_connections_df.rename(
+        columns={"id": "rn_id", "road_id_start": "road_start", "road_id_end": "road_end"}
+    )
+    return road_road_connections_df[["road_start", "road_end", "rn_id", "part"]]
+
+
+# road_start	road_end	rn_id	part
+def create_road_road_connection_query(path):
+    return f"""
+        LOAD CSV FROM '{path}' WITH HEADER AS row
+        MATCH (firstRoad:Road {{id: toInteger(row.road_start)}}), (secondRoad:Road {{id: toInteger(row.road_end)}})
+        CREATE (firstRoad)-[:ROAD_CONNECTED_TO {{rn_id: toInteger(row.rn_id), part: row.part}}]->(secondRoad)
+    """
+
+
 def preprocess_road_node_connections(df):
     df.fillna({"oneway": "no"}, inplace=True)
     exploded_df = df[["oneway", "nodes", "id"]].explode("nodes")
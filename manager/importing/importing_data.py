@@ -6,6 +6,7 @@ import gc
 
 from utils.file_management import prepare_files, find_file, prepare_paths, split_large_csv
 from utils.parallelization import execute_with_pool
+from utils.geometry_store import ensure_geometry_store
 from database.communication import execute_query
 from settings import get_clear_preprocessed_value
 
@@ -45,6 +46,7 @@ from importing.data_specific.roads import (
     preprocess_road_node_connections,
     create_road_node_connection_input_query,
     create_road_node_road_connection_query,
+    preprocess_road_road_connections,
 )
 from importing.data_specific.railways import (
     preprocess_railways_df,
@@ -52,8 +54,10 @@ from importing.data_specific.railways import (
 )
 
 
-def default_loading(name, preprocess_function, input_query_creation_function, max_rows=1_000_000):
+def default_loading(name, preprocess_function, input_query_creation_function, max_rows=1_000_000, geometry_store_name=None):
     target_dir = prepare_files(name, dataframe_modifier=preprocess_function, max_rows=max_rows, clear_output=get_clear_preprocessed_value())
+    if geometry_store_name is not None:
+        ensure_geometry_store(geometry_store_name, target_dir)
     queries = [
         input_query_creation_function(os.path.join(target_dir, file.name))
         for file in Path(target_dir).glob("*.csv")
@@ -62,28 +66,28 @@ def default_loading(name, preprocess_function, input_query_creation_function, ma
     execute_query('FREE MEMORY')
 
 def load_buildings(name="buildings"):
-    default_loading(name, preprocess_buildings_df, create_buildings_input_query, max_rows=500_000)
+    default_loading(name, preprocess_buildings_df, create_buildings_input_query, max_rows=500_000, geometry_store_name="buildings")
 
 def load_cities(name="cities"):
     default_loading(name, preprocess_cities_df, create_cities_input_query)
 
 def load_communes(name="communes"):
-    default_loading(name, preprocess_communes_df, create_communes_input_query)
+    default_loading(name, preprocess_communes_df, create_communes_input_query, geometry_store_name="communes")
 
 def load_countries(name="countries"):
-    default_loading(name, preprocess_countries_df, create_countries_input_query)
+    default_loading(name, preprocess_countries_df, create_countries_input_query, geometry_store_name="countries")
 
 def load_powiats(name="powiats"):
-    default_loading(name, preprocess_powiats_df, create_powiats_input_query)
+    default_loading(name, preprocess_powiats_df, create_powiats_input_query, geometry_store_name="powiats")
 
 def load_railways(name="railways"):
-    default_loading(name, preprocess_railways_df, create_railways_input_query)
+    default_loading(name, preprocess_railways_df, create_railways_input_query, geometry_store_name="railways")
     
 def load_trees(name="trees"):
     default_loading(name, preprocess_trees_df, create_trees_input_query)
 
 def load_voivodships(name="voivodships"):
-    default_loading(name, preprocess_voivodships_df, create_voivodships_input_query)
+    default_loading(name, preprocess_voivodships_df, create_voivodships_input_query, geometry_store_name="voivodships")
     
     
 def preprocess_and_save_road_components(name):
@@ -93,8 +97,9 @@ def preprocess_and_save_road_components(name):
     roadnodes_directory = '/data/roadnodes'
     roadnodes_roads_connection_directory = '/data/roadnodes_roads'
     roadnodes_roadnodes_connection_directory = '/data/roadnodes_roadnodes'
+    roads_roads_connection_directory = '/data/roads_roads'
     
-    dirs = [roads_directory, roadnodes_directory, roadnodes_roads_connection_directory, roadnodes_roadnodes_connection_directory]
+    dirs = [roads_directory, roadnodes_directory, roadnodes_roads_connection_directory, roadnodes_roadnodes_connection_directory, roads_roads_connection_directory]
     any_missing = any(not os.path.exists(directory) for directory in dirs)
     for directory in dirs:
         if os.path.exists(directory) and (get_clear_preprocessed_value() or any_missing):
@@ -121,6 +126,10 @@ def preprocess_and_save_road_components(name):
         # ================= ROADNODE ROAD CONNECTION =====================
         road_node_road_connections_df_file_path = os.path.join('/data', f"road_node_road_connections.csv")
         road_node_df[['id', 'road_id']].drop_duplicates(subset=['id', 'road_id']).to_csv(road_node_road_connections_df_file_path, index=False)
+        
+        # ================= ROAD ROAD CONNECTION =====================
+        road_road_connections_df_file_path = os.path.join('/data', f"road_road_connections.csv")
+        preprocess_road_road_connections(road_node_df, df).to_csv(road_road_connections_df_file_path, index=False)
         del road_node_df
         gc.collect()
         print("road nodes preprocessed")
@@ -139,17 +148,20 @@ def preprocess_and_save_road_components(name):
         split_large_csv(road_node_df_file_path, roadnodes_directory)
         split_large_csv(road_node_road_connections_df_file_path, roadnodes_roads_connection_directory)
         split_large_csv(road_node_connetions_df_file_path, roadnodes_roadnodes_connection_directory)
+        split_large_csv(road_road_connections_df_file_path, roads_roads_connection_directory)
         
         os.remove(roads_df_file_path)
         os.remove(road_node_df_file_path)
         os.remove(road_node_road_connections_df_file_path)
         os.remove(road_node_connetions_df_file_path)
+        os.remove(road_road_connections_df_file_path)
         
     return dirs
 
 def load_roads(name="roads"):
     dirs = preprocess_and_save_road_components(name)
-    roads_directory, roadnodes_directory, roadnodes_roads_connection_directory, roadnodes_roadnodes_connection_directory = dirs
+    roads_directory, roadnodes_directory, roadnodes_roads_connection_directory, roadnodes_roadnodes_connection_directory, _ = dirs
+    ensure_geometry_store("roads", roads_directory)
     # ROAD creation
     road_queries = [
         create_roads_input_query(os.path.join(roads_directory, file.name))
@@ -185,16 +197,3 @@ def load_roads(name="roads"):
     execute_query('DROP INDEX ON :Road(id)')
     execute_query('DROP INDEX ON :RoadNode(id)')
     execute_query('FREE MEMORY')
-    
-
-DATA_LOADERS = {
-    "roads": load_roads,
-    "buildings": load_buildings,
-    "cities": load_cities,
-    "communes": load_communes,
-    "countries": load_countries,
-    "powiats": load_powiats,
-    "railways": load_railways,
-    "trees": load_trees,
-    "voivodships": load_voivodships,
-}
@@ -1,18 +1,40 @@
 import time
-from importing.importing_data import DATA_LOADERS
+from plugins import DATA_LOADERS, RELATIONSHIP_CREATORS, QUERY_RUNNERS, PRESET_QUERY_ARGUMENTS
 from database.communication import execute_query
-from queries.query_runners import QUERY_RUNNERS
-from settings import toggle_clear_preprocessed
-from relationships.relationship_creation import RELATIONSHIP_CREATORS
+from queries.result_cache import (
+    run_cached_query,
+    get_query_lock,
+    graph_change,
+    clear_query_cache,
+    print_cache_statistics,
+)
+from settings import (
+    toggle_clear_preprocessed,
+    set_edge_output_mode,
+    EDGE_OUTPUT_MODES,
+    set_symmetric_edge_layout,
+    SYMMETRIC_EDGE_LAYOUTS,
+    set_query_cache_enabled,
+    QUERY_SERVICE_PORT,
+)
+from utils.parallelization import RESOURCE_MANAGER
+from utils.job_context import report_failure
 import signal
 import sys
 import os
 import shutil
+import threading
 import readline
 
+# Modules of commands are imported when a command first runs, so that the CLI starts at once
+
 
 def signal_handler(sig, frame):
     print("You pressed Ctrl+C!")
+    # Running jobs stop at their next chance and worker tasks are drained, so no process is left behind
+    if JOB_MANAGER[0] is not None:
+        JOB_MANAGER[0].cancel_all(wait=True)
+    RESOURCE_MANAGER.shutdown()
     sys.exit(0)
 
 
@@ -27,8 +49,32 @@ CLEAR_DATABASE_COMMAND = "delete_all"
 RUN_CUSTOM_QUERY_COMMAND = "cq"
 RUN_QUERY_COMMAND = "q"
 TOGGLE_PREPROCESSED_DATA_CLEANING = "clear_preprocessed"
+EDGE_OUTPUT_MODE_COMMAND = "edge_mode"
+SYMMETRIC_EDGE_LAYOUT_COMMAND = "symmetric_edges"
+QUERY_CACHE_COMMAND = "cache"
+QUERY_CACHE_OPTIONS = ["on", "off", "clear", "stats"]
+SNAPSHOT_COMMAND = "snapshot"
+SNAPSHOT_OPTIONS = ["create", "list", "restore"]
+FORCE_ARGUMENT = "force"
+JOB_COMMAND = "job"
+JOB_OPTIONS = ["run", "pipeline", "status", "list", "cancel", "wait"]
+# Commands which can run as stages of background jobs
+JOB_STAGE_COMMANDS = [
+    IMPORT_COMMAND,
+    CREATE_RELATIONSHIP_COMMAND,
+    RUN_QUERY_COMMAND,
+    RUN_CUSTOM_QUERY_COMMAND,
+    CLEAR_DATABASE_COMMAND,
+    SNAPSHOT_COMMAND,
+]
+JOB_MANAGER = [None]
+PROFILE_COMMAND = "profile"
+EXPLAIN_ARGUMENT = "explain"
 REMOVE_COMMAND = "srm"
 HELP_COMMAND = "help"
+ESTIMATE_ARGUMENT = "estimate"
+SWEEP_ARGUMENT = "sweep"
+REGION_ARGUMENT = "region"
 
 
 def measure_time(func, *args, **kwargs):
@@ -55,7 +101,7 @@ def import_data(arguments):
                     duration = measure_time(DATA_LOADERS[argument])
                     report.append((argument, duration))
                 else:
-                    print(
+                    report_failure(
                         f"Unknown data type: '{argument}'. Available options: {', '.join(DATA_LOADERS.keys())}, all."
                     )
                     break
@@ -72,7 +118,7 @@ def import_data(arguments):
                 )
                 report.append((argument, duration))
             else:
-                print(
+                report_failure(
                     f"Unknown data type: '{argument}'. Available options: {', '.join(DATA_LOADERS.keys())}, all."
                 )
                 break
@@ -87,18 +133,33 @@ def import_data(arguments):
 
 def create_relationships(arguments):
     report = []
+    if arguments[0] == ESTIMATE_ARGUMENT:
+        if len(arguments) < 2:
+            print(
+                f"Usage: {CREATE_RELATIONSHIP_COMMAND} {ESTIMATE_ARGUMENT} <relationship_no> [sample_size] [distance]"
+            )
+            return
+        from relationships.estimation import estimate_relationship
+
+        estimate_relationship(*arguments[1:4])
+        return
     if "all" in arguments:
         print("Creating all relationships...\n")
-        for name, loader in RELATIONSHIP_CREATORS.items():
-            duration = measure_time(loader)
-            report.append((name, duration))
+        from relationships.scheduling import run_relationship_schedule, print_schedule_report
+
+        timeline = run_relationship_schedule(RELATIONSHIP_CREATORS)
+        report = [(name, end - start) for name, start, end in timeline]
+        print_schedule_report(timeline)
+        failed = [name for name in RELATIONSHIP_CREATORS if name not in dict(report)]
+        if failed:
+            report_failure(f"Relationships {', '.join(failed)} were not created")
     else:
         for argument in arguments:
             if argument in RELATIONSHIP_CREATORS:
                 duration = measure_time(RELATIONSHIP_CREATORS[argument])
                 report.append((argument, duration))
             else:
-                print(
+                report_failure(
                     f"Unknown relationship id: '{argument}'. Available options: {', '.join(RELATIONSHIP_CREATORS.keys())}, all."
                 )
                 break
@@ -111,18 +172,123 @@ def create_relationships(arguments):
     )
 
 
-PRESET_QUERY_ARGUMENTS = {
-    "1": [],
-    "2": [],
-    "3": [],
-    "4": [50, "house", 5],
-    "5": [80, 100],
-    "6": [200, 20, "strict"],
-    "7": [3, 10],
-    "8": [564607399, 219955028],
-    "9": [5],
-    "10": [10, 15],
-}
+def get_job_manager():
+    if JOB_MANAGER[0] is None:
+        from service.jobs import JobManager
+
+        JOB_MANAGER[0] = JobManager(run_command)
+    return JOB_MANAGER[0]
+
+
+def check_job_stage_command(command):
+    name = command.split()[0].lower() if command.split() else ""
+    if name not in JOB_STAGE_COMMANDS:
+        raise ValueError(f"Command '{command}' can not run in a job, available: {', '.join(JOB_STAGE_COMMANDS)}")
+
+
+def manage_jobs(arguments):
+    usage = (
+        f"Usage: {JOB_COMMAND} run <command> | {JOB_COMMAND} pipeline <spec_file.json> | {JOB_COMMAND} status [job_id] "
+        f"| {JOB_COMMAND} list | {JOB_COMMAND} cancel <job_id> | {JOB_COMMAND} wait <job_id>"
+    )
+    if not arguments or arguments[0] not in JOB_OPTIONS:
+        print(usage)
+        return
+    from service.jobs import load_pipeline
+
+    option, arguments = arguments[0], arguments[1:]
+    manager = get_job_manager()
+    try:
+        if option == "run" and arguments:
+            command = " ".join(arguments)
+            check_job_stage_command(command)
+            manager.submit(command, [{"name": arguments[0], "command": command}])
+        elif option == "pipeline" and len(arguments) == 1:
+            name, stages = load_pipeline(arguments[0])
+            for stage in stages:
+                check_job_stage_command(stage["command"])
+            manager.submit(name, stages)
+        elif option in ("status", "list"):
+            manager.print_status(arguments[0] if arguments and option == "status" else None)
+        elif option == "cancel" and len(arguments) == 1:
+            manager.cancel(arguments[0])
+        elif option == "wait" and len(arguments) == 1:
+            job = manager.wait(arguments[0])
+            print(f"Job {job.id} ({job.name}) {job.status}")
+        else:
+            print(usage)
+    except (ValueError, OSError) as e:
+        print(e)
+
+
+def manage_snapshots(arguments):
+    usage = (
+        f"Usage: {SNAPSHOT_COMMAND} create <name> | {SNAPSHOT_COMMAND} list "
+        f"| {SNAPSHOT_COMMAND} restore <name> [{FORCE_ARGUMENT}]"
+    )
+    if not arguments or arguments[0] not in SNAPSHOT_OPTIONS:
+        report_failure(usage)
+        return
+    from database.snapshots import create_snapshot, list_snapshots, restore_snapshot
+
+    option, arguments = arguments[0], arguments[1:]
+    try:
+        if option == "create" and len(arguments) == 1:
+            create_snapshot(arguments[0])
+        elif option == "list":
+            list_snapshots()
+        elif option == "restore" and arguments and set(arguments[1:]) <= {FORCE_ARGUMENT}:
+            with graph_change():
+                restore_snapshot(arguments[0], force=FORCE_ARGUMENT in arguments[1:])
+        else:
+            report_failure(usage)
+    except (ValueError, RuntimeError, OSError) as e:
+        report_failure(str(e))
+
+
+def split_region_argument(arguments):
+    """Arguments without 'region=<region>', and the region as a keyword argument of a query runner."""
+    region_prefix = f"{REGION_ARGUMENT}="
+    kwargs = {
+        REGION_ARGUMENT: argument[len(region_prefix) :]
+        for argument in arguments
+        if argument.startswith(region_prefix)
+    }
+    return [argument for argument in arguments if not argument.startswith(region_prefix)], kwargs
+
+
+def profile(arguments):
+    from database.query_profiling import profile_runner
+
+    explain_only = EXPLAIN_ARGUMENT in arguments
+    arguments = [argument for argument in arguments if argument != EXPLAIN_ARGUMENT]
+    if len(arguments) < 2 or arguments[0] not in (RUN_QUERY_COMMAND, CREATE_RELATIONSHIP_COMMAND):
+        print(
+            f"Usage: {PROFILE_COMMAND} {RUN_QUERY_COMMAND} <query_no> [argument_no1 ...|preset] [{EXPLAIN_ARGUMENT}] "
+            f"or {PROFILE_COMMAND} {CREATE_RELATIONSHIP_COMMAND} <relationship_no> [{EXPLAIN_ARGUMENT}]"
+        )
+        return
+    kind, no = arguments[0], arguments[1]
+    try:
+        if kind == CREATE_RELATIONSHIP_COMMAND:
+            if no not in RELATIONSHIP_CREATORS:
+                print(f"Unknown relationship id: '{no}'. Available options: {', '.join(RELATIONSHIP_CREATORS.keys())}.")
+                return
+            with graph_change():
+                profile_runner("relationship", no, RELATIONSHIP_CREATORS[no], explain_only=explain_only)
+            return
+
+        if no not in QUERY_RUNNERS:
+            print(f"Unknown query type: '{no}'. Available options: {', '.join(QUERY_RUNNERS.keys())}.")
+            return
+        args, kwargs = split_region_argument(arguments[2:])
+        if "preset" in args:
+            args = PRESET_QUERY_ARGUMENTS[no]
+        # Run without the result cache, so that the queries reach the database
+        with get_query_lock(no):
+            profile_runner("query", no, QUERY_RUNNERS[no], *args, explain_only=explain_only, **kwargs)
+    except (TypeError, ValueError) as e:
+        print(e)
 
 
 def run_query(arguments):
@@ -131,7 +297,7 @@ def run_query(arguments):
         print("Running all queries with preset parameters \n")
         report = []
         for name, loader in QUERY_RUNNERS.items():
-            duration = measure_time(loader, *PRESET_QUERY_ARGUMENTS[name])
+            duration = measure_time(run_cached_query, name, loader, *PRESET_QUERY_ARGUMENTS[name])
             report.append((name, duration))
         print("\Query running report:")
         for name, duration in report:
@@ -139,34 +305,48 @@ def run_query(arguments):
         print(
             f"Total time taken: {sum([duration for _, duration in report]):.2f} seconds.\n"
         )
+        print_cache_statistics()
         return
 
     query_no = arguments[0]
     if query_no not in QUERY_RUNNERS:
-        print(
+        report_failure(
             f"Unknown query type: '{query_no}'. Available options: {', '.join(QUERY_RUNNERS.keys())}, all."
         )
         return
 
+    if len(arguments) > 1 and arguments[1] == SWEEP_ARGUMENT:
+        from queries.sweeps import run_sweep
+
+        try:
+            duration = measure_time(run_sweep, query_no, arguments[2:])
+            print(f"Query {query_no} sweep run in {duration:.2f} seconds.")
+        except ValueError as e:
+            report_failure(str(e))
+        return
+
+    arguments, kwargs = split_region_argument(arguments)
     try:
         if "preset" in arguments[1:]:
             print(f"Running query {query_no} with preset arguments...\n")
             duration = measure_time(
-                QUERY_RUNNERS[query_no], *PRESET_QUERY_ARGUMENTS[query_no]
+                run_cached_query, query_no, QUERY_RUNNERS[query_no], *PRESET_QUERY_ARGUMENTS[query_no], **kwargs
             )
             print(f"Query {query_no.capitalize()} run in {duration:.2f} seconds.")
         else:
             args = arguments[1:]
-            duration = measure_time(QUERY_RUNNERS[query_no], *args)
+            duration = measure_time(run_cached_query, query_no, QUERY_RUNNERS[query_no], *args, **kwargs)
             print(f"Query {query_no.capitalize()} run in {duration:.2f} seconds.")
+    except ValueError as e:
+        report_failure(str(e))
     except TypeError as e:
-        print(e)
         print(f"Query {query_no} requires the following argumets")
         print(
             QUERY_RUNNERS[query_no].__code__.co_varnames[
                 : QUERY_RUNNERS[query_no].__code__.co_argcount
             ]
         )
+        report_failure(str(e))
 
 
 def print_help():
@@ -183,10 +363,33 @@ def print_help():
     print(
         f"Usage: {CREATE_RELATIONSHIP_COMMAND} <relationship_no1> [relationship_no2 ...] or '{CREATE_RELATIONSHIP_COMMAND} all'"
     )
+    print(
+        f"To estimate edge count, memory and time of a relationship before creating it use: \n\t{CREATE_RELATIONSHIP_COMMAND} {ESTIMATE_ARGUMENT} <relationship_no> [sample_size] [distance]"
+    )
     print(f"")
     print(
         f"Usage: {RUN_QUERY_COMMAND} <query_no> [argument_no1 argument_no2 ...] or '{RUN_QUERY_COMMAND} <query_no> preset' or '{RUN_QUERY_COMMAND} all'"
     )
+    print(
+        f"""To run a query for every combination of parameter values use:
+          {RUN_QUERY_COMMAND} <query_no> {SWEEP_ARGUMENT} <parameter>=<value1>,<value2>,... [<parameter>=<value1>,...]
+          e.g. '{RUN_QUERY_COMMAND} 6 {SWEEP_ARGUMENT} max_distance=50,100,200 max_angle=10,20'.
+          Parameters which are not given take preset values. Queries 4, 6, 7 and 10 fetch their data once
+          for all combinations. Results are saved in /data/query<query_no>_sweep, one file per combination."""
+    )
+    print(
+        f"""To limit a query to a part of the country add '{REGION_ARGUMENT}=<region>' to its arguments, where region is
+          <commune|powiat|voivodship>:<name or id>, a name or id of one of them, or bbox:<minx>,<miny>,<maxx>,<maxy> in EPSG:2180,
+          e.g. '{RUN_QUERY_COMMAND} 4 preset {REGION_ARGUMENT}=powiat:Kraków' or '{RUN_QUERY_COMMAND} 9 {REGION_ARGUMENT}=małopolskie'.
+          Spaces in names are written as underscores. Queries 1-10 take a region."""
+    )
+    print(
+        f"""To see query plans of a query or relationship use:
+          {PROFILE_COMMAND} {RUN_QUERY_COMMAND} <query_no> [argument_no1 ...|preset] [{EXPLAIN_ARGUMENT}] or {PROFILE_COMMAND} {CREATE_RELATIONSHIP_COMMAND} <relationship_no> [{EXPLAIN_ARGUMENT}]
+          Every database query is run under PROFILE first, with hits and time of every operator, or only EXPLAIN
+          for queries changing the graph or with '{EXPLAIN_ARGUMENT}'. Plans are saved to /data/query<query_no>.profile.json
+          or /data/relationship<relationship_no>.profile.json and compared with the previously saved ones."""
+    )
     print(f"")
     print(f"Use command '{CLEAR_DATABASE_COMMAND}' to clear all data in the database")
     print(f"Use command '{RUN_CUSTOM_QUERY_COMMAND} <query>' to run a custom query")
@@ -195,6 +398,182 @@ def print_help():
           If clearing mode is off then already processed data will not be recalculated.
           Default is off."""
     )
+    print(
+        f"""Use command '{EDGE_OUTPUT_MODE_COMMAND} <{'|'.join(EDGE_OUTPUT_MODES)}>' to choose how computed relationships reach the database.
+          csv - saved to csv files and loaded after computation (default),
+          stream - sent to the database by workers while they are computed,
+          stream_csv - sent while computed and also saved to csv files,
+          database - computed inside the database with the spatial query module, where available."""
+    )
+    print(
+        f"""Use command '{SYMMETRIC_EDGE_LAYOUT_COMMAND} <{'|'.join(SYMMETRIC_EDGE_LAYOUTS)}>' to choose how symmetric relationships (5, 6, 7) are stored.
+          directed - two edges per pair of nodes (default),
+          undirected - one edge per pair of nodes, queries match it in both directions."""
+    )
+    print(
+        f"""Queries can also be run over HTTP on port {QUERY_SERVICE_PORT}:
+          GET /queries lists queries and their parameters,
+          GET /queries/<query_no>?<parameter>=<value>&... or ?preset runs a query,
+          POST /queries/<query_no> with {{"parameters": [...]}} runs a query with parameters in order,
+          'offset' and 'limit' in the query string return a page of the result."""
+    )
+    print(
+        f"""Use command '{QUERY_CACHE_COMMAND} <{'|'.join(QUERY_CACHE_OPTIONS)}>' to manage the query result cache.
+          Results are reused for the same query and parameters until the graph is changed
+          by an import, relationship creation, custom query or '{CLEAR_DATABASE_COMMAND}'.
+          on/off - use the cache or always run queries (default is on),
+          clear - remove all cached results,
+          stats - show cache hits, misses and size."""
+    )
+    print(
+        f"""Use command '{JOB_COMMAND}' to run commands in the background while the CLI stays available:
+          {JOB_COMMAND} run <command> - runs one of {', '.join(JOB_STAGE_COMMANDS)} as a job, e.g. '{JOB_COMMAND} run cr all',
+          {JOB_COMMAND} pipeline <spec_file.json> - runs the stages of a pipeline spec in /data, stages start when
+              the stages in their "after" list are done, e.g. {{"name": "nightly", "stages": [{{"name": "import",
+              "command": "import auto all"}}, {{"name": "relationships", "command": "cr all", "after": ["import"]}}]}},
+          {JOB_COMMAND} status [job_id] or {JOB_COMMAND} list - state, time, processed items and throughput of every stage,
+          {JOB_COMMAND} cancel <job_id> - starts no more stages and stops running ones after their current worker tasks,
+          {JOB_COMMAND} wait <job_id> - waits until the job is finished.
+          Status of jobs is saved in /data/jobs."""
+    )
+    print(
+        f"""Use command '{SNAPSHOT_COMMAND}' to save and restore fully built graphs:
+          {SNAPSHOT_COMMAND} create <name> - snapshot of the current graph, saved in /data/snapshots/<name> with a manifest
+              of source files, preprocessed files and relationships, e.g. as the last stage of a pipeline,
+          {SNAPSHOT_COMMAND} list - saved snapshots,
+          {SNAPSHOT_COMMAND} restore <name> [{FORCE_ARGUMENT}] - restarts the database from a snapshot, only if the snapshot
+              was built from the current preprocessed files, unless '{FORCE_ARGUMENT}' is given."""
+    )
+    print(
+        f"""A single command can also be given as arguments of main.py, e.g. 'python main.py {RUN_QUERY_COMMAND} 5 80 100'.
+          It is run without the prompt and the query service, and the program exits when it is done,
+          including jobs it started, e.g. 'python main.py {JOB_COMMAND} pipeline nightly.json' for unattended rebuilds."""
+    )
+
+
+def start_query_service(port=QUERY_SERVICE_PORT):
+    """Starts the query service in a background thread, which also imports it, so the prompt appears at once."""
+
+    def serve():
+        from service.http_service import serve_forever
+
+        serve_forever(port)
+
+    thread = threading.Thread(target=serve, name="query-service", daemon=True)
+    thread.start()
+    return thread
+
+
+def run_command(command):
+    """Runs one command of the CLI, returns False if the CLI should exit."""
+    if command[: len(EXIT_COMMAND)].lower() == EXIT_COMMAND:
+        print("Exiting the CLI tool.")
+        return False
+
+    if command[: len(IMPORT_COMMAND)].lower() == IMPORT_COMMAND:
+        parts = command.split()
+        if len(parts) > 1:
+            arguments = parts[1:]
+            with graph_change():
+                import_data(arguments)
+        else:
+            report_failure(
+                f"Usage: {IMPORT_COMMAND} <data_type1> [data_type2 ...] or '{IMPORT_COMMAND} all'"
+            )
+    elif (
+        command[: len(CREATE_RELATIONSHIP_COMMAND)].lower()
+        == CREATE_RELATIONSHIP_COMMAND
+    ):
+        parts = command.split()
+        if len(parts) > 1:
+            arguments = parts[1:]
+            with graph_change():
+                create_relationships(arguments)
+        else:
+            report_failure(
+                f"Usage: {CREATE_RELATIONSHIP_COMMAND} <relationship_no1> [relationship_no2 ...] or '{CREATE_RELATIONSHIP_COMMAND} all'"
+            )
+    elif command[: len(RUN_QUERY_COMMAND)].lower() == RUN_QUERY_COMMAND:
+        parts = command.split()
+        if len(parts) > 1:
+            arguments = parts[1:]
+            run_query(arguments)
+        else:
+            report_failure(
+                f"Usage: {RUN_QUERY_COMMAND} <query_no1> [argument_no1 argument_no2 ...] or '{RUN_QUERY_COMMAND} all'"
+            )
+    elif (
+        command[: len(RUN_CUSTOM_QUERY_COMMAND)].lower()
+        == RUN_CUSTOM_QUERY_COMMAND
+    ):
+        query = command[len(RUN_CUSTOM_QUERY_COMMAND) :]
+        # Custom queries may change the graph
+        with graph_change():
+            execute_query(query, return_full=True)
+    elif (
+        command[: len(CLEAR_DATABASE_COMMAND)].lower() == CLEAR_DATABASE_COMMAND
+    ):
+        with graph_change():
+            execute_query("DROP GRAPH")
+    elif (
+        command[: len(TOGGLE_PREPROCESSED_DATA_CLEANING)].lower()
+        == TOGGLE_PREPROCESSED_DATA_CLEANING
+    ):
+        toggle_clear_preprocessed()
+    elif (
+        command[: len(EDGE_OUTPUT_MODE_COMMAND)].lower()
+        == EDGE_OUTPUT_MODE_COMMAND
+    ):
+        parts = command.split()
+        if len(parts) > 1:
+            set_edge_output_mode(parts[1])
+        else:
+            print(
+                f"Usage: {EDGE_OUTPUT_MODE_COMMAND} <{'|'.join(EDGE_OUTPUT_MODES)}>"
+            )
+    elif (
+        command[: len(SYMMETRIC_EDGE_LAYOUT_COMMAND)].lower()
+        == SYMMETRIC_EDGE_LAYOUT_COMMAND
+    ):
+        parts = command.split()
+        if len(parts) > 1:
+            set_symmetric_edge_layout(parts[1])
+        else:
+            print(
+                f"Usage: {SYMMETRIC_EDGE_LAYOUT_COMMAND} <{'|'.join(SYMMETRIC_EDGE_LAYOUTS)}>"
+            )
+    elif command[: len(QUERY_CACHE_COMMAND)].lower() == QUERY_CACHE_COMMAND:
+        parts = command.split()
+        if len(parts) > 1 and parts[1] in ("on", "off"):
+            set_query_cache_enabled(parts[1] == "on")
+        elif len(parts) > 1 and parts[1] == "clear":
+            clear_query_cache()
+        elif len(parts) > 1 and parts[1] == "stats":
+            print_cache_statistics()
+        else:
+            print(f"Usage: {QUERY_CACHE_COMMAND} <{'|'.join(QUERY_CACHE_OPTIONS)}>")
+    elif command[: len(SNAPSHOT_COMMAND)].lower() == SNAPSHOT_COMMAND:
+        manage_snapshots(command.split()[1:])
+    elif command[: len(JOB_COMMAND)].lower() == JOB_COMMAND:
+        manage_jobs(command.split()[1:])
+    elif command[: len(PROFILE_COMMAND)].lower() == PROFILE_COMMAND:
+        profile(command.split()[1:])
+    elif command[: len(REMOVE_COMMAND)].lower() == REMOVE_COMMAND:
+        parts = command.split()
+        if parts[1] == "dir":
+            dir = os.path.join("/data", parts[2])
+            shutil.rmtree(dir)
+            if os.path.exists(dir):
+                os.rmdir(dir)
+        elif parts[1] == "file":
+            file = os.path.join("/data", parts[2])
+            os.remove(file)
+    elif command[: len(HELP_COMMAND)].lower() == HELP_COMMAND:
+        print_help()
+    else:
+        print(f"Unknown command.")
+        print(f"Enter '{HELP_COMMAND}' to see commands")
+    return True
 
 
 def run_cli():
@@ -204,79 +583,36 @@ def run_cli():
     print("Welcome to CLI Tool!\nEnter a command. Type 'exit' to quit.")
     print(f"All files should be in csv format and be located in \data directory")
     print(f"Enter '{HELP_COMMAND}' to see commands")
+    # Workers are forked before any data is loaded into the main process
+    RESOURCE_MANAGER.start()
+    start_query_service()
 
     while True:
         try:
-            command = input("> ").strip()
-            if command[: len(EXIT_COMMAND)].lower() == EXIT_COMMAND:
-                print("Exiting the CLI tool.")
+            if not run_command(input("> ").strip()):
                 break
-
-            if command[: len(IMPORT_COMMAND)].lower() == IMPORT_COMMAND:
-                parts = command.split()
-                if len(parts) > 1:
-                    arguments = parts[1:]
-                    import_data(arguments)
-                else:
-                    print(
-                        f"Usage: {IMPORT_COMMAND} <data_type1> [data_type2 ...] or '{IMPORT_COMMAND} all'"
-                    )
-            elif (
-                command[: len(CREATE_RELATIONSHIP_COMMAND)].lower()
-                == CREATE_RELATIONSHIP_COMMAND
-            ):
-                parts = command.split()
-                if len(parts) > 1:
-                    arguments = parts[1:]
-                    create_relationships(arguments)
-                else:
-                    print(
-                        f"Usage: {CREATE_RELATIONSHIP_COMMAND} <relationship_no1> [relationship_no2 ...] or '{CREATE_RELATIONSHIP_COMMAND} all'"
-                    )
-            elif command[: len(RUN_QUERY_COMMAND)].lower() == RUN_QUERY_COMMAND:
-                parts = command.split()
-                if len(parts) > 1:
-                    arguments = parts[1:]
-                    run_query(arguments)
-                else:
-                    print(
-                        f"Usage: {RUN_QUERY_COMMAND} <query_no1> [argument_no1 argument_no2 ...] or '{RUN_QUERY_COMMAND} all'"
-                    )
-            elif (
-                command[: len(RUN_CUSTOM_QUERY_COMMAND)].lower()
-                == RUN_CUSTOM_QUERY_COMMAND
-            ):
-                query = command[len(RUN_CUSTOM_QUERY_COMMAND) :]
-                execute_query(query, return_full=True)
-            elif (
-                command[: len(CLEAR_DATABASE_COMMAND)].lower() == CLEAR_DATABASE_COMMAND
-            ):
-                execute_query("DROP GRAPH")
-            elif (
-                command[: len(TOGGLE_PREPROCESSED_DATA_CLEANING)].lower()
-                == TOGGLE_PREPROCESSED_DATA_CLEANING
-            ):
-                toggle_clear_preprocessed()
-            elif command[: len(REMOVE_COMMAND)].lower() == REMOVE_COMMAND:
-                parts = command.split()
-                if parts[1] == "dir":
-                    dir = os.path.join("/data", parts[2])
-                    shutil.rmtree(dir)
-                    if os.path.exists(dir):
-                        os.rmdir(dir)
-                elif parts[1] == "file":
-                    file = os.path.join("/data", parts[2])
-                    os.remove(file)
-            elif command[: len(HELP_COMMAND)].lower() == HELP_COMMAND:
-                print_help()
-            else:
-                print(f"Unknown command.")
-                print(f"Enter '{HELP_COMMAND}' to see commands")
-
         except KeyboardInterrupt:
             print("\nExiting the CLI tool.")
             break
+    RESOURCE_MANAGER.shutdown()
 
 
 if __name__ == "__main__":
-    run_cli()
+    if sys.argv[1:] == ["serve"]:
+        # Only the query service, for running without a terminal
+        from service.http_service import serve_forever
+
+        RESOURCE_MANAGER.start()
+        serve_forever()
+    elif sys.argv[1:]:
+        # A single command, e.g. 'python main.py q 5 80 100', workers are started only if it needs them
+        if sys.argv[1].lower() == JOB_COMMAND and sys.argv[2:3] in (["run"], ["pipeline"]):
+            # Jobs run their stages in threads, so workers are forked before any of them starts
+            RESOURCE_MANAGER.start()
+        run_command(" ".join(sys.argv[1:]))
+        # Jobs started by the command, e.g. 'python main.py job pipeline nightly.json', are run to the end
+        if JOB_MANAGER[0] is not None:
+            JOB_MANAGER[0].wait_all()
+        RESOURCE_MANAGER.shutdown()
+    else:
+        run_cli()
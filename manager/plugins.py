@@ -0,0 +1,54 @@
+"""
+Data loaders, relationship creators and query runners available to the CLI and the query service.
+Their modules are imported when they are first used.
+"""
+from utils.registry import LazyRegistry
+
+DATA_LOADERS = LazyRegistry("data loader")
+for data_type in ["roads", "buildings", "cities", "communes", "countries", "powiats", "railways", "trees", "voivodships"]:
+    DATA_LOADERS.register(
+        data_type,
+        "importing.importing_data",
+        f"load_{data_type}",
+        optional_parameters=["name"],
+        dependencies=["pandas", "geopandas", "shapely"],
+    )
+
+RELATIONSHIP_CREATORS = LazyRegistry("relationship")
+for relationship_no in range(1, 11):
+    RELATIONSHIP_CREATORS.register(
+        str(relationship_no),
+        "relationships.relationship_creation",
+        f"create_relationship_{relationship_no}",
+        dependencies=["pandas", "geopandas", "shapely", "numpy"],
+    )
+
+QUERY_RUNNERS = LazyRegistry("query")
+QUERY_DEPENDENCIES = ["numpy", "shapely", "pandas"]
+# Parameters and preset arguments of query runners, all of them can also be limited to a region
+QUERY_PARAMETERS = {
+    "1": ([], []),
+    "2": ([], []),
+    "3": ([], []),
+    "4": (["max_distance", "building_type", "min_count"], [50, "house", 5]),
+    "5": (["min_angle", "max_angle"], [80, 100]),
+    "6": (["max_distance", "max_angle", "mode"], [200, 20, "strict"]),
+    "7": (["max_distance", "min_count"], [3, 10]),
+    "8": (["start_road_id"], [564607399, 219955028]),
+    "9": (["max_length"], [5]),
+    "10": (["max_distance", "min_count"], [10, 15]),
+}
+QUERY_OPTIONAL_PARAMETERS = {"8": ["end_road_id"]}
+QUERY_EXTRA_DEPENDENCIES = {"4": ["scipy"], "7": ["scipy"], "8": ["scipy"], "9": ["networkx"]}
+for query_no, (parameters, preset) in QUERY_PARAMETERS.items():
+    QUERY_RUNNERS.register(
+        query_no,
+        "queries.query_runners",
+        f"run_query_{query_no}",
+        parameters=parameters,
+        optional_parameters=QUERY_OPTIONAL_PARAMETERS.get(query_no, []) + ["region"],
+        dependencies=QUERY_DEPENDENCIES + QUERY_EXTRA_DEPENDENCIES.get(query_no, []),
+        preset=preset,
+    )
+
+PRESET_QUERY_ARGUMENTS = {query_no: preset for query_no, (_, preset) in QUERY_PARAMETERS.items()}
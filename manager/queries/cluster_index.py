@@ -0,0 +1,209 @@
+import os
+import re
+
+import numpy as np
+import shapely
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from scipy.spatial import Delaunay, cKDTree
+
+from utils.geometry_store import ensure_geometry_store, get_geometry_store
+from database.communication import get_query_results_list
+from queries.regions import resolve_region, point_in_region_condition
+
+CLUSTER_INDEX_DIRECTORY = "/data/cluster_index"
+# Sparse minimum spanning tree treats zero weights as missing edges
+WEIGHT_OFFSET = 1.0
+# Buildings are clustered in the same area as CLOSE_TO relationships of buildings
+BUILDING_CLUSTER_REGION = "powiat:powiat wielicki"
+
+
+def get_index_path(name):
+    return os.path.join(CLUSTER_INDEX_DIRECTORY, f"{re.sub(r'[^0-9A-Za-z_]+', '_', name)}.npz")
+
+
+def spanning_forest(n, u, v, w):
+    """Minimum spanning forest of a graph with n nodes and edges (u, v, w), as edges sorted by weight."""
+    if len(u) == 0:
+        return u, v, w
+    graph = coo_matrix((w + WEIGHT_OFFSET, (u, v)), shape=(n, n)).tocsr()
+    forest = minimum_spanning_tree(graph).tocoo()
+    order = np.argsort(forest.data, kind="stable")
+    return forest.row[order], forest.col[order], forest.data[order] - WEIGHT_OFFSET
+
+
+def points_spanning_forest(xs, ys):
+    """
+    Euclidean minimum spanning tree of points, computed on the edges of their Delaunay triangulation,
+    which contains it. Points with equal coordinates are joined by edges of zero length.
+    """
+    coords = np.column_stack([xs, ys])
+    unique_coords, first, inverse = np.unique(coords, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    duplicates = np.flatnonzero(first[inverse] != np.arange(len(coords)))
+    dup_u, dup_v = first[inverse[duplicates]], duplicates
+
+    if len(unique_coords) >= 3:
+        simplices = Delaunay(unique_coords).simplices
+        edges = np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]])
+        edges = np.unique(np.sort(edges, axis=1), axis=0)
+    else:
+        edges = np.array([[0, 1]] if len(unique_coords) == 2 else [], dtype=np.int64).reshape(-1, 2)
+    weights = np.linalg.norm(unique_coords[edges[:, 0]] - unique_coords[edges[:, 1]], axis=1)
+    u, v, w = spanning_forest(len(unique_coords), edges[:, 0], edges[:, 1], weights)
+
+    u = np.concatenate([dup_u, first[u]])
+    v = np.concatenate([dup_v, first[v]])
+    w = np.concatenate([np.zeros(len(duplicates)), w])
+    return u, v, w
+
+
+def geometries_spanning_forest(ids, xs, ys, radii, store_name, max_distance, sources=None, batch_size=10_000):
+    """
+    Minimum spanning forest of geometries joined by edges not longer than max_distance.
+    Candidate pairs are found with a KD-tree on geometry centers, whose distance is at most
+    max_distance plus the radii of both geometries, and exact distances are read from the geometry store.
+    If a mask of sources is given, only edges with at least one source geometry are considered.
+    The forest is folded in batches, as the spanning forest of (forest + batch edges) is the spanning forest
+    of all edges seen so far, so the candidate pairs never have to be held in memory at once.
+    """
+    n = len(ids)
+    sources = np.ones(n, dtype=bool) if sources is None else sources
+    source_positions = np.flatnonzero(sources)
+    centers = np.column_stack([xs, ys])
+    tree = cKDTree(centers)
+    store = get_geometry_store(store_name)
+    max_radius = radii.max() if n > 0 else 0.0
+    u = v = np.empty(0, dtype=np.int64)
+    w = np.empty(0)
+
+    for start in range(0, len(source_positions), batch_size):
+        batch = source_positions[start : start + batch_size]
+        neighbours = tree.query_ball_point(centers[batch], r=max_distance + radii[batch] + max_radius)
+        counts = np.fromiter((len(items) for items in neighbours), dtype=np.int64, count=len(batch))
+        batch_u = np.repeat(batch, counts)
+        batch_v = np.fromiter((j for items in neighbours for j in items), dtype=np.int64, count=counts.sum())
+        # Pairs of two sources are found from both of them, other pairs only from their source
+        keep = (batch_u < batch_v) | ~sources[batch_v]
+        batch_u, batch_v = batch_u[keep], batch_v[keep]
+        if len(batch_u) == 0:
+            continue
+
+        distances = shapely.distance(store.get_many(ids[batch_u]), store.get_many(ids[batch_v]))
+        close = distances <= max_distance
+        u, v, w = spanning_forest(
+            n,
+            np.concatenate([u, batch_u[close]]),
+            np.concatenate([v, batch_v[close]]),
+            np.concatenate([w, distances[close]]),
+        )
+        print(f"Cluster index: {start + len(batch)} of {len(source_positions)} geometries processed")
+    return u, v, w
+
+
+def save_cluster_index(name, ids, xs, ys, u, v, w, max_distance):
+    os.makedirs(CLUSTER_INDEX_DIRECTORY, exist_ok=True)
+    path = get_index_path(name)
+    np.savez(path + ".tmp.npz", ids=ids, xs=xs, ys=ys, u=u, v=v, w=w, max_distance=max_distance)
+    os.replace(path + ".tmp.npz", path)
+    print(f"Cluster index '{name}' saved with {len(ids)} nodes and {len(w)} edges")
+
+
+def load_cluster_index(name):
+    path = get_index_path(name)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as index:
+        return {key: index[key] for key in index.files}
+
+
+def get_node_count(label, condition="", parameters=None):
+    query = f"MATCH (n:{label}) {condition} RETURN COUNT(n)"
+    return get_query_results_list(query, lambda record: record.value(), parameters)[0]
+
+
+def get_tree_cluster_index():
+    """Single-linkage hierarchy of all trees, valid for any distance, built when missing or outdated."""
+    index = load_cluster_index("trees")
+    if index is not None and len(index["ids"]) == get_node_count("Tree"):
+        return index
+
+    print("Building cluster index of trees")
+    query = "MATCH (t:Tree) RETURN t.id, t.geometry.x, t.geometry.y"
+    rows = get_query_results_list(query, lambda record: record.values())
+    ids, xs, ys = (np.array(values) for values in zip(*rows)) if rows else (np.empty(0),) * 3
+    u, v, w = points_spanning_forest(xs.astype(float), ys.astype(float))
+    save_cluster_index("trees", ids, xs, ys, u, v, w, np.inf)
+    return load_cluster_index("trees")
+
+
+def get_building_condition(region, max_distance, max_radius):
+    """
+    Condition on buildings of the index built for max_distance: buildings of the type in the region,
+    or close enough to one of them to be joined to it.
+    """
+    margin = max_distance + 2 * max_radius
+    return f"WHERE n.building = $building_type AND {point_in_region_condition(region, 'n.center', margin)}"
+
+
+def get_building_cluster_index(building_type, max_distance):
+    """
+    Single-linkage hierarchy of buildings of a type, valid up to the distance it was built for.
+    Like CLOSE_TO relationships of buildings, it joins buildings in powiat wielicki to buildings close to them.
+    Built when missing, outdated or built for a shorter distance than max_distance.
+    """
+    name = f"buildings_{building_type}"
+    region = resolve_region(BUILDING_CLUSTER_REGION)
+    # The building type comes from the query service, so it is passed to the database as a parameter
+    parameters = {"building_type": building_type}
+    max_radius = get_query_results_list(
+        "MATCH (n:Building) WHERE n.building = $building_type RETURN MAX(n.radius)",
+        lambda record: record.value(),
+        parameters,
+    )[0] or 0.0
+    index = load_cluster_index(name)
+    if (
+        index is not None
+        and max_distance <= index["max_distance"]
+        and len(index["ids"])
+        == get_node_count("Building", get_building_condition(region, index["max_distance"], max_radius), parameters)
+    ):
+        return index
+
+    print(f"Building cluster index of '{building_type}' buildings up to {max_distance} meters")
+    ensure_geometry_store("buildings")
+    query = f"""
+    MATCH (n:Building) {get_building_condition(region, max_distance, max_radius)}
+    RETURN n.id, n.center.x, n.center.y, n.radius
+    """
+    rows = get_query_results_list(query, lambda record: record.values(), parameters)
+    ids, xs, ys, radii = (np.array(values) for values in zip(*rows)) if rows else (np.empty(0),) * 4
+    xs, ys = xs.astype(float), ys.astype(float)
+    minx, miny, maxx, maxy = region["bbox"]
+    sources = (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy)
+    u, v, w = geometries_spanning_forest(
+        ids.astype(np.int64), xs, ys, radii.astype(float), "buildings", max_distance, sources
+    )
+    save_cluster_index(name, ids, xs, ys, u, v, w, max_distance)
+    return load_cluster_index(name)
+
+
+def cut_cluster_index(index, max_distance, min_count):
+    """
+    Clusters of nodes connected by chains of edges not longer than max_distance,
+    with at least min_count nodes, as arrays of node positions in the index.
+    """
+    n = len(index["ids"])
+    if n == 0:
+        return []
+    k = np.searchsorted(index["w"], max_distance, side="right")
+    graph = coo_matrix((np.ones(k), (index["u"][:k], index["v"][:k])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    counts = np.bincount(labels)
+    order = np.argsort(labels, kind="stable")
+    boundaries = np.cumsum(counts)[:-1]
+    return [
+        members
+        for members, count in zip(np.split(order, boundaries), counts)
+        if count >= min_count
+    ]
@@ -0,0 +1,120 @@
+from collections import deque
+
+import networkx as nx
+
+from utils.parallelization import parrarelize_processes
+
+# Components with fewer nodes are bundled into one task, larger ones split by start nodes
+BUNDLE_NODES = 2_000
+TASKS_PER_WORKER = 4
+
+
+def canonical_cycle(cycle):
+    """Rotation of the cycle starting at its smallest node, the same for every rotation of it."""
+    start = cycle.index(min(cycle))
+    return tuple(cycle[start:] + cycle[:start])
+
+
+def distances_to(predecessors, target, max_length):
+    """Number of edges on the shortest path to target from nodes larger than it, up to max_length."""
+    distances = {target: 0}
+    queue = deque([target])
+    while queue:
+        node = queue.popleft()
+        if distances[node] >= max_length:
+            continue
+        for predecessor in predecessors.get(node, []):
+            if predecessor > target and predecessor not in distances:
+                distances[predecessor] = distances[node] + 1
+                queue.append(predecessor)
+    return distances
+
+
+def find_cycles_from(adjacency, starts, max_length):
+    """
+    Simple cycles of at most max_length nodes whose smallest node is one of starts.
+
+    Paths from a start only visit nodes larger than it, so every cycle is found exactly once,
+    from its smallest node and already in canonical rotation. Paths are extended only to nodes
+    from which the start can still be reached within the remaining length.
+    """
+    predecessors = {}
+    for node, successors in adjacency.items():
+        for successor in successors:
+            predecessors.setdefault(successor, []).append(node)
+
+    cycles = []
+    for start in starts:
+        distances = distances_to(predecessors, start, max_length)
+        path = [start]
+        on_path = {start}
+        stack = [iter(adjacency.get(start, []))]
+        while stack:
+            successor = next(stack[-1], None)
+            if successor is None:
+                stack.pop()
+                on_path.discard(path.pop())
+                continue
+            if successor == start:
+                cycles.append(list(path))
+            elif (
+                successor > start
+                and successor not in on_path
+                and len(path) + distances.get(successor, max_length) < max_length + 1
+            ):
+                path.append(successor)
+                on_path.add(successor)
+                stack.append(iter(adjacency.get(successor, [])))
+    return cycles
+
+
+def find_cycles_in_components(components, max_length):
+    """Cycles of every (adjacency, starts) part of a strongly connected component."""
+    return [cycle for adjacency, starts in components for cycle in find_cycles_from(adjacency, starts, max_length)]
+
+
+def create_cycle_tasks(graph, n_tasks):
+    """
+    Splits the cycle search into independent tasks. Every cycle lies within one strongly connected
+    component, so components without cycles are dropped and the rest are searched separately:
+    small components bundled together, and large ones split into groups of start nodes.
+    """
+    tasks = []
+    bundle = []
+    bundle_nodes = 0
+    for nodes in nx.strongly_connected_components(graph):
+        if len(nodes) == 1 and not any(graph.has_edge(node, node) for node in nodes):
+            continue
+        adjacency = {node: [s for s in graph.successors(node) if s in nodes] for node in nodes}
+        starts = sorted(nodes)
+        if len(nodes) > BUNDLE_NODES:
+            # Start nodes are interleaved, as small ones have more nodes to search through
+            tasks.extend([(adjacency, starts[i::n_tasks])] for i in range(min(n_tasks, len(starts))))
+            continue
+        bundle.append((adjacency, starts))
+        bundle_nodes += len(nodes)
+        if bundle_nodes >= BUNDLE_NODES:
+            tasks.append(bundle)
+            bundle, bundle_nodes = [], 0
+    if bundle:
+        tasks.append(bundle)
+    return tasks
+
+
+def find_bounded_cycles(edges, max_length, n_executors=12):
+    """
+    Yields simple cycles of at most max_length nodes of a directed graph given by edges,
+    in canonical rotation and without duplicates, as they are found by parallel workers.
+    """
+    graph = nx.DiGraph(edges)
+    tasks = create_cycle_tasks(graph, n_executors * TASKS_PER_WORKER)
+    print(f"Searching for cycles in {len(tasks)} parts of strongly connected components")
+    seen = set()
+    for _, cycles in parrarelize_processes(
+        find_cycles_in_components, [(task, max_length) for task in tasks], n_executors=n_executors
+    ):
+        for cycle in cycles:
+            key = canonical_cycle(cycle)
+            if key not in seen:
+                seen.add(key)
+                yield list(key)
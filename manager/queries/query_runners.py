@@ -1,27 +1,54 @@
-from shapely import wkt, prepare, convex_hull, MultiPoint, LineString
+import shapely
+from shapely import convex_hull, MultiPoint
+import csv
 import json
-import networkx as nx
-import math
+import os
+import numpy as np
 
+from utils.geometry import nearest_segment_angles
+from utils.geometry_store import ensure_geometry_store, get_geometry_store
 from utils.parallelization import parrarelize_processes
+from database.graph_metadata import (
+    get_edge_layout,
+    get_neighbour_pattern,
+    ensure_road_tree_histograms,
+    get_tree_count_buckets,
+)
+from queries.regions import (
+    resolve_region,
+    describe_region,
+    administrative_unit_clause,
+    bbox_overlap_condition,
+    create_region_index,
+    points_in_region,
+    geometries_in_region,
+)
 from database.communication import (
     execute_query,
     get_query_results_list,
 )
 
+# Distance up to which relationship 6 joins buildings with CLOSE_TO relationships
+BUILDING_CLOSE_TO_DISTANCE = 500
+
 
 def save_object_to_json(object, filepath):
-    with open(filepath, "w", encoding="utf-8") as f:
+    # Replaced at once, so that a result being read is never overwritten in place
+    with open(filepath + ".tmp", "w", encoding="utf-8") as f:
         json.dump(object, f, indent=4, ensure_ascii=False)
+    os.replace(filepath + ".tmp", filepath)
     print(f"Data saved to {filepath}")
 
 
-def run_query_1():
+def run_query_1(region=None):
     """
-    Number of cities within each commune
+    Number of cities within each commune; parameters: optional region
     """
-    print(f"Running query 1")
-    query = """
+    region = resolve_region(region)
+    print(f"Running query 1{describe_region(region)}")
+    create_region_index(region, "Commune", "center")
+    query = f"""
+        {administrative_unit_clause(region, "c", "Commune")}
         MATCH (c:Commune)
         MATCH (c2:City)-[:LOCATED_IN]->(c)
         RETURN c.id AS commune_id, c.name AS commune_name, COUNT(c2) AS number_of_cities
@@ -42,15 +69,18 @@ def run_query_1():
     save_object_to_json(data, output_filepath)
 
 
-def run_query_2():
+def run_query_2(region=None):
     """
-    Adjacent powiats
+    Adjacent powiats; parameters: optional region
     """
-    print(f"Running query 2")
-    query = """
+    region = resolve_region(region)
+    print(f"Running query 2{describe_region(region)}")
+    create_region_index(region, "Powiat", "center")
+    query = f"""
+        {administrative_unit_clause(region, "p1", "Powiat")}
         MATCH (p1:Powiat)
         MATCH (c1:Commune)-[:LOCATED_IN]->(p1)
-        MATCH (c1)-[:IS_ADJACENT]->(c2)
+        MATCH (c1){get_neighbour_pattern("IS_ADJACENT", "Commune")}(c2)
         MATCH (p2:Powiat)<-[:LOCATED_IN]-(c2)
         WHERE p1 <> p2
         RETURN p1.id as id, p1.name as name, collect(DISTINCT [p2.id, p2.name]) as neighbours
@@ -74,16 +104,19 @@ def run_query_2():
     save_object_to_json(data, output_filepath)
 
 
-def run_query_3():
+def run_query_3(region=None):
     """
-    Adjacent voivodships
+    Adjacent voivodships; parameters: optional region
     """
-    print(f"Running query 3")
-    query = """
+    region = resolve_region(region)
+    print(f"Running query 3{describe_region(region)}")
+    create_region_index(region, "Voivodship", "center")
+    query = f"""
+        {administrative_unit_clause(region, "v1", "Voivodship")}
         MATCH (v1:Voivodship)
         MATCH (p1:Powiat)-[:LOCATED_IN]->(v1)
         MATCH (c1:Commune)-[:LOCATED_IN]->(p1)
-        MATCH (c1)-[:IS_ADJACENT]->(c2)
+        MATCH (c1){get_neighbour_pattern("IS_ADJACENT", "Commune")}(c2)
         MATCH (c2)-[:LOCATED_IN]->(p2:Powiat)
         WHERE p1 <> p2
         MATCH (p2)-[:LOCATED_IN]->(v2:Voivodship)
@@ -110,56 +143,101 @@ def run_query_3():
     save_object_to_json(data, output_filepath)
 
 
-def run_query_4(max_distance, building_type, min_count):
+def clusters_in_region(index, clusters, region):
+    """Clusters with at least one member inside the region, all clusters without a region."""
+    if region is None:
+        return clusters
+    inside = points_in_region(region, index["xs"], index["ys"])
+    return [members for members in clusters if inside[members].any()]
+
+
+def get_components_clause(relationship_type, label):
     """
-    Clusters of buildings; parameters: max distance, building type, min count
+    Clause yielding connected components c of a projected subgraph of symmetric relationships.
+    With one edge per pair of nodes, components are weakly connected, otherwise strongly connected.
     """
-    max_distance = float(max_distance)
-    min_count = int(min_count)
-    print(
-        f"Running query 4 with parametrs {max_distance=}, {building_type=}, {min_count=}"
-    )
+    if get_edge_layout(relationship_type, label) == "undirected":
+        return """CALL weakly_connected_components.get(subgraph)
+        YIELD node, component_id
+        WITH component_id, COLLECT(node) AS c"""
+    return """CALL nxalg.strongly_connected_components(subgraph) 
+        YIELD components
+        UNWIND components as c
+        WITH c"""
+
+
+def has_building_close_to_relationships():
+    query = "MATCH (:Building)-[:CLOSE_TO]->(:Building) RETURN 1 LIMIT 1"
+    return len(get_query_results_list(query, lambda record: record.value())) > 0
+
+
+def get_close_to_building_clusters(max_distance, building_type, min_count, region):
+    """Clusters of buildings as connected components of CLOSE_TO relationships, created by relationship 6."""
     query = f"""
-        MATCH p=(:Building {{building:"{building_type}"}})-[e:CLOSE_TO]-(:Building {{building:"{building_type}"}})
+        MATCH p=(:Building {{building: $building_type}}){get_neighbour_pattern("CLOSE_TO", "Building", "e")}(:Building {{building: $building_type}})
         WHERE e.distance <= {max_distance}
         WITH project(p) AS subgraph
-        CALL nxalg.strongly_connected_components(subgraph) 
-        YIELD components
-        UNWIND components as c
-        WITH c
+        {get_components_clause("CLOSE_TO", "Building")}
         WHERE size(c) >= {min_count}
-        RETURN  EXTRACT(n in c | n.id) as ids
+        RETURN EXTRACT(n in c | n.id) AS ids, EXTRACT(n in c | n.center.x) AS xs, EXTRACT(n in c | n.center.y) AS ys
     """
+    clusters = get_query_results_list(query, lambda record: record.values(), {"building_type": building_type})
+    return [ids for ids, xs, ys in clusters if region is None or points_in_region(region, xs, ys).any()]
 
-    def clusters_of_buidlings_transformation_function(record):
-        return record["ids"]
+
+def run_query_4(max_distance, building_type, min_count, region=None):
+    """
+    Clusters of buildings; parameters: max distance, building type, min count, optional region
+    """
+    # Modules using scipy and networkx are imported only by the queries which need them
+    from queries.cluster_index import get_building_cluster_index, cut_cluster_index
+
+    max_distance = float(max_distance)
+    min_count = int(min_count)
+    region = resolve_region(region)
+    print(
+        f"Running query 4 with parametrs {max_distance=}, {building_type=}, {min_count=}{describe_region(region)}"
+    )
 
     output_filename = "query4.json"
     output_filepath = f"/data/{output_filename}"
 
     execute_query("CREATE INDEX ON :Building")
     execute_query("CREATE INDEX ON :Building(building)")
-    data = get_query_results_list(query, clusters_of_buidlings_transformation_function)
+    # Components of CLOSE_TO relationships answer the query when they are created, without building an index
+    if max_distance <= BUILDING_CLOSE_TO_DISTANCE and has_building_close_to_relationships():
+        data = get_close_to_building_clusters(max_distance, building_type, min_count, region)
+    else:
+        index = get_building_cluster_index(building_type, max_distance)
+        # Like connected components of CLOSE_TO edges, clusters have at least two buildings
+        clusters = cut_cluster_index(index, max_distance, max(min_count, 2))
+        clusters = clusters_in_region(index, clusters, region)
+        data = [index["ids"][members].tolist() for members in clusters]
     result = {
         "max_distance": max_distance,
         "building_type": building_type,
         "min_count": min_count,
         "clusters": data,
     }
+    if region is not None:
+        result["region"] = region["name"]
     save_object_to_json(result, output_filepath)
 
 
-def run_query_5(min_angle, max_angle):
+def run_query_5(min_angle, max_angle, region=None):
     """
-    Road/railway crossings; parameters: min angle, max angle
+    Road/railway crossings; parameters: min angle, max angle, optional region
     """
     min_angle = float(min_angle)
     max_angle = float(max_angle)
-    print(f"Running query 5 with parametrs {min_angle=}, {max_angle=}")
+    region = resolve_region(region)
+    print(f"Running query 5 with parametrs {min_angle=}, {max_angle=}{describe_region(region)}")
+    create_region_index(region, "Railway")
     query = f"""
     MATCH (railway:Railway)
+    WHERE {bbox_overlap_condition(region, "railway", "Railway")}
     MATCH (railway)-[e:CROSSES]->(road:Road)
-    WHERE e.angle <= {max_angle} AND e.angle >= {min_angle} 
+    WHERE e.angle <= {max_angle} AND e.angle >= {min_angle} AND {bbox_overlap_condition(region, "road", "Road")}
     RETURN railway.id as railway_id, road.id as road_id, e.angle as angle
     """
 
@@ -175,155 +253,105 @@ def run_query_5(min_angle, max_angle):
 
     execute_query("CREATE INDEX ON :Railway")
     data = get_query_results_list(query, road_railway_crossings_transformation_function)
+    if region is not None:
+        ensure_geometry_store("roads")
+        inside = geometries_in_region(region, "roads", [crossing["road_id"] for crossing in data])
+        data = [crossing for crossing, keep in zip(data, inside) if keep]
 
     save_object_to_json(data, output_filepath)
 
 
-def calculate_angle(segment1, segment2):
-    """Calculate the angle between two line segments."""
-
-    def vector_angle(v1, v2):
-        dot_product = v1[0] * v2[0] + v1[1] * v2[1]
-        magnitude1 = math.sqrt(v1[0] ** 2 + v1[1] ** 2)
-        magnitude2 = math.sqrt(v2[0] ** 2 + v2[1] ** 2)
-        if magnitude1 <= 1e-6 or magnitude2 <= 1e-6:
-            return None
-        cos_theta = dot_product / (magnitude1 * magnitude2)
-        cos_theta = max(-1, min(1, cos_theta))  # Clamp to avoid precision errors
-        return math.acos(cos_theta)
+def find_parallel_roads(max_distance, max_angle, railway_id, road_ids):
+    """
+    Checks every segment of the roads near the railway against its nearest railway segment.
 
-    v1 = (segment1[1][0] - segment1[0][0], segment1[1][1] - segment1[0][1])
-    v2 = (segment2[1][0] - segment2[0][0], segment2[1][1] - segment2[0][1])
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Ids of roads near the railway,
+        number of their segments and number of their segments parallel to the railway.
+    """
+    railway = get_geometry_store("railways").get_many([railway_id])
+    roads = get_geometry_store("roads").get_many(road_ids)
+    near = shapely.dwithin(railway[0], roads, max_distance)
+    road_ids, roads = np.asarray(road_ids)[near], roads[near]
 
-    angle = vector_angle(v1, v2)
-    if angle is None:
-        return None
-    return math.degrees(angle)
+    owners, angles = nearest_segment_angles(roads, railway, max_distance)
+    parallel = (angles <= max_angle) | (np.abs(angles - 180) <= max_angle)
+    segments = np.bincount(owners, minlength=len(roads))
+    parallel_segments = np.bincount(owners, weights=parallel, minlength=len(roads))
+    return road_ids, segments, parallel_segments
 
 
 def parallel_roads_railways_detection_strict(
-    max_distance, max_angle, railway_id, railway_wkt, road_ids, road_wkts
+    max_distance, max_angle, railway_id, road_ids
 ):
-    railway = wkt.loads(railway_wkt)
-    prepare(railway)
-    parallel_road_ids = []
-
-    railway_segments = list(zip(list(railway.coords[:-1]), list(railway.coords[1:])))
-    railway_segments = [LineString(rail_seg) for rail_seg in railway_segments]
-
-    for road_wkt, road_id in zip(road_wkts, road_ids):
-        road = wkt.loads(road_wkt)
-
-        if railway.distance(road) > max_distance:
-            continue
-
-        road_segments = list(zip(list(road.coords[:-1]), list(road.coords[1:])))
-        for road_seg in road_segments:
-            road_seg_line = LineString(road_seg)
-
-            closest_rail_seg = None
-            distance = math.inf
-            for rs in railway_segments:
-                d = rs.distance(road_seg_line)
-                if d <= max_distance and d < distance:
-                    closest_rail_seg = rs
-                    distance = d
-            if closest_rail_seg is None:
-                break
-
-            angle = calculate_angle(closest_rail_seg.coords, road_seg)
-            if angle is None or not (
-                angle <= max_angle or abs(angle - 180) <= max_angle
-            ):
-                break
-        else:
-            parallel_road_ids.append(road_id)
-
+    """Roads whose every segment runs parallel to the nearest railway segment."""
+    road_ids, segments, parallel_segments = find_parallel_roads(
+        max_distance, max_angle, railway_id, road_ids
+    )
+    parallel_road_ids = road_ids[parallel_segments == segments].tolist()
     return {"railway_id": railway_id, "parallel_road_ids": parallel_road_ids}
 
 
 def parallel_roads_railways_detection_lazy(
-    max_distance, max_angle, railway_id, railway_wkt, road_ids, road_wkts
+    max_distance, max_angle, railway_id, road_ids
 ):
-    railway = wkt.loads(railway_wkt)
-    prepare(railway)
-    parallel_road_ids = []
-
-    railway_segments = list(zip(list(railway.coords[:-1]), list(railway.coords[1:])))
-    railway_segments = [LineString(rail_seg) for rail_seg in railway_segments]
-
-    for road_wkt, road_id in zip(road_wkts, road_ids):
-        road = wkt.loads(road_wkt)
-
-        if railway.distance(road) > max_distance:
-            continue
-
-        road_segments = list(zip(list(road.coords[:-1]), list(road.coords[1:])))
-        for road_seg in road_segments:
-            road_seg_line = LineString(road_seg)
-
-            closest_rail_seg = None
-            distance = math.inf
-            for rs in railway_segments:
-                d = rs.distance(road_seg_line)
-                if d <= max_distance and d < distance:
-                    closest_rail_seg = rs
-                    distance = d
-
-            if closest_rail_seg is not None:
-                angle = calculate_angle(closest_rail_seg.coords, road_seg)
-                if angle is not None and (
-                    angle <= max_angle or abs(angle - 180) <= max_angle
-                ):
-                    parallel_road_ids.append(road_id)
-                    break
-
+    """Roads with at least one segment running parallel to the nearest railway segment."""
+    road_ids, _, parallel_segments = find_parallel_roads(
+        max_distance, max_angle, railway_id, road_ids
+    )
+    parallel_road_ids = road_ids[parallel_segments > 0].tolist()
     return {"railway_id": railway_id, "parallel_road_ids": parallel_road_ids}
 
 
-def run_query_6(max_distance, max_angle, mode):
+def run_query_6(max_distance, max_angle, mode, region=None):
     """
-    Roads which run parallel to railways; parameters: to be agreed
+    Roads which run parallel to railways; parameters: max distance, max angle, mode (strict or lazy), optional region
     """
     max_distance = float(max_distance)
     max_angle = float(max_angle)
     if mode not in ["strict", "lazy"]:
-        print("mode should be either 'strict' or 'lazy'")
-    print(f"Running query 6 with parametrs {max_distance=}, {max_angle=}, {mode=}")
+        raise ValueError("mode should be either 'strict' or 'lazy'")
+    region = resolve_region(region)
+    print(f"Running query 6 with parametrs {max_distance=}, {max_angle=}, {mode=}{describe_region(region)}")
+    create_region_index(region, "Railway")
+    railway_condition = bbox_overlap_condition(region, "ra", "Railway")
+    road_condition = bbox_overlap_condition(region, "r", "Road")
     if mode == "strict":
         query = f"""
         MATCH (ra:Railway)
+        WHERE {railway_condition}
         WITH point.distance(ra.upper_right_corner, ra.lower_left_corner) + ({max_distance} * 1.5)  as max_distance, ra, ra.upper_right_corner as p
         MATCH (r:Road)
         WHERE point.distance(r.upper_right_corner, p) <= max_distance AND
         ra.upper_right_corner.x + {max_distance} >= r.lower_left_corner.x AND 
         r.upper_right_corner.x + {max_distance} >= ra.lower_left_corner.x AND 
         ra.upper_right_corner.y + {max_distance} >= r.lower_left_corner.y AND 
-        r.upper_right_corner.y + {max_distance} >= ra.lower_left_corner.y
+        r.upper_right_corner.y + {max_distance} >= ra.lower_left_corner.y AND
+        {road_condition}
         WITH r, ra
         OPTIONAL MATCH (ra)-[e:CROSSES]->(r)
         WHERE e = NULL
-        RETURN ra.id as railway_id, ra.wkt as railway_wkt, COLLECT(r.id) as road_ids, COLLECT(r.wkt) as road_wkts
+        RETURN ra.id as railway_id, COLLECT(r.id) as road_ids
         """
     else:
         query = f"""
         MATCH (ra:Railway)
+        WHERE {railway_condition}
         WITH point.distance(ra.upper_right_corner, ra.lower_left_corner) + ({max_distance} * 1.5)  as max_distance, ra, ra.upper_right_corner as p
         MATCH (r:Road)
         WHERE point.distance(r.upper_right_corner, p) <= max_distance AND
         ra.upper_right_corner.x + {max_distance} >= r.lower_left_corner.x AND 
         r.upper_right_corner.x + {max_distance} >= ra.lower_left_corner.x AND 
         ra.upper_right_corner.y + {max_distance} >= r.lower_left_corner.y AND 
-        r.upper_right_corner.y + {max_distance} >= ra.lower_left_corner.y
-        RETURN ra.id as railway_id, ra.wkt as railway_wkt, COLLECT(r.id) as road_ids, COLLECT(r.wkt) as road_wkts
+        r.upper_right_corner.y + {max_distance} >= ra.lower_left_corner.y AND
+        {road_condition}
+        RETURN ra.id as railway_id, COLLECT(r.id) as road_ids
         """
 
     def parallel_roads_railways_transformation_function(record):
         return [
             record["railway_id"],
-            record["railway_wkt"],
             record["road_ids"],
-            record["road_wkts"],
         ]
 
     output_filename = "query6.json"
@@ -331,9 +359,20 @@ def run_query_6(max_distance, max_angle, mode):
 
     execute_query("CREATE POINT INDEX ON :Road(upper_right_corner)")
     execute_query("CREATE INDEX ON :Railway")
+    ensure_geometry_store("railways")
+    ensure_geometry_store("roads")
     data = get_query_results_list(
         query, parallel_roads_railways_transformation_function
     )
+    if region is not None:
+        data = [
+            [railway_id, np.asarray(road_ids)[geometries_in_region(region, "roads", road_ids)].tolist()]
+            for (railway_id, road_ids), keep in zip(
+                data, geometries_in_region(region, "railways", [railway_id for railway_id, _ in data])
+            )
+            if keep
+        ]
+        data = [row for row in data if row[1]]
     print(f"Recieved {len(data)} railways")
 
     if mode == "strict":
@@ -349,82 +388,135 @@ def run_query_6(max_distance, max_angle, mode):
     save_object_to_json(result, output_filepath)
 
 
-def run_query_7(max_distance, min_count):
+def run_query_7(max_distance, min_count, region=None):
     """
-    Clusters of trees; parameters: max distance, min count; returned as concave hulls
+    Clusters of trees; parameters: max distance, min count, optional region; returned as concave hulls
     """
+    from queries.cluster_index import get_tree_cluster_index, cut_cluster_index
+
     max_distance = float(max_distance)
     min_count = int(min_count)
-    print(f"Running query 7 with parametrs {max_distance=}, {min_count=}")
-    query = f"""
-        MATCH p=(:Tree)-[e:CLOSE_TO]->(:Tree)
-        WHERE e.distance <= {max_distance} 
-        WITH project(p) AS subgraph
-        CALL nxalg.strongly_connected_components(subgraph) 
-        YIELD components
-        UNWIND components as c
-        WITH c
-        WHERE size(c) >= {min_count}
-        RETURN EXTRACT(tree in c | [tree.geometry.x, tree.geometry.y]) as trees_x_y
-    """
-
-    def tree_clusters_transformation_function(record):
-        ch = convex_hull(MultiPoint([(x, y) for x, y in record["trees_x_y"]]))
-        return ch.wkt
+    region = resolve_region(region)
+    print(f"Running query 7 with parametrs {max_distance=}, {min_count=}{describe_region(region)}")
 
     output_filename = "query7.json"
     output_filepath = f"/data/{output_filename}"
 
     execute_query("CREATE INDEX ON :Tree")
-    data = get_query_results_list(query, tree_clusters_transformation_function)
+    index = get_tree_cluster_index()
+    clusters = cut_cluster_index(index, max_distance, max(min_count, 2))
+    clusters = clusters_in_region(index, clusters, region)
+    data = [
+        convex_hull(MultiPoint(np.column_stack([index["xs"][members], index["ys"][members]]))).wkt
+        for members in clusters
+    ]
     result = {"max_distance": max_distance, "min_count": min_count, "clusters": data}
+    if region is not None:
+        result["region"] = region["name"]
     save_object_to_json(result, output_filepath)
 
 
-def run_query_8(start_road_id, end_road_id):
+def get_road_endpoints(road_ids):
+    """Start node id and name of every road in road_ids, found with one query."""
+    # Ids are passed as a parameter, so the query text stays short and its plan is cached for any number of roads
+    query = """
+        MATCH (road:Road)
+        WHERE road.id IN $ids
+        RETURN road.id AS id, road.start_node_id AS start_node_id, road.name AS name
     """
-    Shortest path between two indicated roads; parameters: start and end road ids
+    execute_query("CREATE INDEX ON :Road(id)")
+    parameters = {"ids": [int(road_id) for road_id in set(road_ids)]}
+    return {
+        id: (start_node_id, name)
+        for id, start_node_id, name in get_query_results_list(query, lambda record: record.values(), parameters)
+    }
+
+
+def find_shortest_road_paths(road_pairs, region=None):
     """
-    start_road_id = int(start_road_id)
-    end_road_id = int(end_road_id)
-    print(f"Running query 8 with parametrs {start_road_id=}, {end_road_id=}")
-    query = f"""
-        MATCH (startRoad:Road{{id: {start_road_id}}}), (endRoad:Road{{id: {end_road_id}}})
-        WITH startRoad, endRoad
-        MATCH (startRoad)<-[:BELONGS_TO]-(startRoadNode:RoadNode{{id: startRoad.start_node_id}})
-        MATCH (endRoad)<-[:BELONGS_TO]-(endRoadNode:RoadNode{{id: endRoad.start_node_id}})
-        CALL algo.astar(startRoadNode, endRoadNode, {{relationships_filter:["CONNECTED_TO>"]}})
-        YIELD path, weight
-        RETURN EXTRACT(node in nodes(path) | node.id) as node_ids, weight as distance, startRoad.name as start_name, endRoad.name as end_name; 
+    Shortest paths between start nodes of pairs of roads, in the format of query 8,
+    through road nodes inside the region, if it is given.
     """
-
-    def shortest_path_transformation_function(record):
-        return {
-            "start": record["start_name"],
-            "destination": record["end_name"],
-            "distance_meters": record["distance"],
-            "path": record["node_ids"],
+    from queries.road_graph import route_many
+
+    roads = get_road_endpoints([road_id for pair in road_pairs for road_id in pair])
+    known_pairs = [pair for pair in road_pairs if pair[0] in roads and pair[1] in roads]
+    routes = route_many([(roads[start][0], roads[end][0]) for start, end in known_pairs], region=region)
+    return [
+        {
+            "start": roads[start][1],
+            "destination": roads[end][1],
+            "distance_meters": distance,
+            "path": path,
         }
+        for (start, end), (distance, path) in zip(known_pairs, routes)
+        if distance is not None
+    ]
 
+
+def get_road_pairs_path(filename):
+    """Path of a csv file with road pairs, which has to be given by the name of a file directly in /data."""
+    filename = str(filename)
+    if os.path.basename(filename) != filename or filename.startswith(".") or not filename.lower().endswith(".csv"):
+        raise ValueError(f"Road pairs have to be given as the name of a csv file in /data, got {filename}")
+    return os.path.join("/data", filename)
+
+
+def run_query_8(start_road_id, end_road_id=None, region=None):
+    """
+    Shortest path between two indicated roads; parameters: start and end road ids,
+    or the name of a csv file in /data with start_road_id and end_road_id columns for many pairs,
+    optional region which paths can not leave
+    """
     output_filename = "query8.json"
     output_filepath = f"/data/{output_filename}"
+    region = resolve_region(region)
+
+    if end_road_id is None:
+        print(f"Running query 8 for road pairs in {start_road_id}{describe_region(region)}")
+        with open(get_road_pairs_path(start_road_id), "r", newline="") as f:
+            road_pairs = [
+                (int(row["start_road_id"]), int(row["end_road_id"])) for row in csv.DictReader(f)
+            ]
+        result = find_shortest_road_paths(road_pairs, region)
+        print(f"Found paths for {len(result)} of {len(road_pairs)} road pairs")
+        save_object_to_json(result, output_filepath)
+        return
 
-    execute_query("CREATE INDEX ON :Road(id)")
-    data = get_query_results_list(query, shortest_path_transformation_function)
-    result = data[0]
+    start_road_id = int(start_road_id)
+    end_road_id = int(end_road_id)
+    print(f"Running query 8 with parametrs {start_road_id=}, {end_road_id=}{describe_region(region)}")
+    data = find_shortest_road_paths([(start_road_id, end_road_id)], region)
+    if data:
+        result = data[0]
+    else:
+        # Unknown roads and roads without a connecting path, e.g. one cut off by the region, give no path
+        result = {
+            "start_road_id": start_road_id,
+            "end_road_id": end_road_id,
+            "error": f"No path between roads {start_road_id} and {end_road_id}{describe_region(region)}, "
+            "the roads are unknown or not connected",
+        }
+        print(result["error"])
     save_object_to_json(result, output_filepath)
-    pass
 
 
-def run_query_9(max_length):
+def run_query_9(max_length, region=None):
     """
-    Quasi-roundabouts: find cycles consisting of one-way streets connected end-to-end; parameters: max length
+    Quasi-roundabouts: find cycles consisting of one-way streets connected end-to-end; parameters: max length, optional region
     """
+    from queries.cycles import find_bounded_cycles
+
     max_length = int(max_length)
-    print(f"Running query 9 with parametrs {max_length=}")
-    query = """
-    MATCH p=(r1:Road {oneway:"yes"})-[e:ROAD_CONNECTED_TO {part: "end"}]->(r2:Road {oneway:"yes"})
+    region = resolve_region(region)
+    print(f"Running query 9 with parametrs {max_length=}{describe_region(region)}")
+    create_region_index(region, "Road")
+    region_clause = f"MATCH (r1:Road) WHERE {bbox_overlap_condition(region, 'r1', 'Road')}" if region else ""
+    query = f"""
+    {region_clause}
+    MATCH p=(r1:Road {{oneway:"yes"}})-[e:ROAD_CONNECTED_TO {{part: "end"}}]->(r2:Road {{oneway:"yes"}})
     WHERE r1.start_node_id != r1.end_node_id AND r2.start_node_id != r2.end_node_id AND r1.end_node_id != r2.end_node_id
+        AND {bbox_overlap_condition(region, "r2", "Road")}
     RETURN r1.id as id1, r2.id as id2
     """
 
@@ -436,23 +528,46 @@ def run_query_9(max_length):
 
     execute_query("CREATE INDEX ON :Road(oneway)")
     data = get_query_results_list(query, roundabouts_transformation_function)
+    if region is not None:
+        # Cycles are searched only among roads intersecting the region
+        ensure_geometry_store("roads")
+        road_ids = np.unique(np.array(data, dtype=np.int64).reshape(-1))
+        inside = set(road_ids[geometries_in_region(region, "roads", road_ids)].tolist())
+        data = [(id1, id2) for id1, id2 in data if id1 in inside and id2 in inside]
 
     print(f"Data obtained {len(data)} roads, calculating rounabouts")
-    G = nx.DiGraph(data)
-    cycles = list(nx.simple_cycles(G, length_bound=max_length))
-    result = {"max_length": max_length, "quasi_roundabouts": cycles}
-    save_object_to_json(result, output_filepath)
-
-
-def run_query_10(max_distance, min_count):
+    # Cycles are written as they are found, so that partial results are kept in query9.json.tmp if the search is stopped
+    found = 0
+    with open(output_filepath + ".tmp", "w", encoding="utf-8") as f:
+        f.write(f'{{\n    "max_length": {max_length},\n    "quasi_roundabouts": [')
+        for cycle in find_bounded_cycles(data, max_length):
+            f.write(("," if found else "") + "\n        " + json.dumps(cycle))
+            found += 1
+            if found % 1000 == 0:
+                f.flush()
+                print(f"Found {found} quasi-roundabouts")
+        f.write("\n    ]\n}\n")
+    os.replace(output_filepath + ".tmp", output_filepath)
+    print(f"Found {found} quasi-roundabouts")
+    print(f"Data saved to {output_filepath}")
+
+
+def run_query_10(max_distance, min_count, region=None):
     """
-    Roads with trees near them; parameters: min count, max distance
+    Roads with trees near them; parameters: max distance, min count, optional region
     """
-    min_count = int(max_distance)
+    max_distance = float(max_distance)
     min_count = int(min_count)
-    print(f"Running query 10 with parametrs {max_distance=}, {min_count=}")
+    region = resolve_region(region)
+    print(f"Running query 10 with parametrs {max_distance=}, {min_count=}{describe_region(region)}")
+    create_region_index(region, "Road")
+    # Materialized tree counts bound the number of trees within max_distance from above,
+    # so edges are only expanded for roads which may have enough trees
     query = f"""
         MATCH (road:Road)
+        WHERE {bbox_overlap_condition(region, "road", "Road")}
+            AND road.tree_counts IS NOT NULL
+            AND reduce(total = 0, c IN road.tree_counts[0..{get_tree_count_buckets(max_distance)}] | total + c) >= {min_count}
         MATCH p=(tree:Tree)-[e:CLOSE_TO]->(road)
         WHERE e.distance <= {max_distance}
         WITH COLLECT(tree.id) as trees, road
@@ -471,19 +586,10 @@ def run_query_10(max_distance, min_count):
     output_filepath = f"/data/{output_filename}"
 
     execute_query("CREATE INDEX ON :Road")
+    ensure_road_tree_histograms()
     data = get_query_results_list(query, road_trees_transformation_function)
+    if region is not None:
+        ensure_geometry_store("roads")
+        inside = geometries_in_region(region, "roads", [road["road_id"] for road in data])
+        data = [road for road, keep in zip(data, inside) if keep]
     save_object_to_json(data, output_filepath)
-
-
-QUERY_RUNNERS = {
-    "1": run_query_1,
-    "2": run_query_2,
-    "3": run_query_3,
-    "4": run_query_4,
-    "5": run_query_5,
-    "6": run_query_6,
-    "7": run_query_7,
-    "8": run_query_8,
-    "9": run_query_9,
-    "10": run_query_10,
-}
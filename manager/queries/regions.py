@@ -0,0 +1,213 @@
+"""
+Regions limiting queries to a part of the country.
+
+A region is given as '<level>:<name or id>' with level commune, powiat or voivodship,
+as a plain name or id of one of them, or as an EPSG:2180 bounding box 'bbox:minx,miny,maxx,maxy'.
+Spaces in names can be written as underscores, e.g. 'powiat:powiat_krakowski'.
+
+Queries push the bounding box of the region into Cypher, through point indexes or corner
+properties, and administrative units through the LOCATED_IN hierarchy, before expanding
+relationships. Results are then limited exactly to the region geometry.
+"""
+import numpy as np
+import shapely
+
+from utils.geometry_store import ensure_geometry_store, get_geometry_store
+from database.communication import execute_query, get_query_results_list
+from queries.result_cache import get_graph_version
+
+REGION_LEVELS = {
+    "commune": ("Commune", "communes"),
+    "powiat": ("Powiat", "powiats"),
+    "voivodship": ("Voivodship", "voivodships"),
+}
+# Administrative units in the order of the LOCATED_IN hierarchy
+ADMINISTRATIVE_LABELS = ["Commune", "Powiat", "Voivodship", "Country"]
+
+REGIONS = {}
+REGION_GEOMETRIES = {}
+LABEL_EXTENTS = {}
+
+
+def parse_bbox(text):
+    values = text.split(",")
+    if len(values) != 4:
+        return None
+    try:
+        minx, miny, maxx, maxy = (float(value) for value in values)
+    except ValueError:
+        return None
+    if minx > maxx or miny > maxy:
+        raise ValueError(f"Bounding box {text} has minimum coordinates larger than maximum ones")
+    return minx, miny, maxx, maxy
+
+
+def find_administrative_units(label, identifier):
+    # The identifier comes from the query service, so it is passed to the database as a parameter
+    parameters = {"names": list({identifier.lower(), identifier.replace("_", " ").lower()})}
+    condition = "toLower(n.name) IN $names"
+    if identifier.lstrip("-").isdigit():
+        parameters["id"] = int(identifier)
+        condition = f"n.id = $id OR {condition}"
+    query = f"""
+    MATCH (n:{label})
+    WHERE {condition}
+    RETURN n.id, n.name, n.lower_left_corner.x, n.lower_left_corner.y, n.upper_right_corner.x, n.upper_right_corner.y
+    """
+    return get_query_results_list(query, lambda record: record.values(), parameters)
+
+
+def resolve_region(region):
+    """
+    Region described by an argument of a query, None if the argument is empty.
+    Regions are dicts with a bounding box 'bbox', and for administrative units
+    their 'label', 'id', 'name' and geometry store 'store'.
+    """
+    if region is None or str(region).strip() == "":
+        return None
+    region = str(region).strip()
+    key = (region, get_graph_version())
+    if key in REGIONS:
+        return REGIONS[key]
+
+    level, _, identifier = region.partition(":")
+    bbox = parse_bbox(identifier if level == "bbox" else region)
+    if level == "bbox" and bbox is None:
+        raise ValueError(f"Bounding box has to be given as bbox:minx,miny,maxx,maxy, got {region}")
+    if bbox is not None:
+        resolved = {"label": None, "id": None, "name": region, "store": None, "bbox": bbox}
+        REGIONS[key] = resolved
+        return resolved
+
+    levels = [level] if identifier else list(REGION_LEVELS)
+    identifier = identifier or region
+    if any(level not in REGION_LEVELS for level in levels):
+        raise ValueError(f"Unknown region level '{level}', available: {', '.join(REGION_LEVELS)}, bbox")
+    matches = [
+        (label, store, row)
+        for label, store in (REGION_LEVELS[level] for level in levels)
+        for row in find_administrative_units(label, identifier)
+    ]
+    if not matches:
+        raise ValueError(f"No region matches '{region}'")
+    if len(matches) > 1:
+        options = ", ".join(f"{label.lower()}:{row[0]} ({row[1]})" for label, _, row in matches[:20])
+        raise ValueError(f"Region '{region}' is ambiguous, use one of: {options}")
+
+    label, store, (id, name, minx, miny, maxx, maxy) = matches[0]
+    resolved = {"label": label, "id": id, "name": name, "store": store, "bbox": (minx, miny, maxx, maxy)}
+    REGIONS[key] = resolved
+    print(f"Query limited to {label.lower()} {name} ({id})")
+    return resolved
+
+
+def get_region_geometry(region):
+    """Prepared geometry of the region: its bounding box, or the area enclosed by the border of the unit."""
+    key = (region["label"], region["id"], region["bbox"])
+    geometry = REGION_GEOMETRIES.get(key)
+    if geometry is None:
+        if region["label"] is None:
+            geometry = shapely.box(*region["bbox"])
+        else:
+            ensure_geometry_store(region["store"])
+            border = get_geometry_store(region["store"]).get(region["id"])
+            geometry = shapely.union_all([shapely.Polygon(part.coords) for part in shapely.get_parts(border)])
+        shapely.prepare(geometry)
+        REGION_GEOMETRIES[key] = geometry
+    return geometry
+
+
+def points_in_region(region, xs, ys):
+    """Mask of points inside the region, tested against its geometry only within its bounding box."""
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    minx, miny, maxx, maxy = region["bbox"]
+    inside = (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy)
+    inside[inside] = shapely.contains_xy(get_region_geometry(region), xs[inside], ys[inside])
+    return inside
+
+
+def geometries_in_region(region, store_name, ids):
+    """Mask of ids whose geometries in the geometry store intersect the region."""
+    if len(ids) == 0:
+        return np.zeros(0, dtype=bool)
+    return shapely.intersects(get_region_geometry(region), get_geometry_store(store_name).get_many(ids))
+
+
+def bbox_points(region, margin=0.0):
+    minx, miny, maxx, maxy = region["bbox"]
+    return (
+        f"point({{x: {minx - margin}, y: {miny - margin}}})",
+        f"point({{x: {maxx + margin}, y: {maxy + margin}}})",
+    )
+
+
+def point_in_region_condition(region, point_expression, margin=0.0):
+    """Cypher condition of a point property inside the bounding box of the region, served by a point index."""
+    if region is None:
+        return "TRUE"
+    lower, upper = bbox_points(region, margin)
+    return f"point.withinbbox({point_expression}, {lower}, {upper})"
+
+
+def get_label_extent(label):
+    """Largest width and height of bounding boxes of nodes with a label."""
+    key = (label, get_graph_version())
+    if key not in LABEL_EXTENTS:
+        query = f"""
+        MATCH (n:{label})
+        RETURN max(n.upper_right_corner.x - n.lower_left_corner.x), max(n.upper_right_corner.y - n.lower_left_corner.y)
+        """
+        width, height = get_query_results_list(query, lambda record: record.values())[0]
+        LABEL_EXTENTS[key] = (width or 0.0, height or 0.0)
+    return LABEL_EXTENTS[key]
+
+
+def bbox_overlap_condition(region, variable, label, margin=0.0):
+    """
+    Cypher condition of the bounding box of a node overlapping the bounding box of the region.
+    Lower left corners of overlapping nodes lie in the region box extended down by the largest node extent,
+    so the condition can be served by a point index on lower_left_corner.
+    """
+    if region is None:
+        return "TRUE"
+    width, height = get_label_extent(label)
+    minx, miny, maxx, maxy = region["bbox"]
+    lower = f"point({{x: {minx - margin - width}, y: {miny - margin - height}}})"
+    upper = f"point({{x: {maxx + margin}, y: {maxy + margin}}})"
+    return (
+        f"point.withinbbox({variable}.lower_left_corner, {lower}, {upper}) "
+        f"AND {variable}.upper_right_corner.x >= {minx - margin} AND {variable}.upper_right_corner.y >= {miny - margin}"
+    )
+
+
+def administrative_unit_clause(region, variable, label):
+    """
+    MATCH clause binding variable to administrative units with a label which are in the region,
+    or contain it, for units above the level of the region. Put before the clauses matching the variable.
+    Units are found through the LOCATED_IN hierarchy, and for bounding box regions by their centers.
+    """
+    if region is None:
+        return ""
+    if region["label"] is None:
+        return f"MATCH ({variable}:{label}) WHERE {point_in_region_condition(region, f'{variable}.center')}"
+    hops = ADMINISTRATIVE_LABELS.index(region["label"]) - ADMINISTRATIVE_LABELS.index(label)
+    if hops == 0:
+        return f"MATCH ({variable}:{label} {{id: {region['id']}}})"
+    if hops > 0:
+        return f"MATCH (:{region['label']} {{id: {region['id']}}})<-[:LOCATED_IN*{hops}..{hops}]-({variable}:{label})"
+    return f"MATCH (:{region['label']} {{id: {region['id']}}})-[:LOCATED_IN*{-hops}..{-hops}]->({variable}:{label})"
+
+
+def create_region_index(region, label, property="lower_left_corner"):
+    """Point index serving the bounding box condition of a region, needed only when a region is given."""
+    if region is not None:
+        execute_query(f"CREATE POINT INDEX ON :{label}({property})")
+
+
+def describe_region(region):
+    return "" if region is None else f", region={region['name']}"
+
+
+def get_region_key(region):
+    """Hashable description of a region for caches of worker processes."""
+    return None if region is None else (region["label"], region["id"], region["bbox"], region["store"])
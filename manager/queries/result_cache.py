@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from settings import QUERY_CACHE_MAX_MB, get_query_cache_enabled
+
+QUERY_CACHE_DIRECTORY = "/data/query_cache"
+GRAPH_VERSION_FILE = "/data/graph_version.json"
+
+CACHE_LOCK = threading.Lock()
+CACHE_STATISTICS = {"hits": 0, "misses": 0, "evictions": 0}
+# Runs of one query are serialized, as they write the same output file
+QUERY_LOCKS = defaultdict(threading.RLock)
+
+
+def get_graph_version():
+    if not os.path.exists(GRAPH_VERSION_FILE):
+        return 0
+    with open(GRAPH_VERSION_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)["version"]
+
+
+def bump_graph_version():
+    with CACHE_LOCK:
+        version = get_graph_version() + 1
+        with open(GRAPH_VERSION_FILE + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"version": version}, f)
+        os.replace(GRAPH_VERSION_FILE + ".tmp", GRAPH_VERSION_FILE)
+    return version
+
+
+@contextmanager
+def graph_change():
+    """
+    Marks a block which changes the graph. The version is bumped before it,
+    so that results cached earlier are not used during the change, and after it,
+    so that results computed while the graph was changing are not used afterwards.
+    """
+    bump_graph_version()
+    try:
+        yield
+    finally:
+        bump_graph_version()
+
+
+def normalize_parameter(value):
+    """Numbers given as text or as numbers, e.g. '10', 10 and 10.0, are the same parameter."""
+    text = str(value).strip()
+    try:
+        number = float(text)
+    except ValueError:
+        return text
+    return int(number) if number.is_integer() else number
+
+
+def get_input_file_versions(args):
+    """Modification times of input files in /data named by parameters, e.g. road pairs of query 8."""
+    paths = [os.path.join("/data", str(arg)) for arg in args]
+    return [os.path.getmtime(path) for path in paths if os.path.isfile(path)]
+
+
+def get_cache_key(query_no, args, kwargs=None):
+    kwargs = kwargs or {}
+    key = json.dumps(
+        [
+            str(query_no),
+            [normalize_parameter(arg) for arg in args],
+            sorted((name, normalize_parameter(value)) for name, value in kwargs.items() if value is not None),
+            get_input_file_versions([*args, *kwargs.values()]),
+            get_graph_version(),
+        ]
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def get_query_output_path(query_no):
+    return f"/data/query{query_no}.json"
+
+
+def evict_cache_entries():
+    """Removes least recently used results until the cache fits QUERY_CACHE_MAX_MB."""
+    entries = [entry for entry in os.scandir(QUERY_CACHE_DIRECTORY) if entry.name.endswith(".json")]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= QUERY_CACHE_MAX_MB * 2**20:
+            break
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+        CACHE_STATISTICS["evictions"] += 1
+
+
+def get_query_lock(query_no):
+    with CACHE_LOCK:
+        return QUERY_LOCKS[str(query_no)]
+
+
+def copy_file(source, destination):
+    """Replaces destination with a copy of source, so that readers of destination never see a partial file."""
+    shutil.copyfile(source, destination + ".tmp")
+    os.replace(destination + ".tmp", destination)
+
+
+def run_cached_query(query_no, runner, *args, **kwargs):
+    """
+    Runs a query runner, unless its result for the same parameters and graph version is cached,
+    in which case the cached result is copied to the output file of the query.
+    Returns whether the result was taken from the cache.
+    """
+    with get_query_lock(query_no):
+        if not get_query_cache_enabled():
+            runner(*args, **kwargs)
+            return False
+
+        key = get_cache_key(query_no, args, kwargs)
+        cached_path = os.path.join(QUERY_CACHE_DIRECTORY, f"{key}.json")
+        output_path = get_query_output_path(query_no)
+        with CACHE_LOCK:
+            if os.path.exists(cached_path):
+                # Modification time marks the last use for eviction
+                os.utime(cached_path)
+                copy_file(cached_path, output_path)
+                CACHE_STATISTICS["hits"] += 1
+                print(f"Query {query_no} result for parameters {[*args, *(f'{k}={v}' for k, v in kwargs.items())]} taken from cache")
+                print(f"Data saved to {output_path}")
+                return True
+            CACHE_STATISTICS["misses"] += 1
+
+        start_time = time.time()
+        runner(*args, **kwargs)
+        # Results are not cached if the graph changed while the query was running
+        if (
+            key == get_cache_key(query_no, args, kwargs)
+            and os.path.exists(output_path)
+            and os.path.getmtime(output_path) >= start_time - 1
+        ):
+            os.makedirs(QUERY_CACHE_DIRECTORY, exist_ok=True)
+            with CACHE_LOCK:
+                copy_file(output_path, cached_path)
+                evict_cache_entries()
+        return False
+
+
+def clear_query_cache():
+    with CACHE_LOCK:
+        if os.path.exists(QUERY_CACHE_DIRECTORY):
+            shutil.rmtree(QUERY_CACHE_DIRECTORY)
+    print("Query cache cleared")
+
+
+def print_cache_statistics():
+    entries = (
+        [entry for entry in os.scandir(QUERY_CACHE_DIRECTORY) if entry.name.endswith(".json")]
+        if os.path.exists(QUERY_CACHE_DIRECTORY)
+        else []
+    )
+    size = sum(entry.stat().st_size for entry in entries)
+    requests = CACHE_STATISTICS["hits"] + CACHE_STATISTICS["misses"]
+    hit_rate = CACHE_STATISTICS["hits"] / requests if requests else 0.0
+    print(
+        f"Query cache: {CACHE_STATISTICS['hits']} hits, {CACHE_STATISTICS['misses']} misses ({hit_rate:.0%} hit rate), "
+        f"{CACHE_STATISTICS['evictions']} evictions, {len(entries)} results using {size / 2**20:.1f} of {QUERY_CACHE_MAX_MB} MB, "
+        f"graph version {get_graph_version()}"
+    )
@@ -0,0 +1,233 @@
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from utils.parallelization import parrarelize_processes
+from database.communication import get_query_results_list
+from queries.regions import points_in_region, get_region_key
+
+ROAD_GRAPH_DIRECTORY = "/data/road_graph"
+ROAD_GRAPH_ARRAYS = ["ids", "xs", "ys", "indptr", "indices", "weights"]
+# Sparse graph routines skip edges of zero weight, so nodes with equal coordinates are joined by tiny ones
+MIN_EDGE_WEIGHT = 1e-6
+# Initial search radius as a multiple of the longest straight line distance to a destination
+SEARCH_LIMIT_FACTOR = 1.5
+SEARCH_LIMIT_GROWTH = 4
+MAX_LIMITED_SEARCHES = 4
+
+
+def get_road_graph_path(name):
+    return os.path.join(ROAD_GRAPH_DIRECTORY, f"{name}.npy")
+
+
+def get_road_graph_counts():
+    nodes = get_query_results_list("MATCH (n:RoadNode) RETURN COUNT(n)", lambda record: record.value())[0]
+    edges = get_query_results_list(
+        "MATCH (:RoadNode)-[e:CONNECTED_TO]->(:RoadNode) RETURN COUNT(e)", lambda record: record.value()
+    )[0]
+    return {"nodes": nodes, "edges": edges}
+
+
+def build_road_graph(counts=None):
+    """
+    Exports RoadNode and CONNECTED_TO into a compressed sparse row graph saved as numpy arrays:
+    node ids sorted ascending with their coordinates, and for node i its outgoing edges
+    indices[indptr[i]:indptr[i + 1]] with lengths weights[indptr[i]:indptr[i + 1]].
+    """
+    counts = counts or get_road_graph_counts()
+    print(f"Building road graph with {counts['nodes']} nodes and {counts['edges']} edges")
+    rows = get_query_results_list(
+        "MATCH (n:RoadNode) RETURN n.id, n.geometry.x, n.geometry.y", lambda record: record.values()
+    )
+    ids, xs, ys = (np.array(values) for values in zip(*rows)) if rows else (np.empty(0),) * 3
+    order = np.argsort(ids, kind="stable")
+    ids, xs, ys = ids[order].astype(np.int64), xs[order].astype(float), ys[order].astype(float)
+    del rows
+
+    rows = get_query_results_list(
+        "MATCH (a:RoadNode)-[e:CONNECTED_TO]->(b:RoadNode) RETURN a.id, b.id, e.distance",
+        lambda record: record.values(),
+    )
+    sources, targets, weights = (np.array(values) for values in zip(*rows)) if rows else (np.empty(0),) * 3
+    del rows
+    sources = np.searchsorted(ids, sources.astype(np.int64))
+    targets = np.searchsorted(ids, targets.astype(np.int64))
+    order = np.argsort(sources, kind="stable")
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(ids)), out=indptr[1:])
+
+    arrays = {
+        "ids": ids,
+        "xs": xs,
+        "ys": ys,
+        "indptr": indptr,
+        "indices": targets[order].astype(np.int32),
+        "weights": np.maximum(weights[order].astype(float), MIN_EDGE_WEIGHT),
+    }
+    os.makedirs(ROAD_GRAPH_DIRECTORY, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(get_road_graph_path(name) + ".tmp.npy", array)
+        os.replace(get_road_graph_path(name) + ".tmp.npy", get_road_graph_path(name))
+    # Written last, so that an interrupted build is detected as outdated
+    with open(get_road_graph_path("counts") + ".json", "w", encoding="utf-8") as f:
+        json.dump(counts, f)
+    ROAD_GRAPHS.clear()
+    print(f"Road graph saved in {ROAD_GRAPH_DIRECTORY}")
+
+
+def ensure_road_graph():
+    """Builds the road graph if it is missing or the number of road nodes or connections has changed."""
+    counts = get_road_graph_counts()
+    counts_path = get_road_graph_path("counts") + ".json"
+    if os.path.exists(counts_path):
+        with open(counts_path, "r", encoding="utf-8") as f:
+            if json.load(f) == counts:
+                return
+    build_road_graph(counts)
+
+
+class RoadGraph:
+    """
+    Read-only road graph loaded from memory mapped arrays,
+    so worker processes share the pages of the saved graph.
+    """
+
+    def __init__(self, ids, xs, ys, matrix, version):
+        self.ids, self.xs, self.ys = ids, xs, ys
+        self.matrix = matrix
+        self.version = version
+        self.regions = {}
+
+    @classmethod
+    def load(cls):
+        version = os.stat(get_road_graph_path("counts") + ".json").st_mtime_ns
+        arrays = {name: np.load(get_road_graph_path(name), mmap_mode="r") for name in ROAD_GRAPH_ARRAYS}
+        n = len(arrays["ids"])
+        matrix = csr_matrix((arrays["weights"], arrays["indices"], arrays["indptr"]), shape=(n, n))
+        return cls(arrays["ids"], arrays["xs"], arrays["ys"], matrix, version)
+
+    def within_region(self, region):
+        """Subgraph of road nodes inside the region, kept for further routes in the same region."""
+        key = get_region_key(region)
+        if key not in self.regions:
+            inside = np.flatnonzero(points_in_region(region, self.xs, self.ys))
+            self.regions[key] = RoadGraph(
+                self.ids[inside], self.xs[inside], self.ys[inside], self.matrix[inside][:, inside], self.version
+            )
+        return self.regions[key]
+
+    def positions(self, ids):
+        """Positions of node ids in the graph, -1 for ids which are not road nodes."""
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, ids), max(len(self.ids) - 1, 0))
+        found = len(self.ids) > 0 and self.ids[positions] == ids
+        return np.where(found, positions, -1)
+
+    def straight_distances(self, origin, targets):
+        return np.hypot(self.xs[targets] - self.xs[origin], self.ys[targets] - self.ys[origin])
+
+    def search(self, origin, targets, with_paths=True):
+        """
+        Shortest distances from the origin to targets, and predecessors for paths if requested.
+
+        Edge lengths are at least the straight line distances between their nodes, so a search
+        limited to a radius is exact for all targets within it. The search starts with a radius
+        slightly longer than the furthest straight line distance, like an A* bound, and grows it
+        only when some target has not been reached.
+        """
+        limit = SEARCH_LIMIT_FACTOR * self.straight_distances(origin, targets).max(initial=0.0) + 1.0
+        for attempt in range(MAX_LIMITED_SEARCHES + 1):
+            if attempt == MAX_LIMITED_SEARCHES:
+                limit = np.inf
+            result = dijkstra(
+                self.matrix, indices=origin, limit=limit, return_predecessors=with_paths
+            )
+            distances = result[0] if with_paths else result
+            if np.isfinite(distances[targets]).all():
+                break
+            limit *= SEARCH_LIMIT_GROWTH
+        return result if with_paths else (distances, None)
+
+    def path(self, predecessors, target):
+        path = []
+        while target >= 0:
+            path.append(int(self.ids[target]))
+            target = predecessors[target]
+        return path[::-1]
+
+
+ROAD_GRAPHS = {}
+
+
+def get_road_graph():
+    """Road graph of this process, reloaded when it was rebuilt."""
+    graph = ROAD_GRAPHS.get("roads")
+    if graph is None or graph.version != os.stat(get_road_graph_path("counts") + ".json").st_mtime_ns:
+        graph = ROAD_GRAPHS["roads"] = RoadGraph.load()
+    return graph
+
+
+def route_from_origin(origin_id, target_ids, with_paths=True, region=None):
+    """
+    Routes from one road node to many, as (distance, path) with None for unreachable targets,
+    through road nodes inside the region only, if it is given.
+    """
+    graph = get_road_graph()
+    if region is not None:
+        graph = graph.within_region(region)
+    origin = graph.positions([origin_id])[0]
+    targets = graph.positions(target_ids)
+    if origin < 0:
+        return [(None, None)] * len(target_ids)
+
+    known = targets >= 0
+    distances, predecessors = graph.search(origin, targets[known], with_paths)
+    routes = []
+    for target in targets:
+        if target < 0 or not np.isfinite(distances[target]):
+            routes.append((None, None))
+        else:
+            path = graph.path(predecessors, target) if with_paths else None
+            routes.append((float(distances[target]), path))
+    return routes
+
+
+def route_many(pairs, with_paths=True, n_executors=12, region=None):
+    """
+    Shortest routes for many (start node id, end node id) pairs, in the order of pairs,
+    as (distance in meters, list of node ids on the path) or (None, None) if there is no route.
+    Routes are limited to road nodes inside the region, if it is given.
+
+    Pairs are grouped by their start node, so every start node is searched once,
+    and the groups are processed in parallel on the shared worker pool.
+    """
+    ensure_road_graph()
+    groups = defaultdict(list)
+    for i, (start, end) in enumerate(pairs):
+        groups[int(start)].append((i, int(end)))
+    origins = list(groups.items())
+
+    routes = [(None, None)] * len(pairs)
+    args_list = [(origin, [end for _, end in items], with_paths, region) for origin, items in origins]
+    for done, (id, origin_routes) in enumerate(
+        parrarelize_processes(route_from_origin, args_list, n_executors=n_executors), start=1
+    ):
+        for (i, _), route in zip(origins[id][1], origin_routes):
+            routes[i] = route
+        if done % 100 == 0:
+            print(f"Routes from {done} of {len(origins)} start nodes found")
+    return routes
+
+
+def distance_matrix(origin_ids, destination_ids, n_executors=12, region=None):
+    """Matrix of shortest road distances from origin to destination nodes, inf where there is no route."""
+    pairs = [(origin, destination) for origin in origin_ids for destination in destination_ids]
+    distances = [
+        np.inf if distance is None else distance
+        for distance, _ in route_many(pairs, with_paths=False, n_executors=n_executors, region=region)
+    ]
+    return np.array(distances, dtype=float).reshape(len(origin_ids), len(destination_ids))
@@ -0,0 +1,235 @@
+import itertools
+import os
+import re
+
+import numpy as np
+import shapely
+from shapely import convex_hull, MultiPoint
+
+from utils.geometry import nearest_segment_angles
+from utils.geometry_store import ensure_geometry_store, get_geometry_store
+from utils.parallelization import parrarelize_processes
+from database.communication import execute_query, get_query_results_list
+from database.graph_metadata import ensure_road_tree_histograms, get_tree_count_buckets
+from queries.cluster_index import get_building_cluster_index, get_tree_cluster_index, cut_cluster_index
+from queries.result_cache import run_cached_query, get_query_output_path, get_query_lock, copy_file
+from queries.query_runners import save_object_to_json
+from plugins import QUERY_RUNNERS, PRESET_QUERY_ARGUMENTS
+
+
+def parse_sweep_arguments(query_no, arguments):
+    """
+    Values of every parameter of a query from arguments like 'max_distance=50,100,200'.
+    Parameters which are not given take their preset value, optional ones without a preset are left out.
+    """
+    metadata = QUERY_RUNNERS.get_metadata(query_no)
+    names = metadata["parameters"] + metadata["optional_parameters"]
+    values = dict(zip(names, ([value] for value in PRESET_QUERY_ARGUMENTS.get(query_no, []))))
+    for argument in arguments:
+        name, _, listed = argument.partition("=")
+        if name not in names or not listed:
+            raise ValueError(f"Sweep arguments have to be <parameter>=<value1>,<value2>,..., query {query_no} takes {names}")
+        values[name] = listed.split(",")
+    missing = [name for name in metadata["parameters"] if name not in values]
+    if missing:
+        raise ValueError(f"Missing values of parameters {missing}")
+    return {name: values[name] for name in names if name in values}
+
+
+def get_combinations(values):
+    return [dict(zip(values, combination)) for combination in itertools.product(*values.values())]
+
+
+def get_sweep_output_path(query_no, combination):
+    name = "_".join(f"{key}={value}" for key, value in combination.items())
+    return f"/data/query{query_no}_sweep/{re.sub(r'[^0-9A-Za-z_=.-]+', '_', name)}.json"
+
+
+def sweep_query_4(combinations):
+    """Clusters of buildings cut from one cluster index per building type, built for the longest distance."""
+    execute_query("CREATE INDEX ON :Building")
+    execute_query("CREATE INDEX ON :Building(building)")
+    results = []
+    indexes = {}
+    for combination in combinations:
+        building_type = combination["building_type"]
+        max_distance = float(combination["max_distance"])
+        min_count = int(combination["min_count"])
+        if building_type not in indexes:
+            longest = max(float(c["max_distance"]) for c in combinations if c["building_type"] == building_type)
+            indexes[building_type] = get_building_cluster_index(building_type, longest)
+        index = indexes[building_type]
+        clusters = cut_cluster_index(index, max_distance, max(min_count, 2))
+        results.append(
+            {
+                "max_distance": max_distance,
+                "building_type": building_type,
+                "min_count": min_count,
+                "clusters": [index["ids"][members].tolist() for members in clusters],
+            }
+        )
+    return results
+
+
+def find_parallel_roads_for_combinations(railway_id, railway_corners, roads, combinations):
+    """
+    Parallel roads of one railway for every (max_distance, max_angle, mode) combination,
+    from distances and angles computed once for candidates of the longest distance.
+
+    The nearest railway segment of a road segment does not depend on the distance limit,
+    so a segment paired within the longest distance is paired within a shorter one
+    exactly when the distance between them is not longer.
+    """
+    longest = max(max_distance for max_distance, _, _ in combinations)
+    ra_minx, ra_miny, ra_maxx, ra_maxy = railway_corners
+    road_ids, minxs, minys, maxxs, maxys = (np.array(values) for values in zip(*roads))
+    railway = get_geometry_store("railways").get_many([railway_id])
+    road_geoms = get_geometry_store("roads").get_many(road_ids)
+    road_distances = shapely.distance(railway[0], road_geoms)
+    owners, angles, segment_distances = nearest_segment_angles(road_geoms, railway, longest, return_distances=True)
+    railway_size = np.hypot(ra_maxx - ra_minx, ra_maxy - ra_miny)
+    corner_distances = np.hypot(maxxs - ra_maxx, maxys - ra_maxy)
+
+    results = []
+    for max_distance, max_angle, mode in combinations:
+        # Candidate condition of the query 6 database query, followed by the exact distance check
+        candidates = (
+            (corner_distances <= railway_size + max_distance * 1.5)
+            & (ra_maxx + max_distance >= minxs)
+            & (maxxs + max_distance >= ra_minx)
+            & (ra_maxy + max_distance >= minys)
+            & (maxys + max_distance >= ra_miny)
+            & (road_distances <= max_distance)
+        )
+        paired = segment_distances <= max_distance
+        parallel = paired & ((angles <= max_angle) | (np.abs(angles - 180) <= max_angle))
+        segments = np.bincount(owners, minlength=len(road_ids))
+        parallel_segments = np.bincount(owners, weights=parallel, minlength=len(road_ids))
+        if mode == "strict":
+            selected = candidates & (parallel_segments == segments)
+        else:
+            selected = candidates & (parallel_segments > 0)
+        results.append({"railway_id": railway_id, "parallel_road_ids": road_ids[selected].tolist()})
+    return results
+
+
+def sweep_query_6(combinations):
+    """Parallel roads for all combinations from one fetch of candidates within the longest distance."""
+    parameters = [
+        (float(c["max_distance"]), float(c["max_angle"]), c["mode"]) for c in combinations
+    ]
+    longest = max(max_distance for max_distance, _, _ in parameters)
+    query = f"""
+    MATCH (ra:Railway)
+    WITH point.distance(ra.upper_right_corner, ra.lower_left_corner) + ({longest} * 1.5)  as max_distance, ra, ra.upper_right_corner as p
+    MATCH (r:Road)
+    WHERE point.distance(r.upper_right_corner, p) <= max_distance AND
+    ra.upper_right_corner.x + {longest} >= r.lower_left_corner.x AND
+    r.upper_right_corner.x + {longest} >= ra.lower_left_corner.x AND
+    ra.upper_right_corner.y + {longest} >= r.lower_left_corner.y AND
+    r.upper_right_corner.y + {longest} >= ra.lower_left_corner.y
+    RETURN ra.id as railway_id,
+        [ra.lower_left_corner.x, ra.lower_left_corner.y, ra.upper_right_corner.x, ra.upper_right_corner.y] as railway_corners,
+        COLLECT([r.id, r.lower_left_corner.x, r.lower_left_corner.y, r.upper_right_corner.x, r.upper_right_corner.y]) as roads
+    """
+    execute_query("CREATE POINT INDEX ON :Road(upper_right_corner)")
+    execute_query("CREATE INDEX ON :Railway")
+    ensure_geometry_store("railways")
+    ensure_geometry_store("roads")
+    data = get_query_results_list(query, lambda record: record.values())
+    print(f"Recieved {len(data)} railways for {len(parameters)} parameter combinations")
+
+    results = [[] for _ in parameters]
+    jobs = [(*args, parameters) for args in data]
+    for _, railway_results in parrarelize_processes(find_parallel_roads_for_combinations, jobs, n_executors=12):
+        for result, railway_result in zip(results, railway_results):
+            result.append(railway_result)
+    return results
+
+
+def sweep_query_7(combinations):
+    """Clusters of trees for all combinations cut from one cluster index."""
+    execute_query("CREATE INDEX ON :Tree")
+    index = get_tree_cluster_index()
+    results = []
+    for combination in combinations:
+        max_distance = float(combination["max_distance"])
+        min_count = int(combination["min_count"])
+        clusters = cut_cluster_index(index, max_distance, max(min_count, 2))
+        data = [
+            convex_hull(MultiPoint(np.column_stack([index["xs"][members], index["ys"][members]]))).wkt
+            for members in clusters
+        ]
+        results.append({"max_distance": max_distance, "min_count": min_count, "clusters": data})
+    return results
+
+
+def sweep_query_10(combinations):
+    """Roads with trees near them for all combinations from one fetch at the loosest thresholds."""
+    parameters = [(float(c["max_distance"]), int(c["min_count"])) for c in combinations]
+    longest = max(max_distance for max_distance, _ in parameters)
+    fewest = min(min_count for _, min_count in parameters)
+    query = f"""
+        MATCH (road:Road)
+        WHERE road.tree_counts IS NOT NULL
+            AND reduce(total = 0, c IN road.tree_counts[0..{get_tree_count_buckets(longest)}] | total + c) >= {fewest}
+        MATCH (tree:Tree)-[e:CLOSE_TO]->(road)
+        WHERE e.distance <= {longest}
+        WITH COLLECT([tree.id, e.distance]) as trees, road
+        WHERE size(trees) >= {fewest}
+        RETURN road.id as road_id, road.name as road_name, trees
+    """
+    execute_query("CREATE INDEX ON :Road")
+    ensure_road_tree_histograms()
+    roads = get_query_results_list(query, lambda record: record.values())
+
+    results = []
+    for max_distance, min_count in parameters:
+        result = []
+        for road_id, road_name, trees in roads:
+            tree_ids = [tree_id for tree_id, distance in trees if distance <= max_distance]
+            if len(tree_ids) >= min_count:
+                result.append({"road_name": road_name, "road_id": road_id, "trees": tree_ids})
+        results.append(result)
+    return results
+
+
+SWEEP_RUNNERS = {
+    "4": sweep_query_4,
+    "6": sweep_query_6,
+    "7": sweep_query_7,
+    "10": sweep_query_10,
+}
+
+
+def run_sweep(query_no, arguments):
+    """
+    Runs a query for every combination of parameter values and saves one result file per combination
+    in /data/query<no>_sweep, with an index.json listing the files.
+
+    Queries with a sweep runner fetch their data once for the loosest parameters and evaluate
+    all combinations from it, other queries, and queries limited to regions, are run once per combination.
+    """
+    values = parse_sweep_arguments(query_no, arguments)
+    combinations = get_combinations(values)
+    print(f"Running query {query_no} for {len(combinations)} parameter combinations")
+    output_directory = f"/data/query{query_no}_sweep"
+    os.makedirs(output_directory, exist_ok=True)
+
+    index = []
+    if query_no in SWEEP_RUNNERS and "region" not in values:
+        for combination, result in zip(combinations, SWEEP_RUNNERS[query_no](combinations)):
+            output_filepath = get_sweep_output_path(query_no, combination)
+            save_object_to_json(result, output_filepath)
+            index.append({"parameters": combination, "file": os.path.basename(output_filepath)})
+    else:
+        for combination in combinations:
+            output_filepath = get_sweep_output_path(query_no, combination)
+            arguments = [value for name, value in combination.items() if name != "region"]
+            region = {"region": combination["region"]} if "region" in combination else {}
+            # The output file is copied before another run of the query, e.g. from the query service, replaces it
+            with get_query_lock(query_no):
+                run_cached_query(query_no, QUERY_RUNNERS[query_no], *arguments, **region)
+                copy_file(get_query_output_path(query_no), output_filepath)
+            index.append({"parameters": combination, "file": os.path.basename(output_filepath)})
+    save_object_to_json(index, os.path.join(output_directory, "index.json"))
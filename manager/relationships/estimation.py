@@ -0,0 +1,299 @@
+import json
+import math
+import time
+
+import numpy as np
+import shapely
+
+from settings import DATABASE_MEMORY_LIMIT_MB, get_symmetric_edge_layout
+from utils.geometry import segment_crossings
+from utils.geometry_store import ensure_geometry_store, get_geometry_store
+from utils.parallelization import parrarelize_processes
+from database.communication import execute_query, get_query_results_list
+
+# Measured for relationship 7: 32 million CLOSE_TO edges with a distance property took 4 GB
+EDGE_BYTES = 125
+# Memgraph creates around 1 million relationships per second from an optimized import
+EDGE_LOAD_RATE = 1_000_000
+STRATUM_SIZE = 20_000
+Z_95 = 1.96
+
+
+def get_max_building_radius():
+    query = "MATCH (t:Building) RETURN MAX(t.radius)"
+    return {"max_radius": get_query_results_list(query, lambda record: record.value())[0]}
+
+
+def count_building_neighbours(ids, distance=500, max_radius=0):
+    query = f"""
+    UNWIND {list(ids)} AS sample_id
+    MATCH (t1:Building {{id: sample_id}})
+    WITH t1, t1.center as p, ({distance} + {max_radius} + t1.radius) as max_distance
+    MATCH (t2:Building)
+    WHERE t1 <> t2 AND point.distance(t2.center, p) <= max_distance
+    RETURN t1.id, COLLECT(t2.id)
+    """
+    store = get_geometry_store("buildings")
+    counts = {id: 0 for id in ids}
+    for building_id, candidate_ids in get_query_results_list(query, lambda record: record.values()):
+        if candidate_ids:
+            distances = shapely.distance(store.get(building_id), store.get_many(candidate_ids))
+            counts[building_id] = int((distances <= distance).sum())
+    return [counts[id] for id in ids]
+
+
+def count_tree_neighbours(ids, distance=50):
+    query = f"""
+    UNWIND {list(ids)} AS sample_id
+    MATCH (t1:Tree {{id: sample_id}})
+    WITH t1, t1.geometry as p
+    MATCH (t2:Tree)
+    WHERE t1 <> t2 AND point.distance(t2.geometry, p) <= {distance}
+    RETURN t1.id, COUNT(t2)
+    """
+    counts = {id: 0 for id in ids}
+    counts.update(get_query_results_list(query, lambda record: record.values()))
+    return [counts[id] for id in ids]
+
+
+def count_road_trees(ids, distance=20):
+    query = f"""
+    UNWIND {list(ids)} AS sample_id
+    MATCH (road:Road {{id: sample_id}})
+    WITH road, point({{x: road.lower_left_corner.x - {distance}, y: road.lower_left_corner.y - {distance}}}) as llc, point({{x: road.upper_right_corner.x + {distance}, y: road.upper_right_corner.y + {distance}}}) as urc
+    MATCH (tree:Tree)
+    WHERE point.withinbbox(tree.geometry, llc, urc)
+    RETURN road.id, COLLECT(tree.geometry.x), COLLECT(tree.geometry.y)
+    """
+    store = get_geometry_store("roads")
+    counts = {id: 0 for id in ids}
+    for road_id, tree_xs, tree_ys in get_query_results_list(query, lambda record: record.values()):
+        trees = shapely.points(np.array(tree_xs, dtype=float), np.array(tree_ys, dtype=float))
+        counts[road_id] = int(shapely.dwithin(store.get(road_id), trees, distance).sum())
+    return [counts[id] for id in ids]
+
+
+def count_connected_roads(ids, distance=None):
+    query = f"""
+    UNWIND {list(ids)} AS sample_id
+    MATCH (road:Road {{id: sample_id}})<-[:BELONGS_TO]-(:RoadNode)-[:BELONGS_TO]->(other:Road)
+    WHERE road <> other
+    RETURN road.id, COUNT(other)
+    """
+    counts = {id: 0 for id in ids}
+    counts.update(get_query_results_list(query, lambda record: record.values()))
+    return [counts[id] for id in ids]
+
+
+def count_railway_crossings(ids, distance=None):
+    query = f"""
+    UNWIND {list(ids)} AS sample_id
+    MATCH (ra:Railway {{id: sample_id}})
+    WITH point.distance(ra.upper_right_corner, ra.lower_left_corner) as max_distance, ra, ra.upper_right_corner as p
+    MATCH (r:Road)
+    WHERE point.distance(r.upper_right_corner, p) <= max_distance AND
+        ra.upper_right_corner.x >= r.lower_left_corner.x AND
+        r.upper_right_corner.x >= ra.lower_left_corner.x AND
+        ra.upper_right_corner.y >= r.lower_left_corner.y AND
+        r.upper_right_corner.y >= ra.lower_left_corner.y
+    RETURN ra.id, COLLECT(r.id)
+    """
+    counts = {id: 0 for id in ids}
+    for railway_id, road_ids in get_query_results_list(query, lambda record: record.values()):
+        if road_ids:
+            railway_idx, _, _ = segment_crossings(
+                get_geometry_store("railways").get_many([railway_id]),
+                get_geometry_store("roads").get_many(road_ids),
+            )
+            counts[railway_id] = len(railway_idx)
+    return [counts[id] for id in ids]
+
+
+# label: node label the sample is drawn from, every sampled node is the start of its edges
+# position: point property used for spatial stratification
+# count_function: number of edges created for every node id in a batch
+# indexes: indexes needed by count_function
+# geometry_stores: geometry stores used by count_function
+# extra_arguments: optional function returning additional keyword arguments of count_function
+# symmetric: count_function counts neighbours of symmetric relationships, one edge per pair in undirected layout
+RELATIONSHIP_ESTIMATORS = {
+    "6": {
+        "label": "Building",
+        "position": "center",
+        "count_function": count_building_neighbours,
+        "distance": 500,
+        "indexes": ["INDEX ON :Building(id)", "POINT INDEX ON :Building(center)"],
+        "geometry_stores": ["buildings"],
+        "extra_arguments": get_max_building_radius,
+        "symmetric": True,
+    },
+    "7": {
+        "label": "Tree",
+        "position": "geometry",
+        "count_function": count_tree_neighbours,
+        "distance": 50,
+        "indexes": ["INDEX ON :Tree(id)", "POINT INDEX ON :Tree(geometry)"],
+        "geometry_stores": [],
+        "symmetric": True,
+    },
+    "8": {
+        "label": "Road",
+        "position": "lower_left_corner",
+        "count_function": count_road_trees,
+        "distance": 20,
+        "indexes": ["INDEX ON :Road(id)", "POINT INDEX ON :Tree(geometry)"],
+        "geometry_stores": ["roads"],
+    },
+    "9": {
+        "label": "Road",
+        "position": "lower_left_corner",
+        "count_function": count_connected_roads,
+        "distance": None,
+        "indexes": ["INDEX ON :Road(id)"],
+        "geometry_stores": [],
+    },
+    "10": {
+        "label": "Railway",
+        "position": "lower_left_corner",
+        "count_function": count_railway_crossings,
+        "distance": None,
+        "indexes": ["INDEX ON :Railway(id)", "POINT INDEX ON :Road(upper_right_corner)"],
+        "geometry_stores": ["railways", "roads"],
+    },
+}
+
+
+def run_count_function(count_function, ids, kwargs):
+    return count_function(ids, **kwargs)
+
+
+def get_strata(label, position):
+    """Number of nodes in every square cell of STRATUM_SIZE meters."""
+    query = f"""
+    MATCH (n:{label})
+    RETURN toInteger(floor(n.{position}.x / {STRATUM_SIZE})) AS cx, toInteger(floor(n.{position}.y / {STRATUM_SIZE})) AS cy, COUNT(n) AS count
+    """
+    return {
+        (cx, cy): count
+        for cx, cy, count in get_query_results_list(query, lambda record: record.values())
+    }
+
+
+def draw_sample(label, position, probability):
+    query = f"""
+    MATCH (n:{label})
+    WHERE rand() < {probability}
+    RETURN n.id, toInteger(floor(n.{position}.x / {STRATUM_SIZE})), toInteger(floor(n.{position}.y / {STRATUM_SIZE}))
+    """
+    return get_query_results_list(query, lambda record: record.values())
+
+
+def estimate_stratified_total(strata, sample_strata, values):
+    """
+    Post-stratified estimate of the total of values over all nodes and its standard error.
+    Strata without sampled nodes use the mean and variance of the whole sample.
+    """
+    values = np.asarray(values, dtype=float)
+    overall_mean = values.mean()
+    overall_variance = values.var(ddof=1) if len(values) > 1 else 0.0
+
+    by_stratum = {}
+    for stratum, value in zip(sample_strata, values):
+        by_stratum.setdefault(stratum, []).append(value)
+
+    total = 0.0
+    variance = 0.0
+    for stratum, count in strata.items():
+        stratum_values = np.array(by_stratum.get(stratum, []))
+        n = len(stratum_values)
+        mean = stratum_values.mean() if n > 0 else overall_mean
+        stratum_variance = stratum_values.var(ddof=1) if n > 1 else overall_variance
+        total += count * mean
+        variance += count**2 * (1 - min(n, count) / count) * stratum_variance / max(n, 1)
+    return total, math.sqrt(variance)
+
+
+def estimate_relationship(relationship_no, sample_size=1000, distance=None):
+    """
+    Estimates the number of edges, database memory and runtime of a relationship
+    from a spatially stratified sample of its start nodes.
+    """
+    if relationship_no not in RELATIONSHIP_ESTIMATORS:
+        print(
+            f"Estimation is not available for relationship '{relationship_no}'. Available options: {', '.join(RELATIONSHIP_ESTIMATORS.keys())}."
+        )
+        return
+    estimator = RELATIONSHIP_ESTIMATORS[relationship_no]
+    label, position = estimator["label"], estimator["position"]
+    sample_size = int(sample_size)
+    distance = float(distance) if distance is not None else estimator["distance"]
+    print(f"Estimating relationship {relationship_no} with parametrs {sample_size=}, {distance=}")
+
+    for index in estimator["indexes"]:
+        execute_query(f"CREATE {index}")
+    for store_name in estimator["geometry_stores"]:
+        ensure_geometry_store(store_name)
+
+    strata = get_strata(label, position)
+    node_count = sum(strata.values())
+    if node_count == 0:
+        print(f"There are no {label} nodes")
+        return
+    sample = draw_sample(label, position, min(1.0, sample_size / node_count))
+    if len(sample) == 0:
+        print("Sample is empty, increase the sample size")
+        return
+    sample_ids = [id for id, _, _ in sample]
+    sample_strata = [(cx, cy) for _, cx, cy in sample]
+
+    count_function = estimator["count_function"]
+    count_kwargs = {"distance": distance}
+    if "extra_arguments" in estimator:
+        count_kwargs.update(estimator["extra_arguments"]())
+    batches = [sample_ids[i : i + 100] for i in range(0, len(sample_ids), 100)]
+
+    start_time = time.time()
+    counts = [None] * len(batches)
+    for i, batch_counts in parrarelize_processes(
+        run_count_function, [(count_function, batch, count_kwargs) for batch in batches], n_executors=10
+    ):
+        counts[i] = batch_counts
+    duration = time.time() - start_time
+    counts = [count for batch_counts in counts for count in batch_counts]
+
+    for index in estimator["indexes"]:
+        execute_query(f"DROP {index}")
+
+    edges, standard_error = estimate_stratified_total(strata, sample_strata, counts)
+    if estimator.get("symmetric") and get_symmetric_edge_layout() == "undirected":
+        edges, standard_error = edges / 2, standard_error / 2
+    lower, upper = max(0.0, edges - Z_95 * standard_error), edges + Z_95 * standard_error
+    result = {
+        "relationship": relationship_no,
+        "distance": distance,
+        "nodes": node_count,
+        "sampled_nodes": len(sample_ids),
+        "strata": len(strata),
+        "edges": edges,
+        "edges_95_lower": lower,
+        "edges_95_upper": upper,
+        "memory_mb": edges * EDGE_BYTES / 1e6,
+        "memory_mb_95_upper": upper * EDGE_BYTES / 1e6,
+        "computation_seconds": duration / len(sample_ids) * node_count,
+        "loading_seconds": edges / EDGE_LOAD_RATE,
+        "loading_seconds_95_upper": upper / EDGE_LOAD_RATE,
+    }
+
+    print(f"\nEstimate for relationship {relationship_no} from {len(sample_ids)} of {node_count} {label} nodes in {len(strata)} strata:")
+    print(f"Edges: {edges:,.0f} (95% CI {lower:,.0f} - {upper:,.0f})")
+    print(f"Database memory: {result['memory_mb']:,.0f} MB (up to {result['memory_mb_95_upper']:,.0f} MB)")
+    print(f"Client side computation: {result['computation_seconds']:.2f} seconds.")
+    print(f"Edge loading: {result['loading_seconds']:.2f} seconds (up to {result['loading_seconds_95_upper']:.2f} seconds).")
+    if result["memory_mb_95_upper"] > DATABASE_MEMORY_LIMIT_MB:
+        print(f"Warning: the relationship may not fit into the database memory limit of {DATABASE_MEMORY_LIMIT_MB} MB")
+
+    output_filepath = f"/data/estimate_{relationship_no}.json"
+    with open(output_filepath, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=4)
+    print(f"Data saved to {output_filepath}")
+    return result
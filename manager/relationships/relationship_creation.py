@@ -2,7 +2,7 @@ import geopandas as gpd
 import numpy as np
 import pandas as pd
 import gc
-from shapely import wkt, prepare
+from shapely import prepare
 from shapely.geometry import Point, Polygon, LineString, MultiLineString
 
 from pathlib import Path
@@ -10,13 +10,22 @@ import os
 import shutil
 import csv
 from typing import Union
-
-from settings import get_clear_preprocessed_value
-from utils.parallelization import execute_with_pool
+from functools import partial
+
+from settings import get_clear_preprocessed_value, get_edge_output_mode, get_symmetric_edge_layout
+from importing.importing_data import preprocess_and_save_road_components
+from importing.data_specific.roads import create_road_road_connection_query
+from utils.parallelization import execute_with_pool, parrarelize_processes
+from utils.geometry import points_within_distance, segment_crossings
+from utils.geometry_store import ensure_geometry_store, get_geometry_store
+from utils.file_management import finish_csv_files
+from database.graph_metadata import set_edge_layout, build_road_tree_histograms
 from database.communication import (
     execute_query,
+    get_query_results_list,
     execute_query_to_csv,
     execute_query_to_csv_parallelized,
+    save_edges,
 )
 
 def clear_preprocessed_check(output_directory):
@@ -26,6 +35,52 @@ def clear_preprocessed_check(output_directory):
             os.rmdir(output_directory)
     
 
+def create_edges(output_directory, compute_edges, csv_query_function, unwind_query, id_indexes, create_in_database=None):
+    """
+    Creates edges computed by compute_edges(output_directory, edge_query).
+
+    In 'csv' edge output mode edges are saved to csv chunks in output_directory and loaded afterwards.
+    In 'stream' mode workers send edges to the database with unwind_query while they are computed,
+    and in 'stream_csv' mode they are also saved as csv chunks. Cached chunks are always loaded from csv.
+    In 'database' mode create_in_database creates edges with the spatial query module of the database.
+    """
+    mode = get_edge_output_mode()
+    if mode == "database":
+        if create_in_database is not None:
+            create_in_database()
+            execute_query("FREE MEMORY")
+            return
+        print("Relationship can not be created in the database, using csv edge output mode")
+        mode = "csv"
+
+    clear_preprocessed_check(output_directory)
+
+    for index in id_indexes:
+        execute_query(f"CREATE INDEX ON {index}")
+
+    streamed = False
+    if not os.path.exists(output_directory):
+        if mode != "stream":
+            os.makedirs(output_directory, exist_ok=True)
+        compute_edges(
+            output_directory if mode != "stream" else None,
+            unwind_query if mode != "csv" else None,
+        )
+        streamed = mode != "csv"
+
+    if not streamed:
+        create_edges_queries = [
+            csv_query_function(os.path.join(output_directory, file.name))
+            for file in Path(output_directory).glob("*.csv")
+        ]
+        if create_edges_queries:
+            execute_with_pool(execute_query, create_edges_queries, max_processes=10)
+
+    for index in id_indexes:
+        execute_query(f"DROP INDEX ON {index}")
+    execute_query("FREE MEMORY")
+
+
 def is_within(point: Point, line: Union[MultiLineString, LineString]) -> bool:
     if isinstance(line, MultiLineString):
         for subline in line.geoms:
@@ -37,10 +92,34 @@ def is_within(point: Point, line: Union[MultiLineString, LineString]) -> bool:
     return False
 
 
-def is_point_within_border(data):
-    point_id, x, y, border_id, border_wkt = data
+def create_located_in_relationships_in_database(label, border_label, store_name):
+    """
+    Creates LOCATED_IN relationships between nodes and borders containing their centers
+    with the spatial query module of the database.
+    """
+    execute_query(f"CREATE POINT INDEX ON :{label}(center)")
+    execute_query(f"CREATE INDEX ON :{border_label}")
+    ensure_geometry_store(store_name)
+    execute_query(
+        f"""
+        MATCH (border:{border_label})
+        WITH border.lower_left_corner as llc, border.upper_right_corner as urc, border
+        MATCH (n:{label})
+        WHERE point.withinbbox(n.center, llc, urc)
+        WITH border, COLLECT(n) AS candidates
+        CALL spatial.within_border("{store_name}", border.id, [c IN candidates | c.center.x], [c IN candidates | c.center.y]) YIELD index
+        WITH border, candidates[index] AS n
+        CREATE (n)-[:LOCATED_IN]->(border)
+        """
+    )
+    execute_query(f"DROP POINT INDEX ON :{label}(center)")
+    execute_query(f"DROP INDEX ON :{border_label}")
+
+
+def is_point_within_border(data, store_name):
+    point_id, x, y, border_id = data
     point = Point(float(x), float(y))
-    line = wkt.loads(border_wkt)
+    line = get_geometry_store(store_name).get(border_id)
     if is_within(point, line):
         return [point_id, border_id]
     return None
@@ -55,47 +134,40 @@ def create_relationship_1():
     WITH  commune.lower_left_corner as llc, commune.upper_right_corner as urc, commune
     MATCH (city:City) 
     WHERE point.withinbbox(city.center, llc, urc)
-    RETURN city.id AS city_id, city.center.x AS city_x, city.center.y AS city_y, commune.id AS commune_id, commune.wkt AS commune_wkt
+    RETURN city.id AS city_id, city.center.x AS city_x, city.center.y AS city_y, commune.id AS commune_id
     """
     headers = ["city_id", "commune_id"]
-    output_directory = "/data/city_commune_data"
-    clear_preprocessed_check(output_directory)
-    
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory, exist_ok=True)
+
+    def compute_edges(output_directory, edge_query):
         execute_query("CREATE POINT INDEX ON :City(center)")
         execute_query("CREATE INDEX ON :Commune")
+        ensure_geometry_store("communes")
         execute_query_to_csv_parallelized(
-            query, headers, output_directory, modifier_function=is_point_within_border, chunk_size=2000
+            query, headers, output_directory, modifier_function=partial(is_point_within_border, store_name="communes"), chunk_size=2000, edge_query=edge_query, tuning_key="relationship_1"
         )
 
         execute_query("DROP POINT INDEX ON :City(center)")
         execute_query("DROP INDEX ON :Commune")
-        
 
     create_relationships_query = lambda path: f"""
         LOAD CSV FROM '{path}' WITH HEADER AS row
         MATCH (city:City {{id: toInteger(row.city_id)}}), (commune:Commune {{id: toInteger(row.commune_id)}})
         CREATE (city)-[:LOCATED_IN]->(commune)
         """
-    
-    city_commune_connetions_queries = [
-        create_relationships_query(
-            os.path.join(output_directory, file.name)
-        )
-        for file in Path(output_directory).glob("*.csv")
-    ]
+    unwind_query = """
+        UNWIND $rows AS row
+        MATCH (city:City {id: row.city_id}), (commune:Commune {id: row.commune_id})
+        CREATE (city)-[:LOCATED_IN]->(commune)
+        """
 
-    execute_query("CREATE INDEX ON :City(id)")
-    execute_query("CREATE INDEX ON :Commune(id)")
-    
-    execute_with_pool(
-        execute_query, city_commune_connetions_queries, max_processes=10
+    create_edges(
+        "/data/city_commune_data",
+        compute_edges,
+        create_relationships_query,
+        unwind_query,
+        [":City(id)", ":Commune(id)"],
+        partial(create_located_in_relationships_in_database, "City", "Commune", "communes"),
     )
-    
-    execute_query("DROP INDEX ON :City(id)")
-    execute_query("DROP INDEX ON :Commune(id)")
-    execute_query("FREE MEMORY")
 
 
 def create_relationship_2():
@@ -107,48 +179,41 @@ def create_relationship_2():
     WITH  powiat.lower_left_corner as llc, powiat.upper_right_corner as urc, powiat
     MATCH (commune:Commune) 
     WHERE point.withinbbox(commune.center, llc, urc)
-    RETURN commune.id AS commune_id, commune.center.x AS commune_x, commune.center.y AS commune_y, powiat.id AS powiat_id, powiat.wkt AS powiat_wkt
+    RETURN commune.id AS commune_id, commune.center.x AS commune_x, commune.center.y AS commune_y, powiat.id AS powiat_id
     """
     headers = ["commune_id", "powiat_id"]
-    output_directory = "/data/commune_powiat_data"
-    clear_preprocessed_check(output_directory)
 
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory, exist_ok=True)
+    def compute_edges(output_directory, edge_query):
         execute_query("CREATE POINT INDEX ON :Commune(center)")
         execute_query("CREATE INDEX ON :Powiat")
+        ensure_geometry_store("powiats")
 
         execute_query_to_csv_parallelized(
-            query, headers, output_directory, modifier_function=is_point_within_border, chunk_size=1000
+            query, headers, output_directory, modifier_function=partial(is_point_within_border, store_name="powiats"), chunk_size=1000, edge_query=edge_query, tuning_key="relationship_2"
         )
 
         execute_query("DROP POINT INDEX ON :Commune(center)")
         execute_query("DROP INDEX ON :Powiat")
 
-        
     create_relationships_query = lambda path: f"""
         LOAD CSV FROM '{path}' WITH HEADER AS row
         MATCH (commune:Commune {{id: toInteger(row.commune_id)}}), (powiat:Powiat {{id: toInteger(row.powiat_id)}})
         CREATE (commune)-[:LOCATED_IN]->(powiat)
         """
-        
-    commune_powiat_connetions_queries = [
-        create_relationships_query(
-            os.path.join(output_directory, file.name)
-        )
-        for file in Path(output_directory).glob("*.csv")
-    ]
-            
-    execute_query("CREATE INDEX ON :Powiat(id)")
-    execute_query("CREATE INDEX ON :Commune(id)")
-    
-    execute_with_pool(
-        execute_query, commune_powiat_connetions_queries, max_processes=10
-    )
+    unwind_query = """
+        UNWIND $rows AS row
+        MATCH (commune:Commune {id: row.commune_id}), (powiat:Powiat {id: row.powiat_id})
+        CREATE (commune)-[:LOCATED_IN]->(powiat)
+        """
 
-    execute_query("DROP INDEX ON :Powiat(id)")
-    execute_query("DROP INDEX ON :Commune(id)")
-    execute_query("FREE MEMORY")
+    create_edges(
+        "/data/commune_powiat_data",
+        compute_edges,
+        create_relationships_query,
+        unwind_query,
+        [":Powiat(id)", ":Commune(id)"],
+        partial(create_located_in_relationships_in_database, "Commune", "Powiat", "powiats"),
+    )
 
 
 def create_relationship_3():
@@ -161,8 +226,13 @@ def create_relationship_3():
     WITH  voivodship.lower_left_corner as llc, voivodship.upper_right_corner as urc, voivodship
     MATCH (powiat:Powiat) 
     WHERE point.withinbbox(powiat.center, llc, urc)
-    RETURN powiat.id AS powiat_id, powiat.center.x AS powiat_x, powiat.center.y AS powiat_y, voivodship.id AS voivodship_id, voivodship.wkt AS voivodship_wkt
+    RETURN powiat.id AS powiat_id, powiat.center.x AS powiat_x, powiat.center.y AS powiat_y, voivodship.id AS voivodship_id
     """
+    if get_edge_output_mode() == "database":
+        create_located_in_relationships_in_database("Powiat", "Voivodship", "voivodships")
+        execute_query("FREE MEMORY")
+        return
+
     headers = ["powiat_id", "voivodship_id"]
     output_directory = "/data/powiat_voivodship_data"
     output_file = os.path.join(output_directory, 'powiat_voivodship_data.csv')
@@ -172,9 +242,10 @@ def create_relationship_3():
         os.makedirs(output_directory, exist_ok=True)
         execute_query("CREATE POINT INDEX ON :Powiat(center)")
         execute_query("CREATE INDEX ON :Voivodship")
+        ensure_geometry_store("voivodships")
         
         execute_query_to_csv(
-            query, headers, output_file, modifier_function=is_point_within_border
+            query, headers, output_file, modifier_function=partial(is_point_within_border, store_name="voivodships")
         )
         
         execute_query("DROP POINT INDEX ON :Powiat(center)")
@@ -206,8 +277,13 @@ def create_relationship_4():
     WITH  country.lower_left_corner as llc, country.upper_right_corner as urc, country
     MATCH (voivodship:Voivodship) 
     WHERE point.withinbbox(voivodship.center, llc, urc)
-    RETURN voivodship.id AS voivodship_id, voivodship.center.x AS voivodship_x, voivodship.center.y AS voivodship_y, country.id AS country_id, country.wkt AS country_wkt
+    RETURN voivodship.id AS voivodship_id, voivodship.center.x AS voivodship_x, voivodship.center.y AS voivodship_y, country.id AS country_id
     """
+    if get_edge_output_mode() == "database":
+        create_located_in_relationships_in_database("Voivodship", "Country", "countries")
+        execute_query("FREE MEMORY")
+        return
+
     headers = ["voivodship_id", "country_id"]
     output_directory = "/data/voivodship_country_data"
     output_file = os.path.join(output_directory, 'voivodship_country_data.csv')
@@ -217,9 +293,10 @@ def create_relationship_4():
         os.makedirs(output_directory, exist_ok=True)
         execute_query("CREATE POINT INDEX ON :Voivodship(center)")
         execute_query("CREATE INDEX ON :Country")
+        ensure_geometry_store("countries")
         
         execute_query_to_csv(
-            query, headers, output_file, modifier_function=is_point_within_border
+            query, headers, output_file, modifier_function=partial(is_point_within_border, store_name="countries")
         )
         
         execute_query("DROP INDEX ON :Country")
@@ -241,11 +318,20 @@ def create_relationship_4():
     execute_query("FREE MEMORY")
 
 
+def create_symmetric_edges_clause(node1, node2, relationship):
+    """
+    CREATE clause of a symmetric relationship between two nodes, e.g. relationship=':CLOSE_TO {distance: d}'.
+    Creates one edge per pair of nodes in the undirected symmetric edge layout and two edges otherwise.
+    """
+    if get_symmetric_edge_layout() == "undirected":
+        return f"CREATE ({node1})-[{relationship}]->({node2})"
+    return f"CREATE ({node1})-[{relationship}]->({node2}), ({node2})-[{relationship}]->({node1})"
+
+
 def are_adjacent(data):
     """Checks if two borders are adjacent."""
-    border_1_id, border_1_wkt, border_2_id, border_2_wkt = data
-    line1 = wkt.loads(border_1_wkt)
-    line2 = wkt.loads(border_2_wkt)
+    border_1_id, border_2_id = data
+    line1, line2 = get_geometry_store("communes").get_many([border_1_id, border_2_id])
 
     # A and B overlap if they have some but not all points in common,
     # have the same dimension, and the intersection of the interiors
@@ -268,52 +354,66 @@ def create_relationship_5():
         WITH MAX(point.distance(c_max.upper_right_corner, c_max.lower_left_corner)) as max_dia
         MATCH (c1:Commune), (c2:Commune)
         WHERE id(c1) < id(c2) AND point.distance(c1.center, c2.center) <= max_dia
-        RETURN c1.id AS commune1_id, c1.wkt AS commune1_wkt, 
-        c2.id AS commune2_id, c2.wkt AS commune2_wkt
+        RETURN c1.id AS commune1_id, c2.id AS commune2_id
     """
     headers = ["commune1_id", "commune2_id"]
-    output_directory = "/data/adjacent_communes"
-    clear_preprocessed_check(output_directory)
-    
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory, exist_ok=True)
+
+    def compute_edges(output_directory, edge_query):
         execute_query("CREATE POINT INDEX ON :Commune(center)")
         execute_query("CREATE INDEX ON :Commune")
+        ensure_geometry_store("communes")
         
         execute_query_to_csv_parallelized(
-            query, headers, output_directory, modifier_function=are_adjacent, chunk_size=1000
+            query, headers, output_directory, modifier_function=are_adjacent, chunk_size=1000, edge_query=edge_query, tuning_key="relationship_5"
         )
 
         execute_query("DROP POINT INDEX ON :Commune(center)")
         execute_query("DROP INDEX ON :Commune")
         
+    create_clause = create_symmetric_edges_clause("c1", "c2", ":IS_ADJACENT")
     create_relationships_query = lambda path: f"""
         LOAD CSV FROM '{path}' WITH HEADER AS row
         MATCH (c1:Commune {{id: toInteger(row.commune1_id)}}), (c2:Commune {{id: toInteger(row.commune2_id)}})
-        CREATE (c1)-[:IS_ADJACENT]->(c2), (c2)-[:IS_ADJACENT]->(c1)
+        {create_clause}
         """
-        
-    adjcent_communes_connetions_queries = [
-        create_relationships_query(
-            os.path.join(output_directory, file.name)
+    unwind_query = f"""
+        UNWIND $rows AS row
+        MATCH (c1:Commune {{id: row.commune1_id}}), (c2:Commune {{id: row.commune2_id}})
+        {create_clause}
+        """
+
+    def create_in_database():
+        execute_query("CREATE POINT INDEX ON :Commune(center)")
+        ensure_geometry_store("communes")
+        execute_query(
+            f"""
+            MATCH (c_max:Commune)
+            WITH MAX(point.distance(c_max.upper_right_corner, c_max.lower_left_corner)) as max_dia
+            MATCH (c1:Commune), (c2:Commune)
+            WHERE id(c1) < id(c2) AND point.distance(c1.center, c2.center) <= max_dia
+            WITH c1, COLLECT(c2) AS candidates
+            CALL spatial.adjacent("communes", c1.id, [c IN candidates | c.id]) YIELD index
+            WITH c1, candidates[index] AS c2
+            {create_clause}
+            """
         )
-        for file in Path(output_directory).glob("*.csv")
-    ]
-    execute_query("CREATE INDEX ON :Commune(id)")
+        execute_query("DROP POINT INDEX ON :Commune(center)")
 
-    execute_with_pool(
-        execute_query, adjcent_communes_connetions_queries, max_processes=10
+    create_edges(
+        "/data/adjacent_communes",
+        compute_edges,
+        create_relationships_query,
+        unwind_query,
+        [":Commune(id)"],
+        create_in_database,
     )
-    
-    execute_query("DROP INDEX ON :Commune(id)")
-    execute_query("FREE MEMORY")
+    set_edge_layout("IS_ADJACENT", "Commune", get_symmetric_edge_layout())
 
 
 def check_proximity(data, distance=500):
-    id1, wkt1, id2, wkt2 = data
+    id1, id2 = data
 
-    geom1 = wkt.loads(wkt1)
-    geom2 = wkt.loads(wkt2)
+    geom1, geom2 = get_geometry_store("buildings").get_many([id1, id2])
 
     actual_distance = geom1.distance(geom2)
     if actual_distance <= distance:
@@ -322,14 +422,14 @@ def check_proximity(data, distance=500):
     return None
 
 def check_proximity_multiple(data, distance=500):
-    id1, wkt1, ids, wkts = data
+    id1, ids = data
 
-    geom1 = wkt.loads(wkt1)
+    store = get_geometry_store("buildings")
+    geom1 = store.get(id1)
     prepare(geom1)
     
     return_values = []
-    for id2, wkt2 in zip(ids, wkts):
-        geom2 = wkt.loads(wkt2)
+    for id2, geom2 in zip(ids, store.get_many(ids)):
         actual_distance = geom1.distance(geom2)
         if actual_distance <= distance:
             return_values.append([id1, id2, actual_distance]) 
@@ -341,15 +441,24 @@ def create_buildings_distance_connetions_query(path):
     return f"""
         LOAD CSV FROM '{path}' WITH HEADER AS row
         MATCH (startNode:Building {{id: toInteger(row.id1)}}), (endNode:Building {{id: toInteger(row.id2)}})
-        CREATE (startNode)-[:CLOSE_TO {{distance: toFloat(row.actual_distance)}}]->(endNode), (endNode)-[:CLOSE_TO {{distance: toFloat(row.actual_distance)}}]->(startNode)
+        {create_symmetric_edges_clause("startNode", "endNode", ":CLOSE_TO {distance: toFloat(row.actual_distance)}")}
     """
 
 
+def create_buildings_distance_connections_unwind_query():
+    return f"""
+    UNWIND $rows AS row
+    MATCH (startNode:Building {{id: row.id1}}), (endNode:Building {{id: row.id2}})
+    {create_symmetric_edges_clause("startNode", "endNode", ":CLOSE_TO {distance: row.actual_distance}")}
+"""
+
+
 def create_relationship_6():
     """
     All neighbouring buildings not further than 500 meters apart; attributes: distance (meters)
     """
-    query = """
+    # Candidate pairs t1, t2, checked by the client or by the spatial module in the database
+    candidates_clause = """
         MATCH (wieliczka: Powiat{name:"powiat wielicki"})
         WITH wieliczka.lower_left_corner as llc, wieliczka.upper_right_corner as urc
         
@@ -363,17 +472,22 @@ def create_relationship_6():
         
         MATCH (t2:Building)
         WHERE id(t1) < id(t2) AND point.distance(t2.center, p) <= max_distance
-        RETURN t1.id, t1.wkt, t2.id, t2.wkt
         """
+    query = candidates_clause + "RETURN t1.id, t2.id"
     headers = ["id1", "id2", "actual_distance"]
+    database_query = (
+        candidates_clause
+        + """WITH t1, COLLECT(t2) AS candidates
+        CALL spatial.within_distance("buildings", t1.id, [c IN candidates | c.id], 500) YIELD index, distance
+        WITH t1, candidates[index] AS t2, distance
+        """
+        + create_symmetric_edges_clause("t1", "t2", ":CLOSE_TO {distance: distance}")
+    )
 
-    output_directory = "/data/buildings_distance"
-    clear_preprocessed_check(output_directory)
-
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory, exist_ok=True)
+    def compute_edges(output_directory, edge_query):
         execute_query("CREATE INDEX ON :Building")
         execute_query("CREATE POINT INDEX ON :Building(center)")
+        ensure_geometry_store("buildings")
 
         execute_query_to_csv_parallelized(
             query,
@@ -381,22 +495,29 @@ def create_relationship_6():
             output_directory,
             modifier_function=check_proximity,
             chunk_size=100_000,
+            edge_query=edge_query,
+            tuning_key="relationship_6",
         )
         execute_query("DROP INDEX ON :Building")
         execute_query("DROP POINT INDEX ON :Building(center)")
 
-    execute_query("CREATE INDEX ON :Building(id)")
-    buildings_distance_connetions_queries = [
-        create_buildings_distance_connetions_query(
-            os.path.join(output_directory, file.name)
-        )
-        for file in Path(output_directory).glob("*.csv")
-    ]
-    execute_with_pool(
-        execute_query, buildings_distance_connetions_queries, max_processes=10
+    def create_in_database():
+        execute_query("CREATE INDEX ON :Building")
+        execute_query("CREATE POINT INDEX ON :Building(center)")
+        ensure_geometry_store("buildings")
+        execute_query(database_query)
+        execute_query("DROP INDEX ON :Building")
+        execute_query("DROP POINT INDEX ON :Building(center)")
+
+    create_edges(
+        "/data/buildings_distance",
+        compute_edges,
+        create_buildings_distance_connetions_query,
+        create_buildings_distance_connections_unwind_query(),
+        [":Building(id)"],
+        create_in_database,
     )
-    execute_query("DROP INDEX ON :Building(id)")
-    execute_query("FREE MEMORY")
+    set_edge_layout("CLOSE_TO", "Building", get_symmetric_edge_layout())
 
 
 def create_relationship_7():
@@ -411,25 +532,97 @@ def create_relationship_7():
                     WITH t1, t1.geometry as p
                     MATCH (t2:Tree)
                     WHERE id(t1) < id(t2) AND point.distance(t2.geometry, p) <= 50
-                    CREATE (t1)-[:CLOSE_TO {{distance: point.distance(p, t2.geometry)}}]->(t2), (t2)-[:CLOSE_TO {{distance: point.distance(p, t2.geometry)}}]->(t1)
+                    {create_symmetric_edges_clause("t1", "t2", ":CLOSE_TO {distance: point.distance(p, t2.geometry)}")}
                   """
     )
     execute_query("DROP POINT INDEX ON :Tree(geometry)")
     execute_query("DROP INDEX ON :Tree")
     execute_query("FREE MEMORY")
+    set_edge_layout("CLOSE_TO", "Tree", get_symmetric_edge_layout())
 
 
-def check_trees_for_distance(data, distance=20):
-    road_id, road_wkt, tree_ids, tree_xs, tree_ys = data
-    trees = [(tree_id, Point(float(tree_x), float(tree_y))) for tree_id, tree_x, tree_y in zip(tree_ids, tree_xs, tree_ys) ]
-    road_geom = wkt.loads(road_wkt)
+def get_tiles(label, tile_size):
+    """
+    Splits the extent of lower left corners of nodes with a given label into square tiles
+    """
+    query = f"""
+    MATCH (n:{label})
+    RETURN min(n.lower_left_corner.x) AS minx, min(n.lower_left_corner.y) AS miny,
+    max(n.lower_left_corner.x) AS maxx, max(n.lower_left_corner.y) AS maxy
+    """
+    minx, miny, maxx, maxy = get_query_results_list(query, lambda record: record.values())[0]
+    if minx is None:
+        return []
+    return [
+        (x, y, x + tile_size, y + tile_size)
+        for x in np.arange(minx, maxx + tile_size, tile_size)
+        for y in np.arange(miny, maxy + tile_size, tile_size)
+    ]
 
-    prepare(road_geom)
-    return_values = [(road_id, tree_id, road_geom.distance(tree)) for tree_id, tree in trees if road_geom.dwithin(tree, distance)]
-    
-    return None if len(return_values) == 0 else return_values
 
-# id1    id2 actual_distance
+def execute_tiled_join(label, tile_size, tile_function, headers, output_directory, edge_query=None, n_executors=12):
+    """
+    Runs tile_function(tile, headers, output_directory, edge_query) for every tile of nodes with a given label in parallel.
+    Every worker appends edges of its tiles to its own csv files in output_directory, unless it is None.
+    """
+    tiles = get_tiles(label, tile_size)
+    jobs = [(tile, headers, output_directory, edge_query) for tile in tiles]
+    done = 0
+    for _, processed_records in parrarelize_processes(
+        tile_function, jobs, n_executors=n_executors
+    ):
+        done += processed_records
+    print(done)
+    if output_directory is not None:
+        finish_csv_files(output_directory)
+
+
+def check_trees_for_distance_in_tile(tile, headers, output_directory=None, edge_query=None, distance=20):
+    """
+    Joins all roads starting in the tile with trees not further than distance from them.
+    Trees are fetched once per tile and matched to all its roads with a single STRtree query.
+    """
+    minx, miny, maxx, maxy = tile
+    roads_query = f"""
+    MATCH (road:Road)
+    WHERE point.withinbbox(road.lower_left_corner, point({{x: {minx}, y: {miny}}}), point({{x: {maxx}, y: {maxy}}}))
+        AND road.lower_left_corner.x < {maxx} AND road.lower_left_corner.y < {maxy}
+    RETURN road.id, road.upper_right_corner.x, road.upper_right_corner.y
+    """
+    roads = get_query_results_list(roads_query, lambda record: record.values())
+    if len(roads) == 0:
+        return 0
+    road_ids, road_maxxs, road_maxys = zip(*roads)
+
+    trees_query = f"""
+    MATCH (tree:Tree)
+    WHERE point.withinbbox(tree.geometry, point({{x: {minx - distance}, y: {miny - distance}}}), point({{x: {max(road_maxxs) + distance}, y: {max(road_maxys) + distance}}}))
+    RETURN tree.id, tree.geometry.x, tree.geometry.y
+    """
+    trees = get_query_results_list(trees_query, lambda record: record.values())
+    if len(trees) == 0:
+        return 0
+    tree_ids, tree_xs, tree_ys = (np.array(values) for values in zip(*trees))
+
+    road_geoms = get_geometry_store("roads").get_many(road_ids)
+    road_idx, tree_idx, distances = points_within_distance(
+        road_geoms, tree_xs, tree_ys, distance
+    )
+    road_ids = np.array(road_ids)
+
+    save_edges(
+        headers,
+        list(zip(road_ids[road_idx].tolist(), tree_ids[tree_idx].tolist(), distances.tolist())),
+        edge_query,
+        output_directory,
+    )
+    return len(distances)
+
+
+ROAD_TREE_HEADERS = ["road_id", "tree_id", "distance"]
+
+
+# road_id    tree_id    distance
 def create_road_tree_connetions_query(path):
     return f"""
         LOAD CSV FROM '{path}' WITH HEADER AS row
@@ -437,58 +630,57 @@ def create_road_tree_connetions_query(path):
         CREATE (tree)-[:CLOSE_TO {{distance: toFloat(row.distance)}}]->(road)
     """
 
+
+ROAD_TREE_CONNECTIONS_UNWIND_QUERY = """
+    UNWIND $rows AS row
+    MATCH (road:Road {id: row.road_id}), (tree:Tree {id: row.tree_id})
+    CREATE (tree)-[:CLOSE_TO {distance: row.distance}]->(road)
+"""
+
+
 def create_relationship_8():
     """
     Trees which are not further than 20 meters from a road
     """
 
-    query = """
-    MATCH (road:Road)
-    WITH road, point({x: road.lower_left_corner.x - 20, y: road.lower_left_corner.y - 20}) as llc, point({x: road.upper_right_corner.x + 20, y: road.upper_right_corner.y + 20}) as urc
-    MATCH (tree:Tree)
-    WHERE point.withinbbox(tree.geometry, llc, urc)
-    RETURN road.id, road.wkt,  COLLECT(tree.id) as tree_ids, COLLECT(tree.geometry.x) as tree_xs, COLLECT(tree.geometry.y) as tree_ys
-    """
-    
-    headers = ["road_id", "tree_id", "distance"]
-
-    output_directory = "/data/trees_roads"
-    clear_preprocessed_check(output_directory)
-    
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory, exist_ok=True)
+    def compute_edges(output_directory, edge_query):
         execute_query("CREATE POINT INDEX ON :Tree(geometry)")
-        execute_query("CREATE INDEX ON :Road")
+        execute_query("CREATE POINT INDEX ON :Road(lower_left_corner)")
+        ensure_geometry_store("roads")
 
-        execute_query_to_csv_parallelized(
-            query,
-            headers,
-            output_directory,
-            modifier_function=check_trees_for_distance,
-            expand_output_list=True,
-            chunk_size=5000,
+        execute_tiled_join(
+            "Road", 10_000, check_trees_for_distance_in_tile, ROAD_TREE_HEADERS, output_directory, edge_query
         )
         
         execute_query("DROP POINT INDEX ON :Tree(geometry)")
-        execute_query("DROP INDEX ON :Road")
+        execute_query("DROP POINT INDEX ON :Road(lower_left_corner)")
 
-    execute_query("CREATE INDEX ON :Tree(id)")
-    execute_query("CREATE INDEX ON :Road(id)")
-
-    road_tree_connetions_queries = [
-        create_road_tree_connetions_query(
-            os.path.join(output_directory, file.name)
+    def create_in_database(distance=20):
+        execute_query("CREATE POINT INDEX ON :Tree(geometry)")
+        ensure_geometry_store("roads")
+        execute_query(
+            f"""
+            MATCH (road:Road)
+            WITH road, point({{x: road.lower_left_corner.x - {distance}, y: road.lower_left_corner.y - {distance}}}) as llc, point({{x: road.upper_right_corner.x + {distance}, y: road.upper_right_corner.y + {distance}}}) as urc
+            MATCH (tree:Tree)
+            WHERE point.withinbbox(tree.geometry, llc, urc)
+            WITH road, COLLECT(tree) AS candidates
+            CALL spatial.points_within("roads", road.id, [c IN candidates | c.geometry.x], [c IN candidates | c.geometry.y], {distance}) YIELD index, distance
+            WITH road, candidates[index] AS tree, distance
+            CREATE (tree)-[:CLOSE_TO {{distance: distance}}]->(road)
+            """
         )
-        for file in Path(output_directory).glob("*.csv")
-    ]
-    
-    execute_with_pool(
-        execute_query, road_tree_connetions_queries, max_processes=10
+        execute_query("DROP POINT INDEX ON :Tree(geometry)")
+
+    create_edges(
+        "/data/trees_roads",
+        compute_edges,
+        create_road_tree_connetions_query,
+        ROAD_TREE_CONNECTIONS_UNWIND_QUERY,
+        [":Tree(id)", ":Road(id)"],
+        create_in_database,
     )
-    execute_query("DROP INDEX ON :Tree(id)")
-    execute_query("DROP INDEX ON :Road(id)")
-    execute_query("FREE MEMORY")
-    
+    build_road_tree_histograms()
 
 
 def create_relationship_9():
@@ -497,75 +689,70 @@ def create_relationship_9():
     attributes: connecting node identifier,
     which part of one road is connected to the other road (start, mid, end)
     """
-    query = """
-    MATCH (rn:RoadNode)
-    MATCH (rn)-[:BELONGS_TO]->(r:Road)
-    WITH rn, COLLECT(r) as roads, extract(road IN COLLECT(r)| CASE WHEN road.start_node_id = rn.id THEN "start" WHEN road.end_node_id = rn.id THEN "end" ELSE "mid" END) as parts
-    WHERE SIZE(roads) > 1
-    FOREACH (index1 IN RANGE(0, SIZE(roads) - 2) |
-        FOREACH (index2 IN RANGE(index1 + 1, SIZE(roads) - 1) |
-            FOREACH (firstRoad IN [roads[index1]] |
-                FOREACH (secondRoad IN [roads[index2]] | 
-                    CREATE (firstRoad)-[:ROAD_CONNECTED_TO {rn_id: rn.id, part: parts[index1]}]->(secondRoad)
-                    CREATE (secondRoad)-[:ROAD_CONNECTED_TO {rn_id: rn.id, part: parts[index2]}]->(firstRoad)
-                )
-            )
+    dirs = preprocess_and_save_road_components("roads")
+    roads_roads_connection_directory = dirs[-1]
+
+    road_road_connections_queries = [
+        create_road_road_connection_query(
+            os.path.join(roads_roads_connection_directory, file.name)
         )
-    )
-    """
-    
+        for file in Path(roads_roads_connection_directory).glob("*.csv")
+    ]
+
     execute_query("CREATE INDEX ON :Road(id)")
-    execute_query("CREATE INDEX ON :Road")
-    execute_query("CREATE INDEX ON :RoadNode")
-    
-    execute_query(query)
+
+    execute_with_pool(
+        execute_query, road_road_connections_queries, max_processes=20
+    )
 
     execute_query("DROP INDEX ON :Road(id)")
-    execute_query("DROP INDEX ON :Road")
-    execute_query("DROP INDEX ON :RoadNode")
     execute_query("FREE MEMORY")
     
     
-def calculate_angle(segment1, segment2):
-
-    x1, y1, x2, y2 = *segment1.coords[0], *segment1.coords[1]
-    x3, y3, x4, y4 = *segment2.coords[0], *segment2.coords[1]
-
-    vector1 = (x2 - x1, y2 - y1)
-    vector2 = (x4 - x3, y4 - y3)
-
-    dot_product = vector1[0] * vector2[0] + vector1[1] * vector2[1]
-    magnitude1 = np.sqrt(vector1[0]**2 + vector1[1]**2)
-    magnitude2 = np.sqrt(vector2[0]**2 + vector2[1]**2)
+def check_railroad_road_intersection_in_tile(tile, headers, output_directory=None, edge_query=None, road_margin=(0, 0)):
+    """
+    Finds all crossings of railways starting in the tile with roads.
+    road_margin is the largest road extent, so that every road whose bounding box
+    overlaps the tile railways is fetched through the point index on its lower left corner.
+    """
+    minx, miny, maxx, maxy = tile
+    railways_query = f"""
+    MATCH (railway:Railway)
+    WHERE point.withinbbox(railway.lower_left_corner, point({{x: {minx}, y: {miny}}}), point({{x: {maxx}, y: {maxy}}}))
+        AND railway.lower_left_corner.x < {maxx} AND railway.lower_left_corner.y < {maxy}
+    RETURN railway.id, railway.upper_right_corner.x, railway.upper_right_corner.y
+    """
+    railways = get_query_results_list(railways_query, lambda record: record.values())
+    if len(railways) == 0:
+        return 0
+    railway_ids, railway_maxxs, railway_maxys = zip(*railways)
+    margin_x, margin_y = road_margin
 
-    cos_theta = dot_product / (magnitude1 * magnitude2)
-    cos_theta = min(1, max(-1, cos_theta)) 
+    roads_query = f"""
+    MATCH (road:Road)
+    WHERE point.withinbbox(road.lower_left_corner, point({{x: {minx - margin_x}, y: {miny - margin_y}}}), point({{x: {max(railway_maxxs)}, y: {max(railway_maxys)}}}))
+        AND road.upper_right_corner.x >= {minx} AND road.upper_right_corner.y >= {miny}
+    RETURN road.id
+    """
+    road_ids = get_query_results_list(roads_query, lambda record: record.value())
+    if len(road_ids) == 0:
+        return 0
 
-    angle = np.acos(cos_theta) * (180 / np.pi)
-    return angle
-    
-def check_railroad_road_intersection(data):
-    railroad_id, railroad_wkt, road_ids, road_wkts = data
-    roads = [(road_id, wkt.loads(road_wkt)) for road_id, road_wkt in zip(road_ids, road_wkts) ]
-    railroad_geom = wkt.loads(railroad_wkt)
-    prepare(railroad_geom)
-    
-    return_values = []
-    for road_id, road in roads:
-        if railroad_geom.crosses(road):
-            for i in range(len(railroad_geom.coords) - 1):
-                railroad_segment = LineString([railroad_geom.coords[i], railroad_geom.coords[i + 1]])
-                prepare(railroad_segment)
+    railway_idx, road_idx, angles = segment_crossings(
+        get_geometry_store("railways").get_many(railway_ids),
+        get_geometry_store("roads").get_many(road_ids),
+    )
 
-                for j in range(len(road.coords) - 1):
-                    road_segment = LineString([road.coords[j], road.coords[j + 1]])
+    save_edges(
+        headers,
+        list(zip(np.array(railway_ids)[railway_idx].tolist(), np.array(road_ids)[road_idx].tolist(), angles.tolist())),
+        edge_query,
+        output_directory,
+    )
+    return len(angles)
 
-                    if railroad_segment.crosses(road_segment):
-                        angle = calculate_angle(railroad_segment, road_segment)
-                        return_values.append((railroad_id, road_id, angle))
+ROAD_RAILWAY_HEADERS = ["railway_id", "road_id", "angle"]
 
-    
-    return None if len(return_values) == 0 else return_values    
 
 # ["railway_id", "road_id", "angle"]
 def create_road_railway_crossing_query(path):
@@ -575,72 +762,71 @@ def create_road_railway_crossing_query(path):
         CREATE (railway)-[:CROSSES {{angle: toFloat(row.angle)}}]->(road)
     """
 
+
+ROAD_RAILWAY_CROSSING_UNWIND_QUERY = """
+    UNWIND $rows AS row
+    MATCH (railway:Railway {id: row.railway_id}), (road:Road {id: row.road_id})
+    CREATE (railway)-[:CROSSES {angle: row.angle}]->(road)
+"""
+
+
 def create_relationship_10():
     """
     Railways which cross roads; attributes: angle
     """
-    
-    query="""
-    MATCH (ra:Railway)
-    WITH point.distance(ra.upper_right_corner, ra.lower_left_corner) as max_distance, ra, ra.upper_right_corner as p
-    MATCH (r:Road)
-    WHERE point.distance(r.upper_right_corner, p) <= max_distance AND
-        ra.upper_right_corner.x >= r.lower_left_corner.x AND 
-        r.upper_right_corner.x >= ra.lower_left_corner.x AND 
-        ra.upper_right_corner.y >= r.lower_left_corner.y AND 
-        r.upper_right_corner.y >= ra.lower_left_corner.y
-    RETURN ra.id, ra.wkt, COLLECT(r.id), COLLECT(r.wkt)
-    """
-    
-    headers = ["railway_id", "road_id", "angle"]
-
-    output_directory = "/data/railway_road_intersections"
-    clear_preprocessed_check(output_directory)
-
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory, exist_ok=True)
-        execute_query("CREATE POINT INDEX ON :Road(upper_right_corner)")
-        execute_query("CREATE INDEX ON :Railway")
 
-        execute_query_to_csv_parallelized(
-            query,
-            headers,
+    def compute_edges(output_directory, edge_query):
+        execute_query("CREATE POINT INDEX ON :Railway(lower_left_corner)")
+        execute_query("CREATE POINT INDEX ON :Road(lower_left_corner)")
+        ensure_geometry_store("railways")
+        ensure_geometry_store("roads")
+
+        road_margin = get_query_results_list(
+            """
+            MATCH (road:Road)
+            RETURN max(road.upper_right_corner.x - road.lower_left_corner.x), max(road.upper_right_corner.y - road.lower_left_corner.y)
+            """,
+            lambda record: record.values(),
+        )[0]
+        execute_tiled_join(
+            "Railway",
+            10_000,
+            partial(check_railroad_road_intersection_in_tile, road_margin=road_margin),
+            ROAD_RAILWAY_HEADERS,
             output_directory,
-            modifier_function=check_railroad_road_intersection,
-            expand_output_list=True,
-            chunk_size=1000,
+            edge_query,
         )
         
-        execute_query("DROP POINT INDEX ON :Road(upper_right_corner)")
-        execute_query("DROP INDEX ON :Railway")
+        execute_query("DROP POINT INDEX ON :Railway(lower_left_corner)")
+        execute_query("DROP POINT INDEX ON :Road(lower_left_corner)")
 
-    execute_query("CREATE INDEX ON :Road(id)")
-    execute_query("CREATE INDEX ON :Railway(id)")
-
-    road_railway_crossing_queries = [
-        create_road_railway_crossing_query(
-            os.path.join(output_directory, file.name)
+    def create_in_database():
+        execute_query("CREATE POINT INDEX ON :Road(upper_right_corner)")
+        ensure_geometry_store("railways")
+        ensure_geometry_store("roads")
+        execute_query(
+            """
+            MATCH (ra:Railway)
+            WITH point.distance(ra.upper_right_corner, ra.lower_left_corner) as max_distance, ra, ra.upper_right_corner as p
+            MATCH (r:Road)
+            WHERE point.distance(r.upper_right_corner, p) <= max_distance AND
+                ra.upper_right_corner.x >= r.lower_left_corner.x AND
+                r.upper_right_corner.x >= ra.lower_left_corner.x AND
+                ra.upper_right_corner.y >= r.lower_left_corner.y AND
+                r.upper_right_corner.y >= ra.lower_left_corner.y
+            WITH ra, COLLECT(r) AS candidates
+            CALL spatial.crossings("railways", ra.id, "roads", [c IN candidates | c.id]) YIELD index, angle
+            WITH ra, candidates[index] AS road, angle
+            CREATE (ra)-[:CROSSES {angle: angle}]->(road)
+            """
         )
-        for file in Path(output_directory).glob("*.csv")
-    ]
-    
-    execute_with_pool(
-        execute_query, road_railway_crossing_queries, max_processes=10
-    )
-    execute_query("DROP INDEX ON :Railway(id)")
-    execute_query("DROP INDEX ON :Road(id)")
-    execute_query("FREE MEMORY")
-
+        execute_query("DROP POINT INDEX ON :Road(upper_right_corner)")
 
-RELATIONSHIP_CREATORS = {
-    "1": create_relationship_1,
-    "2": create_relationship_2,
-    "3": create_relationship_3,
-    "4": create_relationship_4,
-    "5": create_relationship_5,
-    "6": create_relationship_6,
-    "7": create_relationship_7,
-    "8": create_relationship_8,
-    "9": create_relationship_9,
-    "10": create_relationship_10,
-}
+    create_edges(
+        "/data/railway_road_intersections",
+        compute_edges,
+        create_road_railway_crossing_query,
+        ROAD_RAILWAY_CROSSING_UNWIND_QUERY,
+        [":Road(id)", ":Railway(id)"],
+        create_in_database,
+    )
@@ -0,0 +1,208 @@
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from settings import DATABASE_MEMORY_LIMIT_MB
+from utils.parallelization import RESOURCE_MANAGER
+from utils.job_context import JobCancelled, check_cancelled, submit_in_context
+
+
+# reads: node labels used as input, no creator reads relationships created by another one
+# creates: relationship type created
+# pattern: start label, relationship type and end label of the created relationships
+# indexes: indexes created and dropped by the creator, creators sharing one can not run at the same time
+# processes: worker processes used by the client side phase
+# memory: estimated database memory needed in MB
+RELATIONSHIP_DEPENDENCIES = {
+    "1": {
+        "reads": ["City", "Commune"],
+        "creates": "LOCATED_IN",
+        "pattern": ("City", "LOCATED_IN", "Commune"),
+        "indexes": [":City(center)", ":Commune", ":City(id)", ":Commune(id)"],
+        "processes": 10,
+        "memory": 200,
+    },
+    "2": {
+        "reads": ["Commune", "Powiat"],
+        "creates": "LOCATED_IN",
+        "pattern": ("Commune", "LOCATED_IN", "Powiat"),
+        "indexes": [":Commune(center)", ":Powiat", ":Powiat(id)", ":Commune(id)"],
+        "processes": 10,
+        "memory": 100,
+    },
+    "3": {
+        "reads": ["Powiat", "Voivodship"],
+        "creates": "LOCATED_IN",
+        "pattern": ("Powiat", "LOCATED_IN", "Voivodship"),
+        "indexes": [":Powiat(center)", ":Voivodship", ":Powiat(id)", ":Voivodship(id)"],
+        "processes": 1,
+        "memory": 100,
+    },
+    "4": {
+        "reads": ["Voivodship", "Country"],
+        "creates": "LOCATED_IN",
+        "pattern": ("Voivodship", "LOCATED_IN", "Country"),
+        "indexes": [":Voivodship(center)", ":Country", ":Voivodship(id)", ":Country(id)"],
+        "processes": 1,
+        "memory": 100,
+    },
+    "5": {
+        "reads": ["Commune"],
+        "creates": "IS_ADJACENT",
+        "pattern": ("Commune", "IS_ADJACENT", "Commune"),
+        "indexes": [":Commune(center)", ":Commune", ":Commune(id)"],
+        "processes": 10,
+        "memory": 200,
+    },
+    "6": {
+        "reads": ["Building"],
+        "creates": "CLOSE_TO",
+        "pattern": ("Building", "CLOSE_TO", "Building"),
+        "indexes": [":Building", ":Building(center)", ":Building(id)"],
+        "processes": 10,
+        "memory": 2000,
+    },
+    "7": {
+        "reads": ["Tree"],
+        "creates": "CLOSE_TO",
+        "pattern": ("Tree", "CLOSE_TO", "Tree"),
+        "indexes": [":Tree", ":Tree(geometry)"],
+        "processes": 1,
+        "memory": 8000,
+    },
+    "8": {
+        "reads": ["Tree", "Road"],
+        "creates": "CLOSE_TO",
+        "pattern": ("Tree", "CLOSE_TO", "Road"),
+        "indexes": [":Tree(geometry)", ":Road(lower_left_corner)", ":Tree(id)", ":Road(id)"],
+        "processes": 12,
+        "memory": 1000,
+    },
+    "9": {
+        "reads": ["Road"],
+        "creates": "ROAD_CONNECTED_TO",
+        "pattern": ("Road", "ROAD_CONNECTED_TO", "Road"),
+        "indexes": [":Road(id)"],
+        "processes": 20,
+        "memory": 4000,
+    },
+    "10": {
+        "reads": ["Railway", "Road"],
+        "creates": "CROSSES",
+        "pattern": ("Railway", "CROSSES", "Road"),
+        "indexes": [":Railway(lower_left_corner)", ":Road(lower_left_corner)", ":Road(id)", ":Railway(id)"],
+        "processes": 12,
+        "memory": 200,
+    },
+}
+
+
+def are_conflicting(name, other):
+    return bool(
+        set(RELATIONSHIP_DEPENDENCIES[name]["indexes"])
+        & set(RELATIONSHIP_DEPENDENCIES[other]["indexes"])
+    )
+
+
+def run_timed(function):
+    start_time = time.time()
+    function()
+    return start_time, time.time()
+
+
+def run_relationship_schedule(creators, max_processes=None, memory_limit=None):
+    """
+    Runs relationship creators concurrently, respecting their shared indexes
+    and global limits of worker processes and database memory.
+
+    Parameters:
+        creators (Dict[str, Callable]): Relationship creators to run, by relationship id.
+        max_processes (int): Maximum number of worker processes in use, size of the shared worker pool by default.
+        memory_limit (int): Maximum estimated database memory in MB in use.
+
+    Returns:
+        List[Tuple[str, float, float]]: Relationship id, start and end time of every finished creator.
+    """
+    max_processes = max_processes or RESOURCE_MANAGER.get_capacity()
+    memory_limit = memory_limit or DATABASE_MEMORY_LIMIT_MB
+    names = list(creators.keys())
+
+    pending = list(names)
+    running = {}
+    finished = {}
+
+    with ThreadPoolExecutor(max_workers=len(names) or 1) as executor:
+        while pending or running:
+            # A cancelled job starts no more creators and waits for the running ones to stop
+            try:
+                check_cancelled()
+            except JobCancelled:
+                pending.clear()
+                if not running:
+                    break
+            for name in list(pending):
+                if any(are_conflicting(name, other) for other in running.values()):
+                    continue
+                used_processes = sum(RELATIONSHIP_DEPENDENCIES[other]["processes"] for other in running.values())
+                used_memory = sum(RELATIONSHIP_DEPENDENCIES[other]["memory"] for other in running.values())
+                if running and (
+                    used_processes + RELATIONSHIP_DEPENDENCIES[name]["processes"] > max_processes
+                    or used_memory + RELATIONSHIP_DEPENDENCIES[name]["memory"] > memory_limit
+                ):
+                    continue
+                print(f"Starting relationship {name}")
+                running[submit_in_context(executor, run_timed, creators[name])] = name
+                pending.remove(name)
+
+            if not running:
+                print(f"Could not schedule relationships: {', '.join(pending)}")
+                break
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    finished[name] = future.result()
+                    print(f"Finished relationship {name}")
+                except JobCancelled:
+                    print(f"Relationship {name} cancelled")
+                except BaseException:
+                    traceback.print_exc()
+                    print(f"Relationship {name} failed")
+
+    check_cancelled()
+    return [(name, *finished[name]) for name in names if name in finished]
+
+
+def get_critical_path(timeline):
+    """
+    Walks back from the last finished creator, each time to the creator whose end allowed it to start.
+    """
+    if not timeline:
+        return []
+    current = max(timeline, key=lambda entry: entry[2])
+    path = [current]
+    while True:
+        previous = [entry for entry in timeline if entry[2] <= current[1] + 1e-3 and entry not in path]
+        if not previous:
+            break
+        current = max(previous, key=lambda entry: entry[2])
+        path.append(current)
+    return path[::-1]
+
+
+def print_schedule_report(timeline):
+    if not timeline:
+        return
+    schedule_start = min(start for _, start, _ in timeline)
+    schedule_end = max(end for _, _, end in timeline)
+
+    print("\nRelationship creation timeline:")
+    for name, start, end in sorted(timeline, key=lambda entry: entry[1]):
+        print(
+            f"Relationship {name}: {start - schedule_start:8.2f}s - {end - schedule_start:8.2f}s ({end - start:.2f} seconds)"
+        )
+
+    critical_path = get_critical_path(timeline)
+    print(f"Critical path: {' -> '.join(name for name, _, _ in critical_path)}")
+    print(f"Sequential time: {sum(end - start for _, start, end in timeline):.2f} seconds.")
+    print(f"Wall time: {schedule_end - schedule_start:.2f} seconds.\n")
@@ -0,0 +1,280 @@
+"""
+HTTP/JSON interface to the queries, served next to the CLI.
+
+    GET  /queries                   available queries with their parameters and presets
+    GET  /queries/<no>?<name>=...   runs a query with parameters given by name, or '?preset' for preset ones,
+                                    optionally limited to a region with 'region=<region>'
+    POST /queries/<no>              runs a query with {"parameters": [...] or {...}} or {"preset": true}
+
+Results are streamed from the output file of the query, or returned as a page
+of the result list when 'offset' or 'limit' is given in the query string.
+Responses carry the time spent waiting for and running the query in X-Queue-Time,
+X-Query-Time and Server-Timing headers, and X-Cache telling whether the result was cached.
+"""
+import asyncio
+import inspect
+import json
+import math
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+from settings import QUERY_SERVICE_PORT, QUERY_SERVICE_THREADS, QUERY_SERVICE_MAX_QUEUED
+from plugins import QUERY_RUNNERS, PRESET_QUERY_ARGUMENTS
+from queries.result_cache import run_cached_query, get_query_lock, get_query_output_path
+
+STREAM_CHUNK_BYTES = 2**20
+PAGINATION_ARGUMENTS = ["offset", "limit"]
+# Optional parameters passed by name, which can also be given with preset parameters
+KEYWORD_PARAMETERS = ["region"]
+
+
+def get_parameters(query_no):
+    """Names of required and optional parameters of a query runner, known without importing it."""
+    metadata = QUERY_RUNNERS.get_metadata(query_no)
+    return metadata["parameters"], metadata["optional_parameters"]
+
+
+def describe_query(query_no):
+    required, optional = get_parameters(query_no)
+    return {
+        "query": query_no,
+        "description": inspect.cleandoc(QUERY_RUNNERS[query_no].__doc__ or ""),
+        "parameters": required,
+        "optional_parameters": optional,
+        "preset": PRESET_QUERY_ARGUMENTS.get(query_no, []),
+    }
+
+
+def is_number(argument):
+    try:
+        return math.isfinite(float(argument))
+    except ValueError:
+        return False
+
+
+def is_integer(argument):
+    if isinstance(argument, float):
+        return argument.is_integer()
+    return re.fullmatch(r"-?\d+", str(argument)) is not None
+
+
+def is_csv_name(argument):
+    return re.fullmatch(r"[\w-][\w.-]*\.csv", str(argument), re.IGNORECASE) is not None
+
+
+# Checks of arguments by parameter name with their descriptions, as arguments end up in Cypher queries and file paths
+PARAMETER_CHECKS = {
+    "max_distance": (is_number, "a number"),
+    "min_angle": (is_number, "a number"),
+    "max_angle": (is_number, "a number"),
+    "min_count": (is_integer, "an integer"),
+    "max_length": (is_integer, "an integer"),
+    "building_type": (lambda argument: re.fullmatch(r"[\w:-]+", str(argument)) is not None, "a building type"),
+    "mode": (lambda argument: argument in ["strict", "lazy"], "either 'strict' or 'lazy'"),
+    "start_road_id": (lambda argument: is_integer(argument) or is_csv_name(argument), "a road id or a csv file in /data"),
+    "end_road_id": (is_integer, "a road id"),
+    "region": (lambda argument: isinstance(argument, str), "a string"),
+}
+
+
+def check_argument(name, argument):
+    if not isinstance(argument, (str, int, float)) or isinstance(argument, bool):
+        raise ValueError(f"Parameter {name} has to be a number or a string")
+    check, description = PARAMETER_CHECKS.get(name, (None, None))
+    if check is not None and not check(argument):
+        raise ValueError(f"Parameter {name} has to be {description}, got {argument!r}")
+
+
+def parse_arguments(query_no, parameters=None, preset=False):
+    """
+    Positional and keyword arguments of a query runner from a list or a dict of parameters by name.
+    Keyword parameters, like region, are taken from a dict also when preset parameters are used.
+    """
+    required, optional = get_parameters(query_no)
+    names = required + optional
+    positional = [name for name in names if name not in KEYWORD_PARAMETERS]
+    parameters = parameters if parameters is not None else []
+    keyword_arguments = {}
+    if isinstance(parameters, dict):
+        keyword_arguments = {name: parameters[name] for name in KEYWORD_PARAMETERS if name in parameters}
+        for name, argument in keyword_arguments.items():
+            check_argument(name, argument)
+    if preset:
+        return list(PRESET_QUERY_ARGUMENTS[query_no]), keyword_arguments
+
+    if isinstance(parameters, dict):
+        unknown = [name for name in parameters if name not in names]
+        if unknown:
+            raise ValueError(f"Unknown parameters {unknown}, query {query_no} takes {names}")
+        missing = [name for name in required if name not in parameters]
+        if missing:
+            raise ValueError(f"Missing parameters {missing}, query {query_no} takes {names}")
+        given = [name for name in positional if name in parameters]
+        if given != positional[: len(given)]:
+            raise ValueError(f"Optional parameters of query {query_no} have to be given in order {optional}")
+        arguments = [parameters[name] for name in given]
+    elif isinstance(parameters, list):
+        if not len(required) <= len(parameters) <= len(positional):
+            raise ValueError(f"Query {query_no} takes parameters {positional}, {len(parameters)} given")
+        arguments = parameters
+    else:
+        raise ValueError("Parameters have to be a list or an object")
+
+    for name, argument in zip(positional, arguments):
+        check_argument(name, argument)
+    return list(arguments), keyword_arguments
+
+
+def parse_pagination(query):
+    try:
+        offset = int(query.get("offset", 0))
+        limit = int(query["limit"]) if "limit" in query else None
+    except ValueError:
+        raise ValueError("offset and limit have to be integers")
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError("offset and limit can not be negative")
+    return offset, limit
+
+
+def paginate(result, offset, limit):
+    """Page of a list result, or of the only list in an object result, e.g. quasi_roundabouts of query 9."""
+    end = None if limit is None else offset + limit
+    if isinstance(result, list):
+        return {"total": len(result), "offset": offset, "limit": limit, "result": result[offset:end]}
+    if isinstance(result, dict):
+        lists = [key for key, value in result.items() if isinstance(value, list)]
+        if len(lists) == 1:
+            page = dict(result)
+            page[lists[0]] = result[lists[0]][offset:end]
+            return {"total": len(result[lists[0]]), "offset": offset, "limit": limit, "result": page}
+    raise ValueError("Result of this query is not a list and can not be paginated")
+
+
+def run_query_job(query_no, arguments, keyword_arguments):
+    """
+    Runs a query in a service thread and opens its output file while holding the lock of the query,
+    so the returned file keeps this result even if the query is run again before it is read.
+    """
+    with get_query_lock(query_no):
+        start_time = time.perf_counter()
+        cached = run_cached_query(query_no, QUERY_RUNNERS[query_no], *arguments, **keyword_arguments)
+        elapsed = time.perf_counter() - start_time
+        result_file = open(get_query_output_path(query_no), "rb")
+    return result_file, cached, elapsed
+
+
+def error_response(status, message):
+    return web.json_response({"error": message}, status=status)
+
+
+class QueryService:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=QUERY_SERVICE_THREADS, thread_name_prefix="query")
+        # Queries of one type run one at a time, as they write the same output file
+        self.query_locks = {query_no: asyncio.Lock() for query_no in QUERY_RUNNERS}
+        self.queued = {query_no: 0 for query_no in QUERY_RUNNERS}
+
+    async def list_queries(self, request):
+        return web.json_response([describe_query(query_no) for query_no in QUERY_RUNNERS])
+
+    async def get_query(self, request):
+        query_no = request.match_info["query_no"]
+        if query_no not in QUERY_RUNNERS:
+            return error_response(404, f"Unknown query '{query_no}', available: {list(QUERY_RUNNERS)}")
+        parameters = {
+            name: value
+            for name, value in request.query.items()
+            if name not in PAGINATION_ARGUMENTS and name != "preset"
+        }
+        return await self.run_query(request, query_no, parameters, "preset" in request.query)
+
+    async def post_query(self, request):
+        query_no = request.match_info["query_no"]
+        if query_no not in QUERY_RUNNERS:
+            return error_response(404, f"Unknown query '{query_no}', available: {list(QUERY_RUNNERS)}")
+        try:
+            body = await request.json() if request.can_read_body else {}
+        except json.JSONDecodeError:
+            return error_response(400, "Request body is not valid JSON")
+        if not isinstance(body, dict):
+            return error_response(400, "Request body has to be an object")
+        return await self.run_query(request, query_no, body.get("parameters"), bool(body.get("preset")))
+
+    async def run_query(self, request, query_no, parameters, preset):
+        try:
+            arguments, keyword_arguments = parse_arguments(query_no, parameters, preset)
+            offset, limit = parse_pagination(request.query)
+        except ValueError as e:
+            return error_response(400, str(e))
+
+        if self.queued[query_no] >= QUERY_SERVICE_MAX_QUEUED:
+            return error_response(429, f"Too many requests of query {query_no} waiting, try again later")
+        self.queued[query_no] += 1
+        queue_start = time.perf_counter()
+        try:
+            async with self.query_locks[query_no]:
+                queue_time = time.perf_counter() - queue_start
+                result_file, cached, query_time = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, run_query_job, query_no, arguments, keyword_arguments
+                )
+        except ValueError as e:
+            return error_response(400, str(e))
+        except Exception as e:
+            return error_response(500, f"Query {query_no} failed: {e!r}")
+        finally:
+            self.queued[query_no] -= 1
+
+        headers = {
+            "X-Queue-Time": f"{queue_time:.3f}",
+            "X-Query-Time": f"{query_time:.3f}",
+            "Server-Timing": f"queue;dur={queue_time * 1000:.1f}, query;dur={query_time * 1000:.1f}",
+            "X-Cache": "hit" if cached else "miss",
+        }
+        with result_file:
+            if "offset" in request.query or "limit" in request.query:
+                try:
+                    page = paginate(json.load(result_file), offset, limit)
+                except ValueError as e:
+                    return error_response(400, str(e))
+                return web.json_response(page, headers=headers)
+            return await self.stream_file(request, result_file, headers)
+
+    async def stream_file(self, request, result_file, headers):
+        response = web.StreamResponse(headers={**headers, "Content-Type": "application/json"})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await loop.run_in_executor(None, result_file.read, STREAM_CHUNK_BYTES)
+            if not chunk:
+                break
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+
+def create_app():
+    service = QueryService()
+    app = web.Application()
+    app.add_routes(
+        [
+            web.get("/queries", service.list_queries),
+            web.get("/queries/{query_no}", service.get_query),
+            web.post("/queries/{query_no}", service.post_query),
+        ]
+    )
+    return app
+
+
+def serve_forever(port=QUERY_SERVICE_PORT):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runner = web.AppRunner(create_app())
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "0.0.0.0", port).start())
+    print(f"Query service listening on port {port}")
+    loop.run_forever()
+
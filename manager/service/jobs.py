@@ -0,0 +1,328 @@
+"""
+Background jobs of CLI commands.
+
+A job is a list of stages, each running one CLI command, e.g. 'import auto all' or 'cr all'.
+Stages start when the stages listed in their 'after' have finished, so independent stages overlap.
+Status of every job, with progress and throughput of its stages, is saved to /data/jobs/<id>.json.
+
+Pipeline spec files are JSON, e.g.
+    {"name": "nightly", "stages": [
+        {"name": "clear", "command": "delete_all"},
+        {"name": "import", "command": "import auto all", "after": ["clear"]},
+        {"name": "relationships", "command": "cr all", "after": ["import"]}
+    ]}
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+import traceback
+from datetime import datetime
+
+from settings import JOB_MAX_PARALLEL_STAGES, JOB_STATUS_SAVE_INTERVAL
+from utils.job_context import CURRENT_STAGE, JobCancelled
+
+JOBS_DIRECTORY = "/data/jobs"
+FINISHED_STATUSES = ["done", "failed", "cancelled", "skipped", "interrupted"]
+
+
+def get_job_path(job_id):
+    return os.path.join(JOBS_DIRECTORY, f"{job_id}.json")
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def find_cycle(after):
+    """Names of stages on a cycle of stages running after each other, empty if the stages can be ordered."""
+    visiting, visited = [], set()
+
+    def visit(name):
+        if name in visiting:
+            return visiting[visiting.index(name) :] + [name]
+        if name in visited:
+            return []
+        visiting.append(name)
+        for previous in after[name]:
+            cycle = visit(previous)
+            if cycle:
+                return cycle
+        visiting.pop()
+        visited.add(name)
+        return []
+
+    for name in after:
+        cycle = visit(name)
+        if cycle:
+            return cycle
+    return []
+
+
+def load_pipeline(path):
+    """Name and stages of a pipeline spec file, given in /data or as a full path."""
+    path = path if os.path.isabs(path) else os.path.join("/data", path)
+    with open(path, "r", encoding="utf-8") as f:
+        spec = json.load(f)
+    stages = spec.get("stages") if isinstance(spec, dict) else None
+    if not isinstance(stages, list) or not stages:
+        raise ValueError(f"Pipeline {path} has to be an object with a non empty list of stages")
+    stages = [{"command": stage} if isinstance(stage, str) else stage for stage in stages]
+    names = [stage.get("name", stage.get("command")) for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Stages of pipeline {path} need unique names")
+    for stage in stages:
+        if not stage.get("command"):
+            raise ValueError(f"Every stage of pipeline {path} needs a command")
+        unknown = [name for name in stage.get("after", []) if name not in names]
+        if unknown:
+            raise ValueError(f"Stage {stage.get('name', stage['command'])} runs after unknown stages {unknown}")
+    cycle = find_cycle({name: stage.get("after", []) for name, stage in zip(names, stages)})
+    if cycle:
+        raise ValueError(f"Stages of pipeline {path} wait for each other: {' -> '.join(cycle)}")
+    return spec.get("name", os.path.basename(path)), stages
+
+
+class JobStage:
+    def __init__(self, job, name, command, after):
+        self.job = job
+        self.job_id = job.id
+        self.name = name
+        self.command = command
+        self.after = list(after)
+        self.status = "pending"
+        self.started = None
+        self.finished = None
+        self.items = 0
+        self.error = None
+
+    def is_cancelled(self):
+        return self.job.cancelled.is_set()
+
+    def add_progress(self, items):
+        with self.job.lock:
+            self.items += items
+        self.job.save(throttled=True)
+
+    def to_dict(self):
+        end = self.finished or time.time()
+        elapsed = end - self.started if self.started else 0.0
+        return {
+            "name": self.name,
+            "command": self.command,
+            "after": self.after,
+            "status": self.status,
+            "started": self.started,
+            "finished": self.finished,
+            "seconds": elapsed,
+            "items": self.items,
+            "items_per_second": self.items / elapsed if elapsed > 0 else 0.0,
+            "error": self.error,
+        }
+
+
+class Job:
+    def __init__(self, id, name, stages):
+        self.id = id
+        self.name = name
+        self.created = time.time()
+        self.status = "pending"
+        self.lock = threading.RLock()
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.last_save = 0.0
+        self.stages = [
+            JobStage(self, stage.get("name", stage["command"]), stage["command"], stage.get("after", []))
+            for stage in stages
+        ]
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "id": self.id,
+                "name": self.name,
+                "pid": os.getpid(),
+                "created": self.created,
+                "status": self.status,
+                "stages": [stage.to_dict() for stage in self.stages],
+            }
+
+    def save(self, throttled=False):
+        with self.lock:
+            if throttled and time.time() - self.last_save < JOB_STATUS_SAVE_INTERVAL:
+                return
+            self.last_save = time.time()
+            status = self.to_dict()
+            os.makedirs(JOBS_DIRECTORY, exist_ok=True)
+            path = get_job_path(self.id)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(status, f, indent=2)
+            os.replace(path + ".tmp", path)
+
+
+class JobManager:
+    """
+    Runs jobs in background threads with command_runner, the function running one CLI command.
+    Jobs left running by a process which has exited are marked as interrupted.
+    """
+
+    def __init__(self, command_runner, max_parallel_stages=JOB_MAX_PARALLEL_STAGES):
+        self.command_runner = command_runner
+        self.max_parallel_stages = max_parallel_stages
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.mark_interrupted_jobs()
+
+    def mark_interrupted_jobs(self):
+        if not os.path.exists(JOBS_DIRECTORY):
+            return
+        for entry in os.scandir(JOBS_DIRECTORY):
+            if not entry.name.endswith(".json"):
+                continue
+            with open(entry.path, "r", encoding="utf-8") as f:
+                status = json.load(f)
+            if status["status"] in FINISHED_STATUSES or is_process_alive(status.get("pid", -1)):
+                continue
+            status["status"] = "interrupted"
+            for stage in status["stages"]:
+                if stage["status"] not in FINISHED_STATUSES:
+                    stage["status"] = "interrupted"
+            with open(entry.path, "w", encoding="utf-8") as f:
+                json.dump(status, f, indent=2)
+
+    def get_next_id(self):
+        ids = [int(name.split(".")[0]) for name in os.listdir(JOBS_DIRECTORY) if name.split(".")[0].isdigit()]
+        return max(ids + list(self.jobs) + [0]) + 1
+
+    def submit(self, name, stages):
+        with self.lock:
+            os.makedirs(JOBS_DIRECTORY, exist_ok=True)
+            job = Job(self.get_next_id(), name, stages)
+            self.jobs[job.id] = job
+            job.save()
+        threading.Thread(target=self.run_job, args=(job,), name=f"job-{job.id}", daemon=True).start()
+        print(f"Job {job.id} ({name}) started with {len(job.stages)} stages")
+        return job
+
+    def run_job(self, job):
+        with job.lock:
+            job.status = "running"
+        job.save()
+        running = {}
+        condition = threading.Condition(job.lock)
+
+        def run_stage(stage):
+            CURRENT_STAGE.set(stage)
+            error = None
+            try:
+                self.command_runner(stage.command)
+                status = "cancelled" if job.cancelled.is_set() else "done"
+            except JobCancelled:
+                status = "cancelled"
+            except BaseException as e:
+                traceback.print_exc()
+                status, error = "failed", repr(e)
+            with condition:
+                stage.status, stage.error = status, error
+                stage.finished = time.time()
+                running.pop(stage.name, None)
+                condition.notify_all()
+            job.save()
+            print(f"Stage {stage.name} of job {job.id} {stage.status} in {stage.to_dict()['seconds']:.2f} seconds")
+
+        with condition:
+            while True:
+                pending = [stage for stage in job.stages if stage.status == "pending"]
+                statuses = {stage.name: stage.status for stage in job.stages}
+                for stage in pending:
+                    if job.cancelled.is_set():
+                        stage.status = "cancelled"
+                    elif any(statuses.get(name) in ["failed", "cancelled", "skipped"] for name in stage.after):
+                        stage.status = "skipped"
+                    elif all(statuses.get(name) == "done" for name in stage.after) and len(running) < self.max_parallel_stages:
+                        stage.status = "running"
+                        stage.started = time.time()
+                        running[stage.name] = stage
+                        # Every stage runs in a fresh context, so it sees only its own CURRENT_STAGE
+                        thread = threading.Thread(
+                            target=contextvars.Context().run, args=(run_stage, stage), name=f"job-{job.id}-{stage.name}", daemon=True
+                        )
+                        thread.start()
+                if not running:
+                    # Stages still pending with nothing running wait for each other and could never start
+                    for stage in job.stages:
+                        if stage.status == "pending":
+                            stage.status = "skipped"
+                    break
+                condition.wait()
+
+            statuses = [stage.status for stage in job.stages]
+            if job.cancelled.is_set():
+                job.status = "cancelled"
+            elif any(status in ["failed", "skipped"] for status in statuses):
+                job.status = "failed"
+            else:
+                job.status = "done"
+        job.save()
+        job.finished.set()
+        print(f"Job {job.id} ({job.name}) {job.status}")
+
+    def get_job(self, job_id):
+        job = self.jobs.get(int(job_id))
+        if job is None:
+            raise ValueError(f"Unknown job {job_id} in this process, saved jobs are listed with 'job list'")
+        return job
+
+    def cancel(self, job_id):
+        """Stops starting stages of the job, running ones stop at their next chance and drain their worker tasks."""
+        job = self.get_job(job_id)
+        job.cancelled.set()
+        print(f"Cancelling job {job.id}, waiting for running stages to stop")
+        return job
+
+    def cancel_all(self, wait=True):
+        for job in list(self.jobs.values()):
+            if not job.finished.is_set():
+                job.cancelled.set()
+        if wait:
+            self.wait_all()
+
+    def wait(self, job_id, timeout=None):
+        job = self.get_job(job_id)
+        job.finished.wait(timeout)
+        return job
+
+    def wait_all(self):
+        for job in list(self.jobs.values()):
+            job.finished.wait()
+
+    def print_status(self, job_id=None):
+        if job_id is not None:
+            statuses = [self.get_job(job_id).to_dict()]
+        else:
+            statuses = []
+            if os.path.exists(JOBS_DIRECTORY):
+                for name in sorted(os.listdir(JOBS_DIRECTORY), key=lambda name: int(name.split(".")[0])):
+                    if name.endswith(".json") and name.split(".")[0].isdigit():
+                        job_id = int(name.split(".")[0])
+                        if job_id in self.jobs:
+                            statuses.append(self.jobs[job_id].to_dict())
+                        else:
+                            with open(os.path.join(JOBS_DIRECTORY, name), "r", encoding="utf-8") as f:
+                                statuses.append(json.load(f))
+        for status in statuses:
+            created = datetime.fromtimestamp(status["created"]).isoformat(sep=" ", timespec="seconds")
+            print(f"Job {status['id']} ({status['name']}), created {created}: {status['status']}")
+            for stage in status["stages"]:
+                print(
+                    f"    {stage['name']}: {stage['status']}, {stage['seconds']:.1f} s, "
+                    f"{stage['items']} items ({stage['items_per_second']:.1f}/s)"
+                    + (f", {stage['error']}" if stage["error"] else "")
+                )
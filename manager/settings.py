@@ -1,5 +1,13 @@
 CLEAR_PREPROCESSED = [False]
 
+# Has to match --memory-limit of the memgraph service in docker-compose.yml
+DATABASE_MEMORY_LIMIT_MB = 72000
+
+# Memory available to worker processes of the manager, all available memory if None
+CLIENT_MEMORY_LIMIT_MB = None
+# Expected peak memory of a single worker process
+WORKER_MEMORY_MB = 1000
+
 def toggle_clear_preprocessed():
     global CLEAR_PREPROCESSED
     CLEAR_PREPROCESSED[0] = not CLEAR_PREPROCESSED[0]
@@ -9,4 +17,56 @@ def toggle_clear_preprocessed():
         print('Clearing preprocessed data is off')
         
 def get_clear_preprocessed_value():
-    return CLEAR_PREPROCESSED[0]
\ No newline at end of file
+    return CLEAR_PREPROCESSED[0]
+
+EDGE_OUTPUT_MODES = ["csv", "stream", "stream_csv", "database"]
+EDGE_OUTPUT_MODE = ["csv"]
+
+def set_edge_output_mode(mode):
+    if mode not in EDGE_OUTPUT_MODES:
+        print(f"Unknown edge output mode: '{mode}'. Available options: {', '.join(EDGE_OUTPUT_MODES)}.")
+        return
+    EDGE_OUTPUT_MODE[0] = mode
+    print(f'Edge output mode is {mode}')
+
+def get_edge_output_mode():
+    return EDGE_OUTPUT_MODE[0]
+
+SYMMETRIC_EDGE_LAYOUTS = ["directed", "undirected"]
+SYMMETRIC_EDGE_LAYOUT = ["directed"]
+
+def set_symmetric_edge_layout(layout):
+    if layout not in SYMMETRIC_EDGE_LAYOUTS:
+        print(f"Unknown symmetric edge layout: '{layout}'. Available options: {', '.join(SYMMETRIC_EDGE_LAYOUTS)}.")
+        return
+    SYMMETRIC_EDGE_LAYOUT[0] = layout
+    print(f'Symmetric edge layout is {layout}')
+
+def get_symmetric_edge_layout():
+    return SYMMETRIC_EDGE_LAYOUT[0]
+
+# Disk space for cached query results, least recently used results are removed above it
+QUERY_CACHE_MAX_MB = 2048
+QUERY_CACHE_ENABLED = [True]
+
+def set_query_cache_enabled(enabled):
+    QUERY_CACHE_ENABLED[0] = enabled
+    print(f'Query cache is {"on" if enabled else "off"}')
+
+def get_query_cache_enabled():
+    return QUERY_CACHE_ENABLED[0]
+
+# HTTP query service, the port is published in docker-compose.yml
+QUERY_SERVICE_PORT = 6000
+# Threads running queries of the service, queries of different types run concurrently
+QUERY_SERVICE_THREADS = 8
+# Requests of one query type waiting or running at once, further ones are rejected
+QUERY_SERVICE_MAX_QUEUED = 16
+
+# Stages of one background job running at once, when they do not depend on each other
+JOB_MAX_PARALLEL_STAGES = 4
+# Seconds between saves of the status of a running job
+JOB_STATUS_SAVE_INTERVAL = 2.0
+
+# Has to match --data-directory of the memgraph service in docker-compose.yml, snapshots are created in it
+DATABASE_DATA_DIRECTORY = "/data/memgraph"
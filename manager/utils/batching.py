@@ -0,0 +1,128 @@
+import fcntl
+import json
+import os
+import pickle
+import threading
+
+BATCH_SETTINGS_FILE = "/data/batch_sizes.json"
+BATCH_SETTINGS_LOCK = threading.Lock()
+PAYLOAD_SAMPLE_SIZE = 20
+
+
+def load_batch_settings():
+    if not os.path.exists(BATCH_SETTINGS_FILE):
+        return {}
+    with open(BATCH_SETTINGS_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_batch_settings(key, settings):
+    """
+    Stores settings of one key. Concurrent creators and CLI processes update the file
+    under a lock, so that none of them overwrites keys saved by another.
+    """
+    temporary_file = f"{BATCH_SETTINGS_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with BATCH_SETTINGS_LOCK, open(BATCH_SETTINGS_FILE + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        all_settings = load_batch_settings()
+        all_settings[key] = settings
+        with open(temporary_file, "w", encoding="utf-8") as f:
+            json.dump(all_settings, f, indent=4)
+        os.replace(temporary_file, BATCH_SETTINGS_FILE)
+
+
+class BatchSizeController:
+    """
+    Chooses the number of records sent to a worker in one batch.
+
+    The batch size follows the measured cost of processing one record, so that a batch takes
+    about target_seconds of worker time, and is bounded by the pickled size of its records.
+    When workers are idle, batches are made longer to reduce the dispatching overhead per record,
+    and when they are fully busy, the target is slowly lowered to keep batches short.
+    Tuned values are stored under key and used as the starting point of the next run.
+    """
+
+    def __init__(
+        self,
+        key=None,
+        initial_size=1000,
+        target_seconds=0.5,
+        max_payload_bytes=8 * 2**20,
+        min_size=1,
+        max_size=1_000_000,
+        smoothing=0.3,
+    ):
+        stored = load_batch_settings().get(key, {}) if key is not None else {}
+        self.key = key
+        self.size = stored.get("chunk_size", initial_size)
+        self.cost_per_record = stored.get("cost_per_record")
+        self.bytes_per_record = stored.get("bytes_per_record")
+        self.target_seconds = stored.get("target_seconds", target_seconds)
+        self.max_payload_bytes = max_payload_bytes
+        self.min_size = min_size
+        self.max_size = max_size
+        self.smoothing = smoothing
+        self.min_target_seconds = target_seconds / 4
+        self.max_target_seconds = target_seconds * 4
+        self.busy_seconds = 0.0
+        self.wall_seconds = 0.0
+
+    def _average(self, previous, value):
+        if previous is None:
+            return value
+        return (1 - self.smoothing) * previous + self.smoothing * value
+
+    def measure_payload(self, batch):
+        if not batch:
+            return
+        sample = batch[:PAYLOAD_SAMPLE_SIZE]
+        self.bytes_per_record = self._average(self.bytes_per_record, len(pickle.dumps(sample)) / len(sample))
+
+    def record_batch(self, records, elapsed):
+        """Updates the cost per record with a batch of records processed by a worker in elapsed seconds."""
+        if records > 0:
+            self.cost_per_record = self._average(self.cost_per_record, elapsed / records)
+
+    def record_utilization(self, busy_seconds, wall_seconds, workers):
+        """Adjusts the target batch duration to the share of time the workers were busy."""
+        if wall_seconds <= 0:
+            return
+        self.busy_seconds += busy_seconds
+        self.wall_seconds += wall_seconds * workers
+        utilization = busy_seconds / (wall_seconds * workers)
+        if utilization < 0.8:
+            self.target_seconds = min(self.target_seconds * 1.5, self.max_target_seconds)
+        elif utilization > 0.95:
+            self.target_seconds = max(self.target_seconds / 1.2, self.min_target_seconds)
+
+    def next_size(self):
+        size = self.size
+        if self.cost_per_record:
+            size = self.target_seconds / self.cost_per_record
+        if self.bytes_per_record:
+            size = min(size, self.max_payload_bytes / self.bytes_per_record)
+        # Changes are limited to a factor of 2 per batch, so that a single outlier does not dominate
+        size = min(max(size, self.size / 2), self.size * 2)
+        self.size = int(min(max(size, self.min_size), self.max_size))
+        return self.size
+
+    def get_idle_share(self):
+        if self.wall_seconds <= 0:
+            return 0.0
+        return max(0.0, 1 - self.busy_seconds / self.wall_seconds)
+
+    def save(self):
+        print(
+            f"Batch size {self.size}, {self.cost_per_record or 0:.6f} s per record, "
+            f"{self.bytes_per_record or 0:.0f} bytes per record, workers idle {self.get_idle_share():.0%} of the time"
+        )
+        if self.key is not None:
+            save_batch_settings(
+                self.key,
+                {
+                    "chunk_size": self.size,
+                    "cost_per_record": self.cost_per_record,
+                    "bytes_per_record": self.bytes_per_record,
+                    "target_seconds": self.target_seconds,
+                },
+            )
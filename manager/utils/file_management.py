@@ -1,7 +1,10 @@
 import os
+import csv
+import io
 import pandas as pd
 import shutil
 import gc
+from pathlib import Path
 
 
 def find_file(name):
@@ -106,6 +109,103 @@ def split_csvs_in_directory(input_dir, output_dir):
     return all_split_files
 
 
+# A worker starts a new csv file after this many rows or bytes
+CSV_TARGET_ROWS = 500_000
+CSV_TARGET_BYTES = 64 * 2**20
+
+
+class CoalescingCsvWriter:
+    """
+    Appends rows to csv files in a directory, starting a new file when the current one
+    reaches target_rows rows or target_bytes bytes. Files are written with a '.part' suffix
+    and renamed when complete, so only complete files match '*.csv'.
+    The current file is reopened for every write, so that a writer can be left open in a
+    long lived worker process, and its last file completed by finish_csv_files.
+    """
+
+    def __init__(self, output_directory, headers, target_rows=CSV_TARGET_ROWS, target_bytes=CSV_TARGET_BYTES, prefix=None):
+        self.output_directory = output_directory
+        self.headers = headers
+        self.target_rows = target_rows
+        self.target_bytes = target_bytes
+        self.prefix = prefix or f"chunk_{os.getpid()}"
+        self.file_index = 0
+        self.path = None
+        self.rows = 0
+        self.bytes = 0
+
+    def _open(self):
+        if self.path is not None and os.path.exists(self.path + ".part"):
+            return open(self.path + ".part", "a", newline="")
+        self.file_index += 1
+        self.path = os.path.join(self.output_directory, f"{self.prefix}_{self.file_index:05d}.csv")
+        self.rows = 0
+        self.bytes = 0
+        file = open(self.path + ".part", "w", newline="")
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(self.headers)
+        self._flush(file, buffer)
+        return file
+
+    def _flush(self, file, buffer):
+        data = buffer.getvalue()
+        file.write(data)
+        self.bytes += len(data)
+
+    def _finish(self, file):
+        file.close()
+        os.replace(self.path + ".part", self.path)
+        self.path = None
+
+    def write_rows(self, rows):
+        file = None
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            if file is None:
+                file = self._open()
+            writer.writerow(row)
+            self.rows += 1
+            if self.rows >= self.target_rows or self.bytes + buffer.tell() >= self.target_bytes:
+                self._flush(file, buffer)
+                self._finish(file)
+                file = None
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+        if file is not None:
+            self._flush(file, buffer)
+            file.close()
+
+
+WORKER_CSV_WRITERS = {}
+
+
+def write_rows_to_worker_csv(output_directory, headers, rows):
+    """Appends rows to the csv files of the current process in output_directory."""
+    writer = WORKER_CSV_WRITERS.get(output_directory)
+    if writer is None:
+        writer = WORKER_CSV_WRITERS[output_directory] = CoalescingCsvWriter(output_directory, headers)
+    writer.write_rows(rows)
+
+
+def finish_csv_files(output_directory):
+    """Completes the last csv files of all writers, once all rows were written to output_directory."""
+    for part_file in Path(output_directory).glob("*.csv.part"):
+        os.replace(part_file, part_file.with_suffix(""))
+    report_csv_files(output_directory)
+
+
+def report_csv_files(output_directory):
+    sizes = [file.stat().st_size for file in Path(output_directory).glob("*.csv")]
+    if not sizes:
+        print(f"No csv files written to {output_directory}")
+        return
+    print(
+        f"Written {len(sizes)} csv files to {output_directory}, {sum(sizes) / 2**20:.2f} MB in total, "
+        f"smallest {min(sizes) / 2**20:.2f} MB, largest {max(sizes) / 2**20:.2f} MB"
+    )
+
+
 if __name__ == "__main__":
     split_files = split_csvs_in_directory("data", "data/out")
     print(split_files)
@@ -0,0 +1,146 @@
+import numpy as np
+import shapely
+from shapely import STRtree
+
+
+def points_within_distance(geometries, xs, ys, distance):
+    """
+    Pairs geometries with all points not further than distance from them.
+
+    Parameters:
+        geometries (np.ndarray): Array of shapely geometries.
+        xs (np.ndarray): X coordinates of the points.
+        ys (np.ndarray): Y coordinates of the points.
+        distance (float): Maximum distance between a geometry and a point.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Geometry indices, point indices and distances of every matching pair.
+    """
+    points = shapely.points(np.asarray(xs, dtype=float), np.asarray(ys, dtype=float))
+    tree = STRtree(points)
+    geometry_idx, point_idx = tree.query(
+        geometries, predicate="dwithin", distance=distance
+    )
+    distances = shapely.distance(geometries[geometry_idx], points[point_idx])
+    return geometry_idx, point_idx, distances
+
+
+def linestring_segments(geometries):
+    """
+    Explodes (multi)linestrings into arrays of their segments.
+
+    Parameters:
+        geometries (np.ndarray): Array of shapely (multi)linestrings.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Segment start points, segment end points and indices of the geometries they belong to.
+    """
+    parts, part_idx = shapely.get_parts(geometries, return_index=True)
+    coords, coord_idx = shapely.get_coordinates(parts, return_index=True)
+    same_part = coord_idx[:-1] == coord_idx[1:]
+    starts = coords[:-1][same_part]
+    ends = coords[1:][same_part]
+    owners = part_idx[coord_idx[:-1][same_part]]
+    return starts, ends, owners
+
+
+def segment_boxes(starts, ends):
+    return shapely.box(
+        np.minimum(starts[:, 0], ends[:, 0]),
+        np.minimum(starts[:, 1], ends[:, 1]),
+        np.maximum(starts[:, 0], ends[:, 0]),
+        np.maximum(starts[:, 1], ends[:, 1]),
+    )
+
+
+def segment_lines(starts, ends):
+    return shapely.linestrings(np.stack([starts, ends], axis=1))
+
+
+def nearest_segment_angles(geometries, reference, max_distance, return_distances=False):
+    """
+    Pairs every segment of geometries with the nearest segment of reference geometries
+    not further than max_distance, the first one in order among equally near segments.
+
+    Parameters:
+        geometries (np.ndarray): Array of shapely (multi)linestrings.
+        reference (np.ndarray): Array of shapely (multi)linestrings.
+        max_distance (float): Maximum distance between paired segments.
+        return_distances (bool): Whether to also return distances between paired segments.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Indices of geometries the segments belong to and angles between paired segments,
+        NaN for segments without a segment of reference near enough or of (almost) zero length.
+        With return_distances, also distances between paired segments, inf for segments without a pair.
+    """
+    starts, ends, owners = linestring_segments(geometries)
+    reference_starts, reference_ends, _ = linestring_segments(reference)
+    angles = np.full(len(starts), np.nan)
+    distances = np.full(len(starts), np.inf)
+    if len(starts) == 0 or len(reference_starts) == 0:
+        return (owners, angles, distances) if return_distances else (owners, angles)
+
+    tree = STRtree(segment_lines(reference_starts, reference_ends))
+    (idx, reference_idx), pair_distances = tree.query_nearest(
+        segment_lines(starts, ends), max_distance=max_distance, all_matches=True, return_distance=True
+    )
+    order = np.lexsort((reference_idx, idx))
+    idx, reference_idx, pair_distances = idx[order], reference_idx[order], pair_distances[order]
+    first = np.r_[True, idx[1:] != idx[:-1]] if len(idx) > 0 else np.empty(0, dtype=bool)
+    idx, reference_idx = idx[first], reference_idx[first]
+
+    angles[idx] = segment_angles(
+        reference_ends[reference_idx] - reference_starts[reference_idx], ends[idx] - starts[idx]
+    )
+    distances[idx] = pair_distances[first]
+    return (owners, angles, distances) if return_distances else (owners, angles)
+
+
+def segment_angles(vectors1, vectors2):
+    """
+    Angles in degrees between pairs of vectors, NaN where one of them has (almost) zero length.
+    """
+    dot_product = np.einsum("ij,ij->i", vectors1, vectors2)
+    magnitude1 = np.linalg.norm(vectors1, axis=1)
+    magnitude2 = np.linalg.norm(vectors2, axis=1)
+    degenerate = (magnitude1 <= 1e-6) | (magnitude2 <= 1e-6)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cos_theta = np.clip(dot_product / (magnitude1 * magnitude2), -1, 1)
+    angles = np.degrees(np.arccos(cos_theta))
+    angles[degenerate] = np.nan
+    return angles
+
+
+def _orientation(a, b, c):
+    return (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (b[:, 1] - a[:, 1]) * (
+        c[:, 0] - a[:, 0]
+    )
+
+
+def segment_crossings(geometries1, geometries2):
+    """
+    Finds all points where segments of geometries1 cross segments of geometries2.
+    Segments cross when their interiors intersect in a single point, as in shapely's crosses.
+
+    Parameters:
+        geometries1 (np.ndarray): Array of shapely (multi)linestrings.
+        geometries2 (np.ndarray): Array of shapely (multi)linestrings.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Indices into geometries1, indices into geometries2 and crossing angles, one entry per crossing point.
+    """
+    starts1, ends1, owners1 = linestring_segments(geometries1)
+    starts2, ends2, owners2 = linestring_segments(geometries2)
+
+    tree = STRtree(segment_boxes(starts2, ends2))
+    idx1, idx2 = tree.query(segment_boxes(starts1, ends1), predicate="intersects")
+
+    a, b = starts1[idx1], ends1[idx1]
+    c, d = starts2[idx2], ends2[idx2]
+    crossing = (_orientation(a, b, c) * _orientation(a, b, d) < 0) & (
+        _orientation(c, d, a) * _orientation(c, d, b) < 0
+    )
+    idx1, idx2 = idx1[crossing], idx2[crossing]
+
+    angles = segment_angles(ends1[idx1] - starts1[idx1], ends2[idx2] - starts2[idx2])
+    return owners1[idx1], owners2[idx2], angles
@@ -0,0 +1,181 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely import wkt
+
+GEOMETRY_STORE_DIRECTORY = "/data/geometry_store"
+INDEX_DTYPE = np.dtype([("id", np.int64), ("offset", np.int64), ("length", np.int64)])
+
+
+def get_store_paths(name):
+    return (
+        os.path.join(GEOMETRY_STORE_DIRECTORY, f"{name}.wkb"),
+        os.path.join(GEOMETRY_STORE_DIRECTORY, f"{name}.index.npy"),
+    )
+
+
+def get_store_source_path(name):
+    return os.path.join(GEOMETRY_STORE_DIRECTORY, f"{name}.source.json")
+
+
+def get_store_source(name):
+    """Source directory the store was built from, None for stores built before it was recorded."""
+    path = get_store_source_path(name)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["source_directory"]
+
+
+def build_geometry_store(name, source_directory=None):
+    """
+    Builds a geometry store from preprocessed csv chunks with 'id' and 'wkt' columns.
+
+    Geometries are saved as concatenated WKB blobs, and their ids, offsets and lengths
+    as an index sorted by id, so that they can be read by id through a memory map.
+
+    Parameters:
+        name (str): Name of the store, e.g. 'roads'.
+        source_directory (str): Directory with preprocessed csv chunks, '/data/<name>' by default.
+    """
+    source_directory = source_directory or os.path.join("/data", name)
+    data_path, index_path = get_store_paths(name)
+    os.makedirs(GEOMETRY_STORE_DIRECTORY, exist_ok=True)
+
+    index_parts = []
+    offset = 0
+    with open(data_path + ".tmp", "wb") as data_file:
+        for file in sorted(Path(source_directory).glob("*.csv")):
+            chunk = pd.read_csv(file, usecols=["id", "wkt"])
+            blobs = shapely.to_wkb(wkt.loads(chunk["wkt"].to_numpy(dtype=object)))
+            lengths = np.fromiter((len(blob) for blob in blobs), dtype=np.int64, count=len(blobs))
+
+            index = np.empty(len(blobs), dtype=INDEX_DTYPE)
+            index["id"] = chunk["id"].to_numpy(dtype=np.int64)
+            index["offset"] = offset + np.cumsum(lengths) - lengths
+            index["length"] = lengths
+            index_parts.append(index)
+
+            data_file.write(b"".join(blobs))
+            offset += int(lengths.sum())
+
+    index = np.concatenate(index_parts) if index_parts else np.empty(0, dtype=INDEX_DTYPE)
+    index = index[np.sort(np.unique(index["id"], return_index=True)[1])]
+    index.sort(order="id")
+    np.save(index_path + ".tmp.npy", index)
+
+    os.replace(data_path + ".tmp", data_path)
+    os.replace(index_path + ".tmp.npy", index_path)
+    with open(get_store_source_path(name) + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"source_directory": os.path.abspath(source_directory)}, f)
+    os.replace(get_store_source_path(name) + ".tmp", get_store_source_path(name))
+    GEOMETRY_STORES.pop(name, None)
+    print(f"Geometry store '{name}' built with {len(index)} geometries")
+
+
+def ensure_geometry_store(name, source_directory=None):
+    """
+    Builds the geometry store if it is missing or older than its preprocessed source data.
+    Without a source directory, the store is compared with the directory it was built from,
+    e.g. /data/my_roads for roads imported from my_roads.csv, and kept if that directory is gone.
+    """
+    data_path, index_path = get_store_paths(name)
+    exists = os.path.exists(data_path) and os.path.exists(index_path)
+    if source_directory is None:
+        source_directory = (get_store_source(name) if exists else None) or os.path.join("/data", name)
+        if exists and not os.path.exists(source_directory):
+            return
+    if not exists or os.path.getmtime(index_path) < os.path.getmtime(source_directory):
+        build_geometry_store(name, source_directory)
+
+
+class GeometryStore:
+    """
+    Read-only access to geometries by node id.
+
+    Both files are memory mapped, so worker processes forked after the store was opened
+    share its pages. WKB is parsed into shapely objects only when a geometry is requested,
+    and parsed geometries are kept in a bounded per-process cache.
+    """
+
+    def __init__(self, name, max_cached=100_000):
+        data_path, index_path = get_store_paths(name)
+        self.name = name
+        self.version = os.stat(index_path).st_mtime_ns
+        self.index = np.load(index_path, mmap_mode="r")
+        self.data = (
+            np.memmap(data_path, dtype=np.uint8, mode="r")
+            if os.path.getsize(data_path) > 0
+            else np.empty(0, dtype=np.uint8)
+        )
+        self.max_cached = max_cached
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _positions(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(self.index["id"], ids)
+        found = positions < len(self.index)
+        found[found] = self.index["id"][positions[found]] == ids[found]
+        if not found.all():
+            raise KeyError(f"Ids not found in geometry store '{self.name}': {ids[~found][:10].tolist()}")
+        return positions
+
+    def get_many(self, ids):
+        """Returns an array of shapely geometries for the given ids."""
+        ids = [int(id) for id in ids]
+        geometries = np.empty(len(ids), dtype=object)
+        missing = []
+        for i, id in enumerate(ids):
+            cached = self._cache.get(id)
+            if cached is None:
+                missing.append(i)
+            else:
+                geometries[i] = cached
+        if not missing:
+            return geometries
+
+        positions = self._positions([ids[i] for i in missing])
+        offsets = self.index["offset"][positions]
+        lengths = self.index["length"][positions]
+        blobs = np.empty(len(missing), dtype=object)
+        blobs[:] = [
+            self.data[offset : offset + length].tobytes()
+            for offset, length in zip(offsets, lengths)
+        ]
+        parsed = shapely.from_wkb(blobs)
+
+        if len(self._cache) + len(missing) > self.max_cached:
+            self._cache.clear()
+        for i, geometry in zip(missing, parsed):
+            geometries[i] = geometry
+            self._cache[ids[i]] = geometry
+        return geometries
+
+    def get(self, id):
+        return self.get_many([id])[0]
+
+
+GEOMETRY_STORES = {}
+
+
+def get_geometry_store(name):
+    """
+    Opens the geometry store once per process, and again when it was rebuilt,
+    as long lived worker processes may outlive a version of the store.
+    """
+    store = GEOMETRY_STORES.get(name)
+    if store is None or store.version != os.stat(get_store_paths(name)[1]).st_mtime_ns:
+        store = GEOMETRY_STORES[name] = GeometryStore(name)
+    return store
+
+
+def open_existing_geometry_stores():
+    for index_file in Path(GEOMETRY_STORE_DIRECTORY).glob("*.index.npy"):
+        get_geometry_store(index_file.name[: -len(".index.npy")])
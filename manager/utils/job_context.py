@@ -0,0 +1,37 @@
+import contextvars
+
+
+class JobCancelled(Exception):
+    """Raised in a stage of a cancelled job, at the next point where it can stop cleanly."""
+
+
+# Stage of a background job run by the current thread, copied to threads started by the stage
+CURRENT_STAGE = contextvars.ContextVar("current_stage", default=None)
+
+
+def check_cancelled():
+    stage = CURRENT_STAGE.get()
+    if stage is not None and stage.is_cancelled():
+        raise JobCancelled(f"Stage {stage.name} of job {stage.job_id} was cancelled")
+
+
+def report_failure(message):
+    """
+    Reports a command which did not do its work. The CLI only prints it,
+    a stage of a background job raises it, so that the stage is marked as failed.
+    """
+    if CURRENT_STAGE.get() is not None:
+        raise RuntimeError(message)
+    print(message)
+
+
+def report_progress(items):
+    """Counts items processed by the stage of the current thread, e.g. records or finished tasks."""
+    stage = CURRENT_STAGE.get()
+    if stage is not None:
+        stage.add_progress(items)
+
+
+def submit_in_context(executor, function, *args):
+    """Submits a function to a thread pool, keeping the stage of the current thread."""
+    return executor.submit(contextvars.copy_context().run, function, *args)
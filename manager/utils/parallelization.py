@@ -1,23 +1,198 @@
+import concurrent.futures
 import multiprocessing
-import concurrent
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+from settings import CLIENT_MEMORY_LIMIT_MB, WORKER_MEMORY_MB
+from utils.job_context import check_cancelled, report_progress
+
+# Every worker may hold a database connection, so the pool size is bounded regardless of the cores
+MAX_WORKERS = 29
+
+
+def get_available_memory_mb():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_worker_capacity():
+    """Number of worker processes fitting the available cores and the client memory budget."""
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    memory = CLIENT_MEMORY_LIMIT_MB or get_available_memory_mb()
+    capacity = cores
+    if memory is not None:
+        capacity = min(capacity, memory // WORKER_MEMORY_MB)
+    return max(1, min(capacity, MAX_WORKERS))
+
+
+def warm_up_worker():
+    """
+    Opens existing geometry stores once per worker process. Other modules are imported
+    by workers with the first task which needs them, as tasks are sent by module and function name.
+    """
+    from utils.geometry_store import open_existing_geometry_stores
+
+    open_existing_geometry_stores()
+
+
+class Stage:
+    """Part of the work submitted to the shared worker pool by one caller."""
+
+    def __init__(self, manager, requested):
+        self.manager = manager
+        self.requested = requested
+        self.running = 0
+
+    def has_capacity(self):
+        with self.manager.condition:
+            return self.running < self.manager.get_share(self)
+
+    def submit(self, function, *args):
+        """
+        Submits a task, waiting until the stage has less running tasks than its share of workers.
+        Raises JobCancelled if the background job running the stage was cancelled.
+        """
+        check_cancelled()
+        with self.manager.condition:
+            while self.running >= self.manager.get_share(self):
+                self.manager.condition.wait()
+            self.running += 1
+        try:
+            future = self.manager.submit(function, *args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future=None):
+        with self.manager.condition:
+            self.running -= 1
+            self.manager.condition.notify_all()
+
+
+class ResourceManager:
+    """
+    Owns one pool of warm worker processes shared by all stages of the program.
+
+    Workers are started once, with geometry stores opened,
+    and kept alive between stages. Concurrent stages get max-min fair shares of the workers:
+    stages requesting less than an equal share keep their request, and the rest is split equally.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.RLock())
+        self.executor = None
+        self.capacity = None
+        self.stages = []
+
+    def start(self, mp_context=None):
+        """Starts the pool, by default forking workers, which should happen before other threads start."""
+        with self.condition:
+            if self.executor is None:
+                self.capacity = get_worker_capacity()
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.capacity, mp_context=mp_context, initializer=warm_up_worker
+                )
+                # Submitting a task starts all workers at once
+                self.executor.submit(os.getpid)
+                print(f"Started {self.capacity} worker processes")
+            return self.executor
+
+    def get_capacity(self):
+        self.start()
+        return self.capacity
+
+    def shutdown(self):
+        with self.condition:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+                self.executor = None
+
+    def submit(self, function, *args):
+        executor = self.start()
+        try:
+            return executor.submit(function, *args)
+        except BrokenProcessPool:
+            # Other threads may hold locks by now, which forked workers would inherit held,
+            # so the new workers are started from a clean forkserver process instead
+            print("Worker pool is broken, e.g. a worker was killed for lack of memory, restarting it with forkserver")
+            with self.condition:
+                if self.executor is executor:
+                    self.executor = None
+            return self.start(multiprocessing.get_context("forkserver")).submit(function, *args)
+
+    def get_share(self, stage):
+        with self.condition:
+            remaining = self.capacity
+            stages = sorted(self.stages, key=lambda other: other.requested)
+            for i, other in enumerate(stages):
+                share = max(1, min(other.requested, remaining // (len(stages) - i)))
+                if other is stage:
+                    return share
+                remaining -= share
+            return max(1, min(stage.requested, self.capacity))
+
+    @contextmanager
+    def stage(self, requested):
+        self.start()
+        stage = Stage(self, requested)
+        with self.condition:
+            self.stages.append(stage)
+            self.condition.notify_all()
+        try:
+            yield stage
+        finally:
+            with self.condition:
+                self.stages.remove(stage)
+                self.condition.notify_all()
+
+
+RESOURCE_MANAGER = ResourceManager()
 
 
 def execute_with_pool(function, data, max_processes=10):
-    with multiprocessing.Pool(min(len(data), max_processes)) as pool:
-        pool.starmap(function, [(q,) for q in data])
-        pool.close()
-        pool.join()
+    for _ in parrarelize_processes(function, [(q,) for q in data], n_executors=max_processes):
+        pass
 
 
 def parrarelize_processes(function, args_list, n_executors=5):
+    """
+    Runs function(*args) for every args in args_list on the shared worker pool,
+    with at most n_executors tasks running at once, and yields (index, result) as they complete.
+    """
     assert n_executors < 30
-    with concurrent.futures.ProcessPoolExecutor(
-        max_workers=min(n_executors, len(args_list))
-    ) as executor:
-        future_to_id = {
-            executor.submit(function, *args): id for id, args in enumerate(args_list)
-        }
-        for future in concurrent.futures.as_completed(future_to_id):
-            id = future_to_id[future]
-            yield (id, future.result())
-            del future_to_id[future]
+    with RESOURCE_MANAGER.stage(n_executors) as stage:
+        future_to_id = {}
+        args_iterator = enumerate(args_list)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and (not future_to_id or stage.has_capacity()):
+                    item = next(args_iterator, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    id, args = item
+                    future_to_id[stage.submit(function, *args)] = id
+                if not future_to_id:
+                    break
+                done, _ = concurrent.futures.wait(
+                    future_to_id, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    id = future_to_id.pop(future)
+                    result = future.result()
+                    report_progress(1)
+                    yield (id, result)
+        finally:
+            for future in future_to_id:
+                future.cancel()
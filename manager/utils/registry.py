@@ -0,0 +1,72 @@
+import importlib
+import importlib.util
+import inspect
+from collections.abc import Mapping
+
+
+class LazyRegistry(Mapping):
+    """
+    Functions by name, registered with the module and attribute holding them.
+    A module is imported when one of its functions is first used, so commands
+    only pay for the imports they need. Metadata of the functions is available without imports.
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.entries = {}
+        self.functions = {}
+
+    def register(self, name, module, attribute, parameters=(), optional_parameters=(), dependencies=(), **metadata):
+        """
+        Registers a function. parameters are its required parameters and optional_parameters
+        the ones with defaults, dependencies are packages its module imports.
+        """
+        self.entries[name] = {
+            "name": name,
+            "module": module,
+            "attribute": attribute,
+            "parameters": list(parameters),
+            "optional_parameters": list(optional_parameters),
+            "dependencies": list(dependencies),
+            **metadata,
+        }
+
+    def get_metadata(self, name):
+        return self.entries[name]
+
+    def is_loaded(self, name):
+        return name in self.functions
+
+    def __getitem__(self, name):
+        function = self.functions.get(name)
+        if function is None:
+            entry = self.entries[name]
+            missing = [package for package in entry["dependencies"] if importlib.util.find_spec(package) is None]
+            if missing:
+                raise ImportError(f"{self.kind.capitalize()} {name} requires missing packages: {', '.join(missing)}")
+            module = importlib.import_module(entry["module"])
+            function = getattr(module, entry["attribute"])
+            self.check_signature(entry, function)
+            self.functions[name] = function
+        return function
+
+    def check_signature(self, entry, function):
+        """Checks that registered parameters match the signature, as they are used before the function is imported."""
+        signature = inspect.signature(function).parameters.values()
+        parameters = [parameter.name for parameter in signature if parameter.default is inspect.Parameter.empty]
+        optional_parameters = [parameter.name for parameter in signature if parameter.default is not inspect.Parameter.empty]
+        if (parameters, optional_parameters) != (entry["parameters"], entry["optional_parameters"]):
+            raise TypeError(
+                f"{self.kind.capitalize()} {entry['name']} is registered with parameters {entry['parameters']} "
+                f"and optional parameters {entry['optional_parameters']}, "
+                f"but {entry['attribute']} takes {parameters} and optional {optional_parameters}"
+            )
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
@@ -0,0 +1,25 @@
+#!/bin/bash
+# Runs memgraph with the given arguments and restarts it when the manager requests it,
+# to recover a snapshot restored into the data directory. Only restarts requested by the manager
+# recover data, so a later start of the container begins with an empty database as before.
+RESTART_REQUEST=/data/memgraph/restart_request
+recovery=""
+
+trap 'kill -TERM "$pid" 2>/dev/null; wait "$pid"; exit $?' TERM INT
+
+while true; do
+    rm -f "$RESTART_REQUEST"
+    /usr/lib/memgraph/memgraph "$@" $recovery &
+    pid=$!
+    while kill -0 "$pid" 2>/dev/null && [ ! -f "$RESTART_REQUEST" ]; do
+        sleep 1
+    done
+    if [ ! -f "$RESTART_REQUEST" ]; then
+        wait "$pid"
+        exit $?
+    fi
+    echo "Restarting memgraph to recover a snapshot"
+    recovery="--data-recovery-on-startup=true"
+    kill -TERM "$pid"
+    wait "$pid"
+done
@@ -0,0 +1,174 @@
+"""
+Spatial predicates evaluated inside Memgraph.
+
+Geometries are read from the geometry stores built by the manager in /data/geometry_store,
+parsed once and cached for the lifetime of the database process.
+Procedures take the id of a node, which is the key of its geometry in a store, and lists
+describing its candidates, and yield indices into these lists for candidates passing the predicate,
+so that the calling query can create relationships with them.
+"""
+import os
+import sys
+
+import mgp
+import numpy as np
+import shapely
+
+# utils/geometry.py of the manager is mounted here, see docker-compose.yml
+sys.path.insert(0, "/query_modules_lib")
+from geometry import points_within_distance, segment_crossings  # noqa: E402
+
+GEOMETRY_STORE_DIRECTORY = "/data/geometry_store"
+MAX_CACHED = 1_000_000
+
+
+class GeometryStore:
+    """Read-only access to geometries by node id, see utils/geometry_store.py of the manager."""
+
+    def __init__(self, name):
+        self.index_path = os.path.join(GEOMETRY_STORE_DIRECTORY, f"{name}.index.npy")
+        data_path = os.path.join(GEOMETRY_STORE_DIRECTORY, f"{name}.wkb")
+        self.version = os.stat(self.index_path).st_mtime_ns
+        self.index = np.load(self.index_path, mmap_mode="r")
+        self.data = (
+            np.memmap(data_path, dtype=np.uint8, mode="r")
+            if os.path.getsize(data_path) > 0
+            else np.empty(0, dtype=np.uint8)
+        )
+        self.geometries = {}
+        self.polygons = {}
+
+    def get(self, id):
+        geometry = self.geometries.get(id)
+        if geometry is None:
+            position = np.searchsorted(self.index["id"], id)
+            if position >= len(self.index) or self.index["id"][position] != id:
+                raise KeyError(f"Id {id} not found in geometry store")
+            offset, length = int(self.index["offset"][position]), int(self.index["length"][position])
+            geometry = shapely.from_wkb(self.data[offset : offset + length].tobytes())
+            if len(self.geometries) >= MAX_CACHED:
+                self.geometries.clear()
+            self.geometries[id] = geometry
+        return geometry
+
+    def get_many(self, ids):
+        geometries = np.empty(len(ids), dtype=object)
+        geometries[:] = [self.get(id) for id in ids]
+        return geometries
+
+    def get_polygons(self, id):
+        """Prepared polygons enclosed by the parts of a border (multi)linestring."""
+        polygons = self.polygons.get(id)
+        if polygons is None:
+            polygons = np.array([shapely.Polygon(part.coords) for part in shapely.get_parts(self.get(id))])
+            shapely.prepare(polygons)
+            if len(self.polygons) >= MAX_CACHED:
+                self.polygons.clear()
+            self.polygons[id] = polygons
+        return polygons
+
+
+STORES = {}
+
+
+def get_store(name):
+    store = STORES.get(name)
+    path = os.path.join(GEOMETRY_STORE_DIRECTORY, f"{name}.index.npy")
+    if store is None or store.version != os.stat(path).st_mtime_ns:
+        store = STORES[name] = GeometryStore(name)
+    return store
+
+
+@mgp.read_proc
+def within_border(
+    context: mgp.ProcCtx,
+    store: str,
+    border_id: int,
+    xs: mgp.List[mgp.Number],
+    ys: mgp.List[mgp.Number],
+) -> mgp.Record(index=int):
+    """Points (xs[i], ys[i]) within the area enclosed by the border."""
+    if not xs:
+        return []
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    within = np.zeros(len(xs), dtype=bool)
+    for polygon in get_store(store).get_polygons(border_id):
+        within |= shapely.contains_xy(polygon, xs, ys)
+    return [mgp.Record(index=int(i)) for i in np.flatnonzero(within)]
+
+
+@mgp.read_proc
+def adjacent(
+    context: mgp.ProcCtx,
+    store: str,
+    id: int,
+    candidate_ids: mgp.List[int],
+) -> mgp.Record(index=int):
+    """Candidates whose geometries touch or overlap the geometry of id."""
+    if not candidate_ids:
+        return []
+    geometry_store = get_store(store)
+    geometry = geometry_store.get(id)
+    candidates = geometry_store.get_many(candidate_ids)
+    matching = shapely.touches(geometry, candidates) | shapely.overlaps(geometry, candidates)
+    return [mgp.Record(index=int(i)) for i in np.flatnonzero(matching)]
+
+
+@mgp.read_proc
+def within_distance(
+    context: mgp.ProcCtx,
+    store: str,
+    id: int,
+    candidate_ids: mgp.List[int],
+    distance: mgp.Number,
+) -> mgp.Record(index=int, distance=float):
+    """Candidates whose geometries are not further than distance from the geometry of id."""
+    if not candidate_ids:
+        return []
+    geometry_store = get_store(store)
+    distances = shapely.distance(geometry_store.get(id), geometry_store.get_many(candidate_ids))
+    return [
+        mgp.Record(index=int(i), distance=float(distances[i]))
+        for i in np.flatnonzero(distances <= distance)
+    ]
+
+
+@mgp.read_proc
+def points_within(
+    context: mgp.ProcCtx,
+    store: str,
+    id: int,
+    xs: mgp.List[mgp.Number],
+    ys: mgp.List[mgp.Number],
+    distance: mgp.Number,
+) -> mgp.Record(index=int, distance=float):
+    """Points (xs[i], ys[i]) not further than distance from the geometry of id."""
+    if not xs:
+        return []
+    geometries = get_store(store).get_many([id])
+    _, point_idx, distances = points_within_distance(geometries, xs, ys, distance)
+    return [
+        mgp.Record(index=int(i), distance=float(d))
+        for i, d in zip(point_idx, distances)
+    ]
+
+
+@mgp.read_proc
+def crossings(
+    context: mgp.ProcCtx,
+    store: str,
+    id: int,
+    candidate_store: str,
+    candidate_ids: mgp.List[int],
+) -> mgp.Record(index=int, angle=float):
+    """Every point where the geometry of id crosses a candidate geometry, with the crossing angle."""
+    if not candidate_ids:
+        return []
+    _, candidate_idx, angles = segment_crossings(
+        get_store(store).get_many([id]),
+        get_store(candidate_store).get_many(candidate_ids),
+    )
+    return [
+        mgp.Record(index=int(i), angle=float(angle))
+        for i, angle in zip(candidate_idx, angles)
+    ]